@@ -79,7 +79,87 @@ def run_migration():
         if 'is_bot' not in message_columns:
             logger.info("Adding is_bot column to messages table")
             cursor.execute("ALTER TABLE messages ADD COLUMN is_bot BOOLEAN DEFAULT 0")
-        
+
+        if 'analysis_pending' not in message_columns:
+            logger.info("Adding analysis_pending column to messages table")
+            cursor.execute("ALTER TABLE messages ADD COLUMN analysis_pending BOOLEAN DEFAULT 0")
+
+        if 'analysis_attempts' not in message_columns:
+            logger.info("Adding analysis_attempts column to messages table")
+            cursor.execute("ALTER TABLE messages ADD COLUMN analysis_attempts INTEGER DEFAULT 0")
+
+        for column_name, column_type in [
+            ('has_task', 'BOOLEAN'),
+            ('is_question', 'BOOLEAN'),
+            ('analysis_model', 'VARCHAR(100)'),
+            ('analysis_prompt_version', 'VARCHAR(20)'),
+            ('analyzed_at', 'DATETIME'),
+            ('simhash', 'INTEGER'),
+            ('reply_to_message_id', 'INTEGER'),
+            ('revision', 'INTEGER DEFAULT 0'),
+            ('edited_at', 'DATETIME'),
+            ('deleted_at', 'DATETIME')
+        ]:
+            if column_name not in message_columns:
+                logger.info(f"Adding {column_name} column to messages table")
+                cursor.execute(f"ALTER TABLE messages ADD COLUMN {column_name} {column_type}")
+
+        # Enforce one row per Telegram message. Of messages stored twice the analyzed copy is kept,
+        # otherwise the first one, so that no analysis is lost or repeated
+        cursor.execute("PRAGMA index_list(messages)")
+        message_indexes = [index[1] for index in cursor.fetchall()]
+
+        if 'uq_messages_chat_message' not in message_indexes:
+            cursor.execute(
+                "SELECT chat_id, message_id, GROUP_CONCAT(id || ':' || COALESCE(is_processed, 0) || '/' "
+                "|| COALESCE(analysis_pending, 0)) FROM messages GROUP BY chat_id, message_id "
+                "HAVING COUNT(*) > 1 AND COUNT(DISTINCT COALESCE(is_processed, 0) || '/' "
+                "|| COALESCE(analysis_pending, 0)) > 1"
+            )
+            for chat_id, message_id, copies in cursor.fetchall():
+                logger.warning(
+                    f"Message {message_id} of chat {chat_id} was stored with different analysis states "
+                    f"(id:is_processed/analysis_pending {copies})"
+                )
+            cursor.execute(
+                "DELETE FROM messages WHERE EXISTS (SELECT 1 FROM messages AS kept "
+                "WHERE kept.chat_id = messages.chat_id AND kept.message_id = messages.message_id "
+                "AND (COALESCE(kept.is_processed, 0) > COALESCE(messages.is_processed, 0) "
+                "OR (COALESCE(kept.is_processed, 0) = COALESCE(messages.is_processed, 0) AND kept.id < messages.id)))"
+            )
+            logger.info(f"Removed {cursor.rowcount} duplicate messages")
+            logger.info("Adding unique index on (chat_id, message_id) to messages table")
+            cursor.execute("CREATE UNIQUE INDEX uq_messages_chat_message ON messages (chat_id, message_id)")
+
+        # Check Chat table for rolling summary columns
+        cursor.execute("PRAGMA table_info(chats)")
+        chat_columns = [column[1] for column in cursor.fetchall()]
+
+        if 'rolling_summary' not in chat_columns:
+            logger.info("Adding rolling_summary column to chats table")
+            cursor.execute("ALTER TABLE chats ADD COLUMN rolling_summary TEXT")
+
+        if 'rolling_summary_start' not in chat_columns:
+            logger.info("Adding rolling_summary_start column to chats table")
+            cursor.execute("ALTER TABLE chats ADD COLUMN rolling_summary_start DATETIME")
+
+        if 'last_summary_message_id' not in chat_columns:
+            logger.info("Adding last_summary_message_id column to chats table")
+            cursor.execute("ALTER TABLE chats ADD COLUMN last_summary_message_id INTEGER")
+
+        # Check chat_sync_state table (created by init_db) for gap recovery columns
+        cursor.execute("PRAGMA table_info(chat_sync_state)")
+        sync_state_columns = [column[1] for column in cursor.fetchall()]
+
+        if sync_state_columns:
+            for column_name, column_type in [
+                ('peer_id', 'INTEGER'),
+                ('last_seen_message_id', 'INTEGER DEFAULT 0')
+            ]:
+                if column_name not in sync_state_columns:
+                    logger.info(f"Adding {column_name} column to chat_sync_state table")
+                    cursor.execute(f"ALTER TABLE chat_sync_state ADD COLUMN {column_name} {column_type}")
+
         # Commit changes
         conn.commit()
         logger.info("Database migration completed successfully")
@@ -33,7 +33,8 @@ setup(
         "aiohttp>=3.8.4",
         "pytz>=2023.3",
         "websockets>=11.0.3",
-        "beautifulsoup4>=4.11.2"
+        "beautifulsoup4>=4.11.2",
+        "numpy>=1.24.0"
     ],
     entry_points={
         "console_scripts": [
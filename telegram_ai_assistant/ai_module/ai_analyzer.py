@@ -7,17 +7,47 @@ import io
 from datetime import datetime
 from typing import List, Dict, Any, Optional, Union
 import httpx
-from openai import AsyncOpenAI
 from PIL import Image
 import re
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from config import OPENAI_API_KEY, OPENAI_MODEL
+from config import OPENAI_API_KEY, OPENAI_MODEL, SUMMARY_CONCURRENCY, AGENT_QUERY_CONCURRENCY, VISION_MAX_DIMENSION, VISION_JPEG_QUALITY
 from utils.logging_utils import setup_ai_logger
+from telegram_ai_assistant.utils.stream_utils import TelegramStreamWriter, stream_chat_completion
+from telegram_ai_assistant.ai_module.llm_gateway import client, chat_completion, bounded, fits_deadline, DeadlineExceeded, is_outage_error
+from telegram_ai_assistant.ai_module.schema_prompt import get_schema_prompt
+from telegram_ai_assistant.ai_module.sql_cache import match_sql_template, remember_sql_template, forget_sql_template
+from telegram_ai_assistant.ai_module.result_digest import compact_result, format_result_for_prompt
+from telegram_ai_assistant.ai_module.link_extractor import build_link_context, fetch_link
+from telegram_ai_assistant.ai_module.usage_tracker import usage_scope
+from telegram_ai_assistant.utils.media_policy import normalize_attachment, local_image_path, describe_attachment, IMAGE_KINDS
 logger = setup_ai_logger()
 logger.info(f"AI Module initializing with model: {OPENAI_MODEL}")
 logger.debug(f"OpenAI API Key: {OPENAI_API_KEY[:5]}...")
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Stored with every persisted analysis; bump when the analysis prompt or its output format changes
+ANALYSIS_PROMPT_VERSION = "1"
+def encode_image(data: Union[bytes, memoryview]) -> str:
+    """
+    Prepare an image buffer for vision analysis without writing it anywhere
+    Images larger than VISION_MAX_DIMENSION are downscaled, and anything that is not a small enough JPEG
+    is re-encoded as one; a JPEG that already fits is passed through untouched.
+    Args:
+        data: Image file content
+    Returns:
+        Base64 encoded JPEG
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        if image.format == "JPEG" and max(image.size) <= VISION_MAX_DIMENSION:
+            return base64.b64encode(data).decode('utf-8')
+        image.thumbnail((VISION_MAX_DIMENSION, VISION_MAX_DIMENSION))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=VISION_JPEG_QUALITY)
+    return base64.b64encode(output.getbuffer()).decode('utf-8')
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
 async def analyze_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
     text = message_data.get("text", "")
     attachments = message_data.get("attachments", [])
@@ -41,12 +71,32 @@ async def analyze_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
             "type": "text", 
             "text": f"Message from {sender_name} in chat '{chat_name}': {text}"
         })
-    for attachment in attachments:
-        if attachment.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp')):
+        link_context = await build_link_context(text)
+        if link_context:
+            content.append({
+                "type": "text",
+                "text": f"Content of the pages linked in the message (may be truncated):\n{link_context}"
+            })
+    # Attachments with the "memory" policy arrive as buffers and never touch the disk
+    media_buffers = message_data.get("media_buffers") or {}
+    for index, attachment in enumerate(map(normalize_attachment, attachments)):
+        image_buffer = media_buffers.get(index)
+        image_path = None if image_buffer is not None else local_image_path(attachment)
+        if image_buffer is not None or image_path:
             try:
-                with open(attachment, "rb") as img_file:
-                    base64_image = base64.b64encode(img_file.read()).decode('utf-8')
-                logger.debug(f"Processing image attachment: {attachment}")
+                if image_buffer is None:
+                    image_buffer = await asyncio.to_thread(_read_file, image_path)
+                base64_image = await asyncio.to_thread(encode_image, image_buffer)
+                logger.debug(f"Processing image attachment: {image_path or 'in-memory ' + describe_attachment(attachment)}")
+                if image_path:
+                    is_preview = image_path == attachment.get("thumbnail_path")
+                else:
+                    is_preview = attachment.get("kind") not in IMAGE_KINDS
+                if is_preview:
+                    content.append({
+                        "type": "text",
+                        "text": f"[Preview image of a {describe_attachment(attachment)} attachment]"
+                    })
                 content.append({
                     "type": "image_url",
                     "image_url": {
@@ -54,16 +104,16 @@ async def analyze_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
                     }
                 })
             except Exception as e:
-                logger.error(f"Error processing image attachment {attachment}: {str(e)}")
+                logger.error(f"Error processing image attachment {image_path or describe_attachment(attachment)}: {str(e)}")
                 content.append({
                     "type": "text",
                     "text": f"[There was an image attachment but it couldn't be processed: {str(e)}]"
                 })
         else:
-            logger.debug(f"Processing file attachment: {attachment}")
+            logger.debug(f"Processing file attachment: {describe_attachment(attachment)}")
             content.append({
                 "type": "text",
-                "text": f"[There was a file attachment: {os.path.basename(attachment)}]"
+                "text": f"[There was a file attachment: {describe_attachment(attachment)}]"
             })
     system_prompt = """
     You are an AI assistant analyzing messages from Telegram work chats.
@@ -73,11 +123,13 @@ async def analyze_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
     3. Whether the message describes a task or work item that should be tracked
     4. Whether the message is important and requires prompt attention
     5. If it contains a task, extract structured information about the task
-    Respond with a JSON object containing the analysis results.
+    Respond with a JSON object containing the analysis results, including at least the keys
+    "category" (string), "is_question", "has_task" and "is_important" (booleans).
     """
     try:
         logger.info(f"Calling OpenAI API to analyze message with ID {message_data.get('message_id')}")
-        response = await client.chat.completions.create(
+        response = await chat_completion(
+            "analyze_message",
             model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -87,6 +139,8 @@ async def analyze_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
         )
         analysis_text = response.choices[0].message.content
         analysis = json.loads(analysis_text)
+        analysis["model"] = OPENAI_MODEL
+        analysis["prompt_version"] = ANALYSIS_PROMPT_VERSION
         analysis["original_message"] = {
             "text": text,
             "chat_id": message_data.get("chat_id"),
@@ -97,6 +151,17 @@ async def analyze_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
         logger.debug(f"Full analysis result: {json.dumps(analysis)[:200]}...")
         return analysis
     except Exception as e:
+        if is_outage_error(e):
+            logger.warning(f"LLM unavailable or over budget, deferring analysis of message {message_data.get('message_id')}: {str(e)}")
+            return {
+                "category": "pending",
+                "is_important": False,
+                "is_question": False,
+                "has_task": False,
+                "deferred": True,
+                "error": str(e),
+                "context_summary": "Analysis deferred until the LLM is available"
+            }
         logger.error(f"Error analyzing message {message_data.get('message_id')}: {str(e)}", exc_info=True)
         return {
             "category": "error",
@@ -120,7 +185,8 @@ async def extract_task_from_message(message_data: Dict[str, Any]) -> Optional[Di
     If no task is detected, return {"is_task": false}
     """
     try:
-        response = await client.chat.completions.create(
+        response = await chat_completion(
+            "extract_task_from_message",
             model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -135,6 +201,8 @@ async def extract_task_from_message(message_data: Dict[str, Any]) -> Optional[Di
             return None
         return task_data
     except Exception as e:
+        if is_outage_error(e):
+            raise
         return None
 async def detect_question_target(message_data: Dict[str, Any], admin_user_id: int) -> Optional[Dict[str, Any]]:
     text = message_data.get("text", "")
@@ -182,7 +250,8 @@ async def detect_question_target(message_data: Dict[str, Any], admin_user_id: in
     - requires_answer: boolean indicating if this question needs a response
     """
     try:
-        response = await client.chat.completions.create(
+        response = await chat_completion(
+            "detect_question_target",
             model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -204,6 +273,8 @@ async def detect_question_target(message_data: Dict[str, Any], admin_user_id: in
                 }
         return None
     except Exception as e:
+        if is_outage_error(e):
+            raise
         logger.error(f"Error in detect_question_target: {str(e)}")
         return None
 async def generate_chat_summary(messages: List[Dict[str, Any]], chat_name: str) -> str:
@@ -228,7 +299,8 @@ async def generate_chat_summary(messages: List[Dict[str, Any]], chat_name: str)
     Keep the summary structured, brief but comprehensive.
     """
     try:
-        response = await client.chat.completions.create(
+        response = await chat_completion(
+            "generate_chat_summary",
             model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -239,6 +311,54 @@ async def generate_chat_summary(messages: List[Dict[str, Any]], chat_name: str)
         return summary
     except Exception as e:
         return f"Error generating summary: {str(e)}"
+async def fold_into_rolling_summary(previous_summary: Optional[str], messages: List[Dict[str, Any]], chat_name: str) -> str:
+    """
+    Update a stored chat summary with messages that arrived after it was written.
+    Only the new messages are sent to the model, together with the previous summary.
+    Args:
+        previous_summary: Current rolling summary, or None to start a new one
+        messages: New messages in chronological order
+        chat_name: Name of the chat
+    Returns:
+        The updated summary text
+    """
+    formatted_messages = []
+    for msg in messages:
+        sender = msg.get("sender_name", "Unknown")
+        text = msg.get("text", "")
+        timestamp = msg.get("timestamp", "")
+        if isinstance(timestamp, str):
+            timestamp_str = timestamp
+        else:
+            timestamp_str = timestamp.strftime("%Y-%m-%d %H:%M") if timestamp else ""
+        formatted_messages.append(f"[{timestamp_str}] {sender}: {text}")
+    messages_text = "\n".join(formatted_messages)
+    system_prompt = """
+    You maintain a running summary of a work chat.
+    You receive the current summary and the messages posted since it was written.
+    Return the updated summary: keep what is still relevant, merge in the new information,
+    and drop details that were superseded by later messages.
+    Focus on:
+    1. Key decisions made
+    2. Action items discussed
+    3. Important questions or issues raised
+    4. Overall topic and progress of discussion
+    Keep the summary structured, brief but comprehensive.
+    """
+    user_content = (
+        f"Chat name: {chat_name}\n\n"
+        f"Current summary:\n{previous_summary or '(no summary yet)'}\n\n"
+        f"New messages:\n{messages_text}"
+    )
+    response = await chat_completion(
+        "fold_into_rolling_summary",
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
+        ]
+    )
+    return response.choices[0].message.content
 async def analyze_productivity(productivity_data: List[Dict[str, Any]]) -> str:
     if not productivity_data:
         return "No productivity data available."
@@ -259,7 +379,8 @@ async def analyze_productivity(productivity_data: List[Dict[str, Any]]) -> str:
     Keep your analysis concise, objective, and action-oriented.
     """
     try:
-        response = await client.chat.completions.create(
+        response = await chat_completion(
+            "analyze_productivity",
             model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -271,14 +392,12 @@ async def analyze_productivity(productivity_data: List[Dict[str, Any]]) -> str:
     except Exception as e:
         return f"Error analyzing productivity: {str(e)}"
 async def extract_url_content(url: str) -> str:
-    try:
-        async with httpx.AsyncClient(follow_redirects=True) as client:
-            response = await client.get(url, timeout=10.0)
-            if response.status_code != 200:
-                return f"Failed to fetch URL: {response.status_code}"
-            return f"Successfully fetched URL. Content length: {len(response.text)} characters"
-    except Exception as e:
-        return f"Error extracting URL content: {str(e)}"
+    page = await fetch_link(url)
+    if not page:
+        return f"Failed to fetch URL: {url}"
+    if not page["text"]:
+        return f"URL has no readable text (content type {page['content_type'] or 'unknown'})"
+    return f"{page['title']}\n{page['text']}" if page["title"] else page["text"]
 async def suggest_response(question_text: str) -> str:
     system_prompt = """
     You are an AI assistant helping a team lead respond to questions from team members.
@@ -286,7 +405,8 @@ async def suggest_response(question_text: str) -> str:
     Keep your answer professional, actionable, and brief.
     """
     try:
-        response = await client.chat.completions.create(
+        response = await chat_completion(
+            "suggest_response",
             model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -297,6 +417,50 @@ async def suggest_response(question_text: str) -> str:
         return suggested_response
     except Exception as e:
         return f"Error generating response: {str(e)}"
+async def explain_query_result(user_question: str, result: List[Dict[str, Any]]) -> str:
+    """
+    Объясняет результаты SQL запроса понятным языком
+    
+    Args:
+        user_question: Вопрос пользователя
+        result: Строки результата запроса
+        
+    Returns:
+        Текст ответа для пользователя
+    """
+    result_explanation_response = await chat_completion(
+        "explain_query_result",
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": """Ты ИИ-аналитик для команды разработчиков, специализирующийся на управлении проектами.
+            Твоя задача - объяснить результаты запроса к базе данных понятным языком, делая акцент на аспектах разработки ПО.
+
+            Объясняя результаты команде разработчиков, делай акцент на:
+            1. Прогресс по задачам и соблюдение сроков
+            2. Продуктивность команды и отдельных разработчиков
+            3. Тренды в коммуникации и сотрудничестве
+            4. Приоритеты в работе и распределение нагрузки
+
+            Важно:
+            1. Отвечай только на заданный вопрос, без лишних деталей о SQL запросе
+            2. Не объясняй, как работает запрос или как он был написан
+            3. Просто дай краткий ответ по сути вопроса на основе данных из БД
+            4. Если данных нет или результат пустой, так и скажи кратко
+            5. Избегай технических терминов и джаргона SQL
+            6. Не упоминай таблицы, соединения и SQL синтаксис в ответе
+            7. Пиши так, как будто просто отвечаешь на вопрос пользователя
+            8. Если в результатах есть конкретные имена, цифры или даты, включи их в ответ
+
+            Плохой пример:
+            "Запрос, представленный в вопросе, предназначен для поиска пользователей, которые не имеют назначенных задач..."
+
+            Хороший пример:
+            "В настоящее время три разработчика не имеют назначенных задач: Александр, Юлия и Максим. Это может быть хорошей возможностью перераспределить рабочую нагрузку в команде."
+            """},
+            {"role": "user", "content": f"Вопрос пользователя: '{user_question}'\nРезультаты: {format_result_for_prompt(result)}"}
+        ]
+    )
+    return result_explanation_response.choices[0].message.content
 async def determine_and_execute_query(user_question: str) -> Dict[str, Any]:
     """
     Использует OpenAI function calling для определения, требуется ли SQL запрос к базе данных
@@ -308,74 +472,26 @@ async def determine_and_execute_query(user_question: str) -> Dict[str, Any]:
     Returns:
         Dictionary с информацией о типе ответа, SQL запросе и результатами
     """
-    # Описание доступных таблиц
-    db_schema = """
-    Доступные таблицы в базе данных:
-    
-    1. users (Пользователи):
-       - id: Integer, первичный ключ
-       - user_id: Integer, ID пользователя Telegram
-       - username: String, имя пользователя (может быть NULL)
-       - first_name: String, имя пользователя
-       - last_name: String, фамилия пользователя
-       - is_bot: Boolean, флаг бота
-       - created_at: DateTime, время создания записи
-    
-    2. messages (Сообщения):
-       - id: Integer, первичный ключ
-       - message_id: Integer, ID сообщения Telegram
-       - chat_id: Integer, внешний ключ на chats.chat_id
-       - sender_id: Integer, внешний ключ на users.user_id
-       - text: Text, текст сообщения
-       - attachments: JSON, прикрепленные файлы
-       - timestamp: DateTime, время сообщения
-       - is_important: Boolean, важное ли сообщение
-       - is_processed: Boolean, обработано ли сообщение
-       - category: String, категория сообщения
-       - is_bot: Boolean, отправлено ли ботом
-    
-    3. chats (Чаты):
-       - id: Integer, первичный ключ
-       - chat_id: Integer, ID чата Telegram
-       - chat_name: String, название чата
-       - is_active: Boolean, активен ли чат
-       - last_summary_time: DateTime, время последнего суммирования
-       - linear_team_id: String, ID команды в Linear
-       
-    4. tasks (Задачи):
-       - id: Integer, первичный ключ
-       - linear_id: String, ID задачи в Linear
-       - title: String, заголовок задачи
-       - description: Text, описание задачи
-       - status: String, статус задачи
-       - created_at: DateTime, время создания
-       - due_date: DateTime, срок исполнения
-       - assignee_id: Integer, внешний ключ на users.user_id
-       - message_id: Integer, ID сообщения, из которого создана задача
-       - chat_id: Integer, ID чата, из которого создана задача
-       
-    5. unanswered_questions (Неотвеченные вопросы):
-       - id: Integer, первичный ключ
-       - message_id: Integer, ID сообщения с вопросом
-       - chat_id: Integer, ID чата с вопросом
-       - target_user_id: Integer, внешний ключ на users.user_id (кому адресован вопрос)
-       - sender_id: Integer, ID пользователя, задавшего вопрос
-       - question: Text, текст вопроса
-       - asked_at: DateTime, время вопроса
-       - is_answered: Boolean, отвечен ли вопрос
-       - answered_at: DateTime, время ответа
-       - reminder_count: Integer, сколько напоминаний отправлено
-       - is_bot: Boolean, задан ли вопрос ботом
-       
-    6. team_productivity (Продуктивность команды):
-       - id: Integer, первичный ключ
-       - user_id: Integer, внешний ключ на users.user_id
-       - date: DateTime, дата записи
-       - message_count: Integer, количество сообщений
-       - tasks_created: Integer, количество созданных задач
-       - tasks_completed: Integer, количество завершенных задач
-       - avg_response_time: Integer, среднее время ответа
-    """
+    # Похожий вопрос уже задавали: используем проверенный SQL без обращения к модели
+    cached = await match_sql_template(user_question)
+    if cached:
+        from telegram_ai_assistant.utils.db_utils import execute_sql_query
+        result = await execute_sql_query(cached["sql"], cached["params"])
+        if result and "error" in result[0]:
+            await forget_sql_template(cached["template_id"], result[0]["error"])
+        else:
+            # The caller explains the result itself, so a cache hit costs no LLM call at all
+            return {
+                "type": "database_query",
+                "question": user_question,
+                "sql_query": cached["sql"],
+                "sql_params": cached["params"],
+                "explanation": f"Cached SQL ({cached['match']} match, similarity {cached['similarity']:.2f})",
+                "result": result,
+                "user_friendly_answer": None,
+                "cached": True,
+                "error": None
+            }
     
     # Определение функций для OpenAI
     functions = [
@@ -425,14 +541,16 @@ async def determine_and_execute_query(user_question: str) -> Dict[str, Any]:
     
     try:
         # Отправляем запрос в OpenAI
-        response = await client.chat.completions.create(
+        # The schema goes first so that every SQL-generating prompt shares the same cacheable prefix
+        response = await chat_completion(
+            "determine_and_execute_query",
             model=OPENAI_MODEL,
             messages=[
-                {"role": "system", "content": f"""Ты ИИ-помощник для команды разработчиков, работающий через Telegram.
+                {"role": "system", "content": get_schema_prompt() + """
                 
-                Твоя задача - определить, требуется ли SQL-запрос к базе данных для ответа на вопрос пользователя о разработке или управлении проектами.
+                Ты ИИ-помощник для команды разработчиков, работающий через Telegram.
                 
-                {db_schema}
+                Твоя задача - определить, требуется ли SQL-запрос к базе данных для ответа на вопрос пользователя о разработке или управлении проектами.
                 
                 Если вопрос пользователя требует получения информации из базы данных (например, статистика разработки, активность команды, задачи и сроки), 
                 используй функцию generate_sql_query и создай SQL-запрос.
@@ -484,39 +602,10 @@ async def determine_and_execute_query(user_question: str) -> Dict[str, Any]:
                         result = [dict(zip(columns, row)) for row in result_data]
                         
                     # Генерируем человеческое объяснение результатов
-                    result_explanation_response = await client.chat.completions.create(
-                        model=OPENAI_MODEL,
-                        messages=[
-                            {"role": "system", "content": """Ты ИИ-аналитик для команды разработчиков, специализирующийся на управлении проектами.
-                            Твоя задача - объяснить результаты запроса к базе данных понятным языком, делая акцент на аспектах разработки ПО.
-                            
-                            Объясняя результаты команде разработчиков, делай акцент на:
-                            1. Прогресс по задачам и соблюдение сроков
-                            2. Продуктивность команды и отдельных разработчиков
-                            3. Тренды в коммуникации и сотрудничестве
-                            4. Приоритеты в работе и распределение нагрузки
-                            
-                            Важно:
-                            1. Отвечай только на заданный вопрос, без лишних деталей о SQL запросе
-                            2. Не объясняй, как работает запрос или как он был написан
-                            3. Просто дай краткий ответ по сути вопроса на основе данных из БД
-                            4. Если данных нет или результат пустой, так и скажи кратко
-                            5. Избегай технических терминов и джаргона SQL
-                            6. Не упоминай таблицы, соединения и SQL синтаксис в ответе
-                            7. Пиши так, как будто просто отвечаешь на вопрос пользователя
-                            8. Если в результатах есть конкретные имена, цифры или даты, включи их в ответ
-                            
-                            Плохой пример:
-                            "Запрос, представленный в вопросе, предназначен для поиска пользователей, которые не имеют назначенных задач..."
-                            
-                            Хороший пример:
-                            "В настоящее время три разработчика не имеют назначенных задач: Александр, Юлия и Максим. Это может быть хорошей возможностью перераспределить рабочую нагрузку в команде."
-                            """},
-                            {"role": "user", "content": f"Вопрос пользователя: '{user_question}'\nРезультаты: {result}"}
-                        ]
-                    )
-                    
-                    result_explanation = result_explanation_response.choices[0].message.content
+                    result_explanation = await explain_query_result(user_question, result)
+                    # An empty result may just as well come from a wrong query, so only proven SQL is cached
+                    if result:
+                        await remember_sql_template(user_question, sql_query)
                     
                     return {
                         "type": "database_query",
@@ -530,7 +619,8 @@ async def determine_and_execute_query(user_question: str) -> Dict[str, Any]:
                 except Exception as e:
                     error = str(e)
                     # Пытаемся объяснить ошибку
-                    error_explanation_response = await client.chat.completions.create(
+                    error_explanation_response = await chat_completion(
+                        "determine_and_execute_query.explain_error",
                         model=OPENAI_MODEL,
                         messages=[
                             {"role": "system", "content": """Ты ИИ-помощник для команды разработчиков, объясняющий проблемы с получением данных.
@@ -608,6 +698,8 @@ async def iterative_reasoning(question: str, max_attempts: int = 3) -> Dict[str,
     Performs iterative reasoning on a complex question or problem.
     Shows reasoning steps as editable bubbles in Telegram.
     If an error or inconsistency is detected, it will retry with a different approach.
+    When run under llm_deadline, retries, verification and answer extraction are skipped
+    once they no longer fit in the remaining time, and the best answer so far is returned.
     
     Args:
         question: The question or problem to solve
@@ -621,6 +713,7 @@ async def iterative_reasoning(question: str, max_attempts: int = 3) -> Dict[str,
     attempts = []
     final_result = None
     is_success = False
+    deadline_hit = False
     
     system_prompt = """
     You are an AI reasoning assistant solving a complex problem step by step.
@@ -645,11 +738,17 @@ async def iterative_reasoning(question: str, max_attempts: int = 3) -> Dict[str,
         )
         message_id = message_obj.message_id
         logger.debug(f"Created initial reasoning message with ID: {message_id}")
+        writer = TelegramStreamWriter(bot, ADMIN_USER_ID, message_id)
     except Exception as e:
         logger.error(f"Error creating initial message: {str(e)}")
         message_id = None
+        writer = None
     
     for attempt in range(1, max_attempts + 1):
+        if attempts and not fits_deadline("iterative_reasoning.reason", "iterative_reasoning.verify"):
+            logger.info(f"Not enough time left for reasoning attempt {attempt}/{max_attempts}, using the best answer so far")
+            deadline_hit = True
+            break
         logger.info(f"Reasoning attempt {attempt}/{max_attempts}")
         
         try:
@@ -658,16 +757,26 @@ async def iterative_reasoning(question: str, max_attempts: int = 3) -> Dict[str,
                 previous_attempts_text = "\n\n".join([f"Attempt {i+1}: {a['reasoning']}" for i, a in enumerate(attempts)])
                 system_prompt += f"\n\nPrevious attempts had issues:\n{previous_attempts_text}\n\nTry a different approach and avoid these mistakes."
             
-            # Call the model with thinking steps format
-            response = await client.chat.completions.create(
-                model=OPENAI_MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Question: {question}\n\nShow your full reasoning process step by step, noting any uncertainties or assumptions."}
-                ]
-            )
+            reasoning_messages = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": f"Question: {question}\n\nShow your full reasoning process step by step, noting any uncertainties or assumptions."}
+            ]
             
-            reasoning = response.choices[0].message.content
+            # Call the model with thinking steps format, streaming the steps into the Telegram message
+            if writer:
+                attempt_title = f"Reasoning Attempt {attempt}/{max_attempts}" if attempt > 1 else "Reasoning Process"
+                writer.reset(f"🧠 Thinking about: {question}\n\n{attempt_title}:\n\n")
+                reasoning = await bounded(
+                    stream_chat_completion(client, writer, "iterative_reasoning.reason", model=OPENAI_MODEL, messages=reasoning_messages),
+                    "iterative_reasoning.reason"
+                )
+            else:
+                response = await chat_completion(
+                    "iterative_reasoning.reason",
+                    model=OPENAI_MODEL,
+                    messages=reasoning_messages
+                )
+                reasoning = response.choices[0].message.content
             
             # Record this attempt
             current_attempt = {
@@ -690,19 +799,16 @@ async def iterative_reasoning(question: str, max_attempts: int = 3) -> Dict[str,
                     # Create message with all attempts
                     full_message = f"🧠 *Thinking about:* {question}\n\n{attempt_header}{formatted_reasoning}"
                     
-                    # Keep message under Telegram's limit
-                    if len(full_message) > 4000:
-                        full_message = full_message[:3950] + "...\n_(reasoning truncated due to length)_"
-                    
-                    await bot.edit_message_text(
-                        chat_id=ADMIN_USER_ID,
-                        message_id=message_id,
-                        text=full_message,
-                        parse_mode="Markdown"
-                    )
+                    # Long reasoning continues in follow-up messages instead of being truncated
+                    await writer.finish(full_message, parse_mode="Markdown")
                 except Exception as e:
                     logger.error(f"Error updating reasoning message: {str(e)}")
             
+            if not fits_deadline("iterative_reasoning.verify"):
+                logger.info(f"Not enough time left to verify reasoning attempt {attempt}, using it unverified")
+                deadline_hit = True
+                break
+            
             # Verify reasoning for errors or contradictions
             verification_prompt = """
             Analyze the reasoning provided and determine if it contains:
@@ -720,7 +826,8 @@ async def iterative_reasoning(question: str, max_attempts: int = 3) -> Dict[str,
             }
             """
             
-            verification_response = await client.chat.completions.create(
+            verification_response = await chat_completion(
+                "iterative_reasoning.verify",
                 model=OPENAI_MODEL,
                 messages=[
                     {"role": "system", "content": verification_prompt},
@@ -745,15 +852,7 @@ async def iterative_reasoning(question: str, max_attempts: int = 3) -> Dict[str,
                     final_message += f"*Reasoning Process:*\n\n{formatted_reasoning}\n\n"
                     final_message += f"✅ *Final Answer:* {final_result}"
                     
-                    if len(final_message) > 4000:
-                        final_message = final_message[:3950] + "...\n_(message truncated due to length)_"
-                    
-                    await bot.edit_message_text(
-                        chat_id=ADMIN_USER_ID,
-                        message_id=message_id,
-                        text=final_message,
-                        parse_mode="Markdown"
-                    )
+                    await writer.finish(final_message, parse_mode="Markdown")
                 
                 logger.info(f"Successful reasoning after {attempt} attempts")
                 break
@@ -761,15 +860,18 @@ async def iterative_reasoning(question: str, max_attempts: int = 3) -> Dict[str,
             # If this was the last attempt and still not valid, use best effort
             if attempt == max_attempts:
                 # Extract final answer even if reasoning isn't perfect
-                extraction_response = await client.chat.completions.create(
-                    model=OPENAI_MODEL,
-                    messages=[
-                        {"role": "system", "content": "Extract the most likely answer from this reasoning, even if it contains some errors. Provide the best possible answer based on the parts of reasoning that are correct."},
-                        {"role": "user", "content": reasoning}
-                    ]
-                )
-                
-                final_result = extraction_response.choices[0].message.content
+                if fits_deadline("iterative_reasoning.extract"):
+                    extraction_response = await chat_completion(
+                        "iterative_reasoning.extract",
+                        model=OPENAI_MODEL,
+                        messages=[
+                            {"role": "system", "content": "Extract the most likely answer from this reasoning, even if it contains some errors. Provide the best possible answer based on the parts of reasoning that are correct."},
+                            {"role": "user", "content": reasoning}
+                        ]
+                    )
+                    final_result = extraction_response.choices[0].message.content
+                else:
+                    final_result = verification.get("final_answer") or reasoning
                 
                 # Update final message with partial success notice
                 if message_id:
@@ -778,15 +880,7 @@ async def iterative_reasoning(question: str, max_attempts: int = 3) -> Dict[str,
                     final_message += f"⚠️ *Best Effort Answer:* {final_result}\n\n"
                     final_message += "_(Note: Maximum attempts reached, providing best available answer)_"
                     
-                    if len(final_message) > 4000:
-                        final_message = final_message[:3950] + "...\n_(message truncated due to length)_"
-                    
-                    await bot.edit_message_text(
-                        chat_id=ADMIN_USER_ID,
-                        message_id=message_id,
-                        text=final_message,
-                        parse_mode="Markdown"
-                    )
+                    await writer.finish(final_message, parse_mode="Markdown")
                 
                 logger.info(f"Reached max attempts ({max_attempts}), providing best effort answer")
             else:
@@ -798,18 +892,14 @@ async def iterative_reasoning(question: str, max_attempts: int = 3) -> Dict[str,
                     retry_message += f"⚠️ *Issues detected:*\n{error_points}\n\n"
                     retry_message += f"_Trying again with attempt {attempt+1}/{max_attempts}..._"
                     
-                    if len(retry_message) > 4000:
-                        retry_message = retry_message[:3950] + "...\n_(message truncated due to length)_"
-                    
-                    await bot.edit_message_text(
-                        chat_id=ADMIN_USER_ID,
-                        message_id=message_id,
-                        text=retry_message,
-                        parse_mode="Markdown"
-                    )
+                    await writer.finish(retry_message, parse_mode="Markdown")
                 
                 logger.info(f"Issues found in attempt {attempt}, will try again")
                 
+        except DeadlineExceeded as e:
+            logger.warning(f"Reasoning attempt {attempt} stopped: {str(e)}")
+            deadline_hit = True
+            break
         except Exception as e:
             logger.error(f"Error in reasoning attempt {attempt}: {str(e)}")
             error_message = str(e)
@@ -841,15 +931,30 @@ async def iterative_reasoning(question: str, max_attempts: int = 3) -> Dict[str,
                     else:
                         error_update += "_Maximum attempts reached. Unable to provide reasoning._"
                     
-                    await bot.edit_message_text(
-                        chat_id=ADMIN_USER_ID,
-                        message_id=message_id,
-                        text=error_update,
-                        parse_mode="Markdown"
-                    )
+                    await writer.finish(error_update, parse_mode="Markdown")
                 except Exception as msg_e:
                     logger.error(f"Error updating error message: {str(msg_e)}")
     
+    # Out of time: degrade to the best answer produced so far instead of overshooting the deadline
+    if deadline_hit and final_result is None:
+        best_attempt = next((a for a in reversed(attempts) if not a.get("error")), None)
+        if best_attempt:
+            final_result = best_attempt.get("verification", {}).get("final_answer") or best_attempt["reasoning"]
+        if message_id:
+            try:
+                deadline_message = f"🧠 *Thinking about:* {question}\n\n"
+                if best_attempt:
+                    best_formatted = best_attempt["reasoning"].replace("Step ", "🔹 Step ")
+                    best_formatted = re.sub(r"(\d+\.\s)", r"🔸 \1", best_formatted)
+                    deadline_message += f"*Reasoning Process:*\n\n{best_formatted}\n\n"
+                    deadline_message += f"⏱ *Best Answer So Far:* {final_result}\n\n"
+                    deadline_message += "_(Note: Time budget exhausted, the answer was not fully verified)_"
+                else:
+                    deadline_message += "⏱ _Time budget exhausted before an answer was ready. Please try again._"
+                await writer.finish(deadline_message, parse_mode="Markdown")
+            except Exception as msg_e:
+                logger.error(f"Error updating deadline message: {str(msg_e)}")
+    
     # Create the final result dictionary
     result = {
         "question": question,
@@ -857,6 +962,7 @@ async def iterative_reasoning(question: str, max_attempts: int = 3) -> Dict[str,
         "final_result": final_result,
         "is_success": is_success,
         "num_attempts": len(attempts),
+        "deadline_exceeded": deadline_hit,
         "message_id": message_id
     }
     
@@ -891,6 +997,230 @@ async def answer_with_reasoning(question: str) -> Dict[str, Any]:
             "success": False
         }
 
+async def summarize_single_chat(chat_id: int, chat_name: str, hours: int = 24) -> Dict[str, Any]:
+    """
+    Collect, analyze and summarize the recent messages of one chat.
+    Used as the per-chat unit of work when several chats are summarized at once.
+    
+    Args:
+        chat_id: Chat ID
+        chat_name: Chat name shown in prompts and progress
+        hours: Number of hours to look back
+        
+    Returns:
+        Dictionary with status ("completed", "empty" or "error"), message_count,
+        topics, analysis and summary
+    """
+    from telegram_ai_assistant.utils.db_utils import get_recent_chat_messages
+    
+    result = {
+        "chat_id": chat_id,
+        "chat_name": chat_name,
+        "status": "in_progress",
+        "message_count": 0,
+        "topics": [],
+        "analysis": {},
+        "summary": ""
+    }
+    
+    chat_messages = await get_recent_chat_messages(chat_id, hours=hours, limit=100)
+    chat_messages = [m for m in chat_messages if m.get("text")]
+    if not chat_messages:
+        result["status"] = "empty"
+        return result
+    result["message_count"] = len(chat_messages)
+    
+    formatted_messages = []
+    for msg in reversed(chat_messages[:50]):  # Newest 50 messages, in chronological order
+        timestamp = msg.get("timestamp", "")
+        timestamp_str = timestamp.strftime("%Y-%m-%d %H:%M") if isinstance(timestamp, datetime) else str(timestamp)
+        formatted_messages.append(f"[{timestamp_str}] {msg.get('sender_name', 'Unknown')}: {msg.get('text', '')}")
+    messages_text = "\n".join(formatted_messages)
+    
+    topic_analysis = await chat_completion(
+        "summarize_single_chat.topics",
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": """
+            Analyze the conversation and identify the main discussion topics.
+            Return the results as JSON: {"main_topics": ["Topic 1", "Topic 2", ...]}
+            """},
+            {"role": "user", "content": f"Chat name: {chat_name}\n\nChat messages:\n{messages_text}"}
+        ],
+        response_format={"type": "json_object"}
+    )
+    result["topics"] = json.loads(topic_analysis.choices[0].message.content).get("main_topics", [])
+    
+    topics_list = ", ".join(result["topics"])
+    summary_response = await chat_completion(
+        "summarize_single_chat.summary",
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": f"""
+            Summarize the conversation based on these main topics: {topics_list}.
+            Return the analysis as JSON:
+            {{
+                "key_decisions": ["Decision 1", ...],
+                "action_items": ["Action 1", ...],
+                "important_questions": ["Question 1", ...],
+                "summary": "A short summary of the discussion and its progress"
+            }}
+            """},
+            {"role": "user", "content": f"Chat name: {chat_name}\n\nChat messages:\n{messages_text}"}
+        ],
+        response_format={"type": "json_object"}
+    )
+    analysis_data = json.loads(summary_response.choices[0].message.content)
+    result["analysis"] = analysis_data
+    result["summary"] = analysis_data.get("summary", "")
+    result["status"] = "completed"
+    return result
+
+async def merge_chat_summaries(chat_summaries: List[Dict[str, Any]], period_label: str) -> str:
+    """
+    Merge per-chat summaries into one digest
+    
+    Args:
+        chat_summaries: Dicts with chat_name, summary and optionally analysis
+        period_label: Human readable period, e.g. "24h" or "Today (UTC)"
+        
+    Returns:
+        Digest text
+    """
+    sections = []
+    for chat in chat_summaries:
+        section = f"Chat: {chat['chat_name']}\nSummary: {chat.get('summary', '')}"
+        analysis = chat.get("analysis") or {}
+        for key, label in (("key_decisions", "Decisions"), ("action_items", "Action items"), ("important_questions", "Open questions")):
+            if analysis.get(key):
+                section += f"\n{label}: " + "; ".join(str(item) for item in analysis[key])
+        sections.append(section)
+    
+    response = await chat_completion(
+        "merge_chat_summaries",
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": "You are a professional summarizer for business communications. Merge the per-chat summaries into one concise digest: start with the most important cross-chat themes, then list key decisions, action items and open questions, mentioning the chat each item comes from."},
+            {"role": "user", "content": f"Period: {period_label}\n\n" + "\n\n".join(sections)}
+        ]
+    )
+    return response.choices[0].message.content
+
+async def _summarize_all_chats(time_period: str, hours: int, bot, admin_user_id: int, main_message_id: int) -> Dict[str, Any]:
+    """
+    Fan the discussion summary out over all active chats.
+    Chats are summarized concurrently (at most SUMMARY_CONCURRENCY at a time) while one
+    progress message shows the status of every chat; the results are merged into one digest.
+    """
+    from telegram_ai_assistant.utils.db_utils import get_active_chats
+    
+    state = {
+        "completed_steps": 0,
+        "total_steps": 2,
+        "current_step": "chat_summaries",
+        "chats": [],
+        "messages": [],
+        "summary": "",
+        "status": "in_progress",
+        "errors": []
+    }
+    
+    chats = await get_active_chats()
+    if not chats:
+        await bot.edit_message_text(
+            chat_id=admin_user_id,
+            message_id=main_message_id,
+            text=f"🔍 *Summary for all monitored chats*\n\n❌ *Failed:* No active chats found",
+            parse_mode="Markdown"
+        )
+        state["status"] = "failed"
+        state["errors"].append("No active chats found")
+        return state
+    
+    progress = {chat["chat_id"]: "⏳ queued" for chat in chats}
+    progress_writer = TelegramStreamWriter(bot, admin_user_id)
+    
+    def render_progress() -> str:
+        done = sum(1 for status in progress.values() if not status.startswith(("⏳", "🔄")))
+        lines = [f"📊 Step 1/2: Summarizing {len(chats)} chats ({done}/{len(chats)} done)\n"]
+        lines += [f"{progress[chat['chat_id']]} — {chat['chat_name']}" for chat in chats]
+        return "\n".join(lines)
+    
+    async def show_progress(final: bool = False):
+        # Flood waits or "message is not modified" must not fail the chat being summarized
+        try:
+            if final:
+                await progress_writer.finish(render_progress())
+            else:
+                await progress_writer.update(render_progress())
+        except Exception as e:
+            logger.warning(f"Could not update summary progress: {str(e)}")
+    
+    await progress_writer.start(render_progress())
+    semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+    
+    async def run_chat(chat: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        async with semaphore:
+            progress[chat["chat_id"]] = "🔄 working"
+            await show_progress()
+            try:
+                with usage_scope(chat_id=chat["chat_id"]):
+                    result = await summarize_single_chat(chat["chat_id"], chat["chat_name"], hours)
+                if result["status"] == "empty":
+                    progress[chat["chat_id"]] = "➖ no messages"
+                else:
+                    progress[chat["chat_id"]] = f"✅ {result['message_count']} messages"
+                return result
+            except Exception as e:
+                logger.error(f"Error summarizing chat {chat['chat_id']}: {str(e)}", exc_info=True)
+                progress[chat["chat_id"]] = "❌ error"
+                state["errors"].append(f"{chat['chat_name']}: {str(e)}")
+                return None
+            finally:
+                await show_progress()
+    
+    results = await asyncio.gather(*(run_chat(chat) for chat in chats))
+    await show_progress(final=True)
+    
+    state["chats"] = [r for r in results if r and r["status"] == "completed"]
+    state["messages_count"] = sum(r["message_count"] for r in state["chats"])
+    state["completed_steps"] = 1
+    state["current_step"] = "merge"
+    
+    if not state["chats"]:
+        await bot.edit_message_text(
+            chat_id=admin_user_id,
+            message_id=main_message_id,
+            text=f"🔍 *Summary for all monitored chats*\n\n❌ *Failed:* No messages found for time period: {time_period}",
+            parse_mode="Markdown"
+        )
+        state["status"] = "failed"
+        state["errors"].append("No messages found for the specified time period")
+        return state
+    
+    # Step 2: merge the per-chat results into one digest
+    digest_writer = TelegramStreamWriter(bot, admin_user_id)
+    try:
+        await digest_writer.start("📝 Step 2/2: Merging chat summaries...")
+        state["summary"] = await merge_chat_summaries(state["chats"], time_period)
+        await digest_writer.finish(f"📝 *Step 2/2: Digest for {len(state['chats'])} chats*\n\n{state['summary']}", parse_mode="Markdown")
+        await bot.edit_message_text(
+            chat_id=admin_user_id,
+            message_id=main_message_id,
+            text=f"✅ *Summary Process Complete*\n\nDiscussion analyzed for {len(state['chats'])} of {len(chats)} chats\nTime period: {time_period}\nMessages analyzed: {state['messages_count']}\n\nYou can view the results in the message threads below.",
+            parse_mode="Markdown"
+        )
+        state["completed_steps"] = 2
+        state["current_step"] = "completed"
+        state["status"] = "completed"
+    except Exception as e:
+        logger.error(f"Error merging chat summaries: {str(e)}", exc_info=True)
+        await digest_writer.finish(f"📝 Step 2/2: Merging chat summaries\n\n❌ Error: {str(e)}")
+        state["status"] = "error"
+        state["errors"].append(f"Merge error: {str(e)}")
+    
+    return state
+
 async def iterative_discussion_summary(chat_id: int = None, time_period: str = "24h", max_attempts: int = 3) -> Dict[str, Any]:
     """
     Generate discussion summary with multiple steps and error correction.
@@ -929,6 +1259,9 @@ async def iterative_discussion_summary(chat_id: int = None, time_period: str = "
         logger.error(f"Error creating initial message: {str(e)}")
         return {"error": str(e), "completed": False}
     
+    if chat_id is None:
+        return await _summarize_all_chats(time_period, hours, bot, ADMIN_USER_ID, main_message_id)
+    
     # Step 1: Data collection
     data_message = await bot.send_message(
         chat_id=ADMIN_USER_ID,
@@ -1091,7 +1424,8 @@ async def iterative_discussion_summary(chat_id: int = None, time_period: str = "
         }
         """
         
-        topic_analysis = await client.chat.completions.create(
+        topic_analysis = await chat_completion(
+            "iterative_discussion_summary.topics",
             model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -1203,7 +1537,8 @@ async def iterative_discussion_summary(chat_id: int = None, time_period: str = "
         }}
         """
         
-        detailed_analysis = await client.chat.completions.create(
+        detailed_analysis = await chat_completion(
+            "iterative_discussion_summary.analysis",
             model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -1323,7 +1658,8 @@ async def iterative_discussion_summary(chat_id: int = None, time_period: str = "
         Format the summary to be clear, readable and professional with proper paragraphs and structure.
         """
         
-        final_summary = await client.chat.completions.create(
+        final_summary = await chat_completion(
+            "iterative_discussion_summary.final",
             model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": "You are a professional summarizer for business communications. Create clear, concise, well-structured summaries."},
@@ -1414,76 +1750,6 @@ async def ai_agent_query(question: str) -> Dict[str, Any]:
         logger.error(f"Error creating initial message: {str(e)}")
         message_id = None
     
-    # Database schema description
-    db_schema = """
-    Available database tables:
-    
-    1. users
-       - id (INTEGER PRIMARY KEY)
-       - user_id (INTEGER) - Telegram user ID
-       - username (TEXT) - Telegram username
-       - first_name (TEXT) - User's first name
-       - last_name (TEXT) - User's last name
-       - is_bot (BOOLEAN) - Whether user is a bot
-       - created_at (TIMESTAMP) - When user was added to DB
-    
-    2. messages
-       - id (INTEGER PRIMARY KEY)
-       - message_id (INTEGER) - Telegram message ID
-       - chat_id (INTEGER) - ID of the chat where message was sent
-       - sender_id (INTEGER) - User ID who sent the message
-       - text (TEXT) - Message content
-       - attachments (TEXT) - JSON string with attachments
-       - timestamp (TIMESTAMP) - When message was sent
-       - is_important (BOOLEAN) - Important flag
-       - is_processed (BOOLEAN) - Processed flag
-       - category (TEXT) - Message category
-       - is_bot (BOOLEAN) - Whether sent by bot
-    
-    3. chats
-       - id (INTEGER PRIMARY KEY)
-       - chat_id (INTEGER) - Telegram chat ID
-       - chat_name (TEXT) - Chat name
-       - is_active (BOOLEAN) - Active status
-       - last_summary_time (TIMESTAMP) - Last summary generation time
-       - linear_team_id (TEXT) - Associated Linear team ID
-    
-    4. tasks
-       - id (INTEGER PRIMARY KEY)
-       - linear_id (TEXT) - Linear task ID
-       - title (TEXT) - Task title
-       - description (TEXT) - Task description
-       - status (TEXT) - Task status
-       - created_at (TIMESTAMP) - Creation time
-       - due_date (TIMESTAMP) - Due date
-       - assignee_id (INTEGER) - Assigned user ID
-       - message_id (INTEGER) - Origin message ID
-       - chat_id (INTEGER) - Origin chat ID
-    
-    5. unanswered_questions
-       - id (INTEGER PRIMARY KEY)
-       - message_id (INTEGER) - Question message ID
-       - chat_id (INTEGER) - Chat where question was asked
-       - target_user_id (INTEGER) - User who should answer
-       - sender_id (INTEGER) - User who asked
-       - question (TEXT) - Question text
-       - asked_at (TIMESTAMP) - When asked
-       - is_answered (BOOLEAN) - Answered status
-       - answered_at (TIMESTAMP) - When answered
-       - reminder_count (INTEGER) - Reminder count
-       - last_reminder_at (TIMESTAMP) - Last reminder time
-       - is_bot (BOOLEAN) - Whether from bot
-    
-    6. team_productivity
-       - id (INTEGER PRIMARY KEY)
-       - user_id (INTEGER) - User ID
-       - date (TIMESTAMP) - Record date
-       - message_count (INTEGER) - Message count
-       - tasks_created (INTEGER) - Tasks created
-       - tasks_completed (INTEGER) - Tasks completed
-       - avg_response_time (INTEGER) - Average response time
-    """
-    
     # First, update message to show we're analyzing the question
     if message_id:
         await bot.edit_message_text(
@@ -1510,8 +1776,7 @@ async def ai_agent_query(question: str) -> Dict[str, Any]:
         
         User question: {question}
         
-        Based on this database schema:
-        {db_schema}
+        Use the database schema described in the system prompt.
         
         IMPORTANT: Always use names instead of IDs in your final answers. When querying:
         1. ALWAYS join the 'users' table when you need user information, to show usernames/first_name/last_name
@@ -1531,6 +1796,11 @@ async def ai_agent_query(question: str) -> Dict[str, Any]:
         3. How to structure the SQL queries with proper JOINs to show names
         4. How to interpret the results
         
+        Steps run in parallel unless they depend on each other. Prefer independent queries.
+        If a query needs the results of an earlier step, list that step in "depends_on" and
+        write {{{{step_N}}}} in the SQL where the values of the first column returned by
+        step N should go, e.g. WHERE user_id IN ({{{{step_1}}}}).
+        
         Return a JSON with the following structure:
         {{
             "question_analysis": "Your understanding of the question",
@@ -1540,13 +1810,15 @@ async def ai_agent_query(question: str) -> Dict[str, Any]:
                     "step": 1,
                     "description": "Description of step 1",
                     "sql_query": "SQL query for step 1",
-                    "reasoning": "Why this query is needed and what it will tell us"
+                    "reasoning": "Why this query is needed and what it will tell us",
+                    "depends_on": []
                 }},
                 {{
                     "step": 2,
                     "description": "Description of step 2",
                     "sql_query": "SQL query for step 2 (or null if not a query step)",
-                    "reasoning": "Why this step is necessary and what insights it provides"
+                    "reasoning": "Why this step is necessary and what insights it provides",
+                    "depends_on": []
                 }}
             ]
         }}
@@ -1561,10 +1833,11 @@ async def ai_agent_query(question: str) -> Dict[str, Any]:
                 parse_mode="Markdown"
             )
         
-        planning_response = await client.chat.completions.create(
+        planning_response = await chat_completion(
+            "ai_agent_query.plan",
             model=OPENAI_MODEL,
             messages=[
-                {"role": "system", "content": "You are an AI agent specialized in planning database queries to answer questions. Always include user names and chat names instead of IDs."},
+                {"role": "system", "content": get_schema_prompt() + "\n\nYou are an AI agent specialized in planning database queries to answer questions. Always include user names and chat names instead of IDs."},
                 {"role": "user", "content": planning_prompt}
             ],
             response_format={"type": "json_object"}
@@ -1592,133 +1865,25 @@ async def ai_agent_query(question: str) -> Dict[str, Any]:
                 parse_mode="Markdown"
             )
         
-        # Step 2: Execute each step in the plan
-        all_results = []
-        from telegram_ai_assistant.utils.db_utils import execute_sql_query
-        
-        for i, step in enumerate(plan.get('plan_steps', [])):
-            step_num = step.get('step')
-            step_desc = step.get('description')
-            sql_query = step.get('sql_query')
-            step_reasoning = step.get('reasoning', '')
-            
-            step_result = {
-                "step": step_num,
-                "description": step_desc,
-                "reasoning": step_reasoning,
-                "query": sql_query,
-                "data": None,
-                "error": None
-            }
-            
-            # Update message to show current step with reasoning
-            if message_id:
-                current_step_text = f"🤖 *AI Agent Processing*\n\n*Question:* {question}\n\n*Executing Step {step_num}:*\n{step_desc}\n"
-                if step_reasoning:
-                    current_step_text += f"*Reasoning:* _{step_reasoning}_\n\n"
-                if sql_query:
-                    current_step_text += f"*SQL Query:*\n```{sql_query}```\n\n"
-                    current_step_text += "_Executing query and analyzing patterns in the data..._"
-                
-                await bot.edit_message_text(
-                    chat_id=ADMIN_USER_ID,
-                    message_id=message_id,
-                    text=current_step_text,
-                    parse_mode="Markdown"
-                )
-            
-            # Execute SQL query if this step has one
-            if sql_query:
-                try:
-                    start_time = datetime.now()
-                    
-                    # Show query processing status
-                    if message_id:
-                        await bot.edit_message_text(
-                            chat_id=ADMIN_USER_ID,
-                            message_id=message_id,
-                            text=f"{current_step_text}\n\n*Query Status:*\n• Sending query to database\n• Processing SQL statements\n• Retrieving result set\n• Preparing data for analysis",
-                            parse_mode="Markdown"
-                        )
-                    
-                    result = await execute_sql_query(sql_query)
-                    execution_time = (datetime.now() - start_time).total_seconds()
-                    
-                    # Check if we need to enrich the results with names
-                    if message_id:
-                        await bot.edit_message_text(
-                            chat_id=ADMIN_USER_ID,
-                            message_id=message_id,
-                            text=f"{current_step_text}\n\n*Query Status:*\n• Query executed successfully\n• Retrieved {len(result) if result else 0} rows\n• Enriching results with user and chat names\n• Formatting data for readability",
-                            parse_mode="Markdown"
-                        )
-                    
-                    result = await enrich_query_results(result)
-                    
-                    step_result["data"] = result
-                    step_result["execution_time"] = f"{execution_time:.2f} seconds"
-                    step_result["row_count"] = len(result) if result else 0
-                    
-                    # Update message with query results and analysis
-                    if message_id:
-                        result_text = f"🤖 *AI Agent Processing*\n\n*Question:* {question}\n\n*Step {step_num} Complete:*\n{step_desc}\n\n"
-                        if step_reasoning:
-                            result_text += f"*Reasoning:* _{step_reasoning}_\n\n"
-                        result_text += f"*Execution Results:*\n• Query executed in {execution_time:.2f} seconds\n• Retrieved {len(result) if result else 0} rows of data\n"
-                        
-                        if result and len(result) > 0:
-                            result_text += "\n*Data Patterns:*\n"
-                            # Try to extract some basic patterns from the data
-                            if len(result) == 1:
-                                result_text += "• Found a single matching record\n"
-                            else:
-                                result_text += f"• Found {len(result)} matching records\n"
-                            
-                            # Check for some basic patterns in the data
-                            columns = list(result[0].keys())
-                            
-                            # Sample results section
-                            result_text += "\n*Sample Results:*\n"
-                            # Format as table for display
-                            result_text += "| " + " | ".join(columns) + " |\n"
-                            result_text += "| " + " | ".join(["---" for _ in columns]) + " |\n"
-                            
-                            # Show up to 5 rows
-                            for row in result[:5]:
-                                result_text += "| " + " | ".join([str(row.get(col, "")) for col in columns]) + " |\n"
-                            
-                            if len(result) > 5:
-                                result_text += f"\n_...and {len(result) - 5} more rows..._\n"
-                        else:
-                            result_text += "\n*Results:* _No data returned from query._\n"
-                            result_text += "• This could indicate that there are no matching records\n• May need to adjust query parameters or check different tables\n"
-                        
-                        await bot.edit_message_text(
-                            chat_id=ADMIN_USER_ID,
-                            message_id=message_id,
-                            text=result_text,
-                            parse_mode="Markdown"
-                        )
-                except Exception as e:
-                    error_msg = str(e)
-                    logger.error(f"Error executing query in step {step_num}: {error_msg}")
-                    step_result["error"] = error_msg
-                    
-                    # Update message with error and reasoning
-                    if message_id:
-                        error_text = f"🤖 *AI Agent Processing*\n\n*Question:* {question}\n\n*Error in Step {step_num}:*\n{step_desc}\n\n"
-                        error_text += f"*SQL Error:* ```{error_msg}```\n\n"
-                        error_text += "*Analysis:*\n• The query failed to execute\n• This may be due to syntax errors, invalid table/column references, or access permissions\n• Attempting to continue with remaining steps for partial insights\n"
-                        error_text += "_Proceeding to next steps to gather available information..._"
-                        
-                        await bot.edit_message_text(
-                            chat_id=ADMIN_USER_ID,
-                            message_id=message_id,
-                            text=error_text,
-                            parse_mode="Markdown"
-                        )
+        # Step 2: Execute the plan as a dependency graph - independent queries run in parallel
+        steps = plan.get('plan_steps', [])
+        on_progress = None
+        if message_id:
+            progress_writer = TelegramStreamWriter(
+                bot, ADMIN_USER_ID, message_id,
+                header=f"🤖 AI Agent Processing\n\nQuestion: {question}\n\nExecuting {len(steps)} steps, independent queries in parallel:\n"
+            )
+            status_lines = []
             
-            all_results.append(step_result)
+            async def on_progress(step_result):
+                status = "✅" if step_result.get("error") is None else "❌"
+                line = f"{status} Step {step_result['step']}: {step_result['description']}"
+                if step_result.get("query") and step_result.get("error") is None:
+                    line += f" ({step_result.get('row_count', 0)} rows in {step_result.get('execution_time')})"
+                status_lines.append(line)
+                await progress_writer.update("\n".join(status_lines))
+        
+        all_results = await execute_plan_steps(steps, on_progress)
         
         # Update message to show we're analyzing all results
         if message_id:
@@ -1740,33 +1905,45 @@ async def ai_agent_query(question: str) -> Dict[str, Any]:
             )
         
         # Step 3: Generate the final answer based on all results
+        prompt_results = [dict(step_result, data=compact_result(step_result.get("data"))) for step_result in all_results]
         answer_prompt = f"""
         Based on the following query results, provide a comprehensive answer to the user's question.
         
         User question: {question}
         
-        Query steps and results:
-        {json.dumps(all_results, indent=2)}
+        Query steps and results (results with many rows are given as column statistics over all rows plus a sample):
+        {json.dumps(prompt_results, indent=2, ensure_ascii=False, default=str)}
         
         IMPORTANT REQUIREMENTS:
         1. ALWAYS use usernames or full names instead of user IDs in your answer
         2. ALWAYS use chat names instead of chat IDs in your answer
         3. Format any dates in a user-friendly way (e.g., "January 15, 2023" or "15 Jan 2023")
         4. If showing metrics, include percentages where appropriate
+        5. Explain what each step's results show in the same answer, do not describe steps that were skipped
         
         Provide a clear, detailed answer that directly addresses the user's question.
         If the results don't contain enough information to answer the question completely, acknowledge that and explain what information is missing.
         """
         
-        answer_response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "You are an AI assistant specialized in interpreting database query results to answer questions. Always use names instead of IDs in your answers. Format data in a human-readable way."},
-                {"role": "user", "content": answer_prompt}
-            ]
-        )
+        answer_messages = [
+            {"role": "system", "content": "You are an AI assistant specialized in interpreting database query results to answer questions. Always use names instead of IDs in your answers. Format data in a human-readable way."},
+            {"role": "user", "content": answer_prompt}
+        ]
         
-        final_answer = answer_response.choices[0].message.content
+        if message_id:
+            # Stream the answer into the agent message instead of waiting for the full completion
+            writer = TelegramStreamWriter(bot, ADMIN_USER_ID, message_id, header=f"🤖 AI Agent Results\n\nQuestion: {question}\n\nAnswer:\n")
+            final_answer = await bounded(
+                stream_chat_completion(client, writer, "ai_agent_query.answer", model=OPENAI_MODEL, messages=answer_messages),
+                "ai_agent_query.answer"
+            )
+        else:
+            answer_response = await chat_completion(
+                "ai_agent_query.answer",
+                model=OPENAI_MODEL,
+                messages=answer_messages
+            )
+            final_answer = answer_response.choices[0].message.content
         
         # Update message with final answer
         if message_id:
@@ -1781,12 +1958,7 @@ async def ai_agent_query(question: str) -> Dict[str, Any]:
                     exec_time = step_result.get("execution_time", "N/A")
                     final_text += f"{status} Step {step_result.get('step')}: {rows} rows in {exec_time}\n"
             
-            await bot.edit_message_text(
-                chat_id=ADMIN_USER_ID,
-                message_id=message_id,
-                text=final_text,
-                parse_mode="Markdown"
-            )
+            await writer.finish(final_text, parse_mode="Markdown")
         
         # Return the final result
         return {
@@ -1821,6 +1993,126 @@ async def ai_agent_query(question: str) -> Dict[str, Any]:
             "success": False
         }
 
+_STEP_REFERENCE = re.compile(r"\{\{\s*step_(\d+)\s*\}\}")
+
+def _substitute_step_results(sql_query: str, results_by_step: Dict[int, Dict[str, Any]]) -> str:
+    """Replace {{step_N}} with a SQL list of the first column values returned by step N"""
+    def replace(match):
+        data = results_by_step.get(int(match.group(1)), {}).get("data") or []
+        literals = []
+        for row in data:
+            value = next(iter(row.values()), None) if row else None
+            if value is None:
+                continue
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                literals.append(str(value))
+            else:
+                literals.append("'" + str(value).replace("'", "''") + "'")
+        return ", ".join(literals) or "NULL"
+    return _STEP_REFERENCE.sub(replace, sql_query)
+
+def validate_plan_steps(steps: List[Dict[str, Any]]) -> List[int]:
+    """
+    Number the planned steps and reject plans that reuse a step number
+    Steps without an integer "step" are numbered by their position.
+    Args:
+        steps: plan_steps from the agent planner
+    Returns:
+        Step numbers in plan order
+    Raises:
+        ValueError: If two steps share a number, which would make {{step_N}} ambiguous
+    """
+    numbers = [step.get('step') if isinstance(step.get('step'), int) else index + 1 for index, step in enumerate(steps)]
+    duplicates = sorted({number for number in numbers if numbers.count(number) > 1})
+    if duplicates:
+        raise ValueError(f"Plan reuses step numbers {duplicates}")
+    return numbers
+
+async def execute_plan_steps(steps: List[Dict[str, Any]], on_progress=None) -> List[Dict[str, Any]]:
+    """
+    Execute planned agent steps as a dependency graph
+    
+    A step depends on the steps listed in its "depends_on" and on the steps whose results it
+    references as {{step_N}} in its SQL. Only earlier steps can be dependencies, so the graph
+    is always acyclic. Steps without pending dependencies run concurrently on read-only
+    connections, at most AGENT_QUERY_CONCURRENCY queries at a time.
+    
+    Args:
+        steps: plan_steps from the agent planner
+        on_progress: Optional coroutine function called with each finished step result
+        
+    Returns:
+        Step results in plan order
+    Raises:
+        ValueError: If the plan reuses a step number
+    """
+    from telegram_ai_assistant.utils.db_utils import execute_read_query
+    semaphore = asyncio.Semaphore(AGENT_QUERY_CONCURRENCY)
+    results_by_step: Dict[int, Dict[str, Any]] = {}
+    tasks: Dict[int, asyncio.Task] = {}
+    dependency_map: Dict[int, List[int]] = {}
+    
+    async def run_step(step_num: int, step: Dict[str, Any], dependencies: List[int]) -> Dict[str, Any]:
+        sql_query = step.get('sql_query')
+        step_result = {
+            "step": step_num,
+            "description": step.get('description'),
+            "reasoning": step.get('reasoning', ''),
+            "query": sql_query,
+            "depends_on": dependencies,
+            "data": None,
+            "error": None
+        }
+        if dependencies:
+            # A dependency that raised only fails the steps that need it, not the whole plan
+            await asyncio.gather(*(tasks[dependency] for dependency in dependencies), return_exceptions=True)
+        failed = [
+            dependency for dependency in dependencies
+            if dependency not in results_by_step or results_by_step[dependency].get("error")
+        ]
+        if failed:
+            step_result["error"] = f"Skipped because step {', '.join(map(str, failed))} failed"
+        elif sql_query:
+            try:
+                sql_query = _substitute_step_results(sql_query, results_by_step)
+                step_result["query"] = sql_query
+                async with semaphore:
+                    start_time = datetime.now()
+                    result = await execute_read_query(sql_query)
+                    execution_time = (datetime.now() - start_time).total_seconds()
+                if len(result) == 1 and list(result[0].keys()) == ["error"]:
+                    logger.error(f"Error executing query in step {step_num}: {result[0]['error']}")
+                    step_result["error"] = result[0]["error"]
+                else:
+                    result = await enrich_query_results(result)
+                    step_result["data"] = result
+                    step_result["execution_time"] = f"{execution_time:.2f} seconds"
+                    step_result["row_count"] = len(result)
+            except Exception as e:
+                logger.error(f"Error executing step {step_num}: {str(e)}", exc_info=True)
+                step_result["error"] = str(e)
+        results_by_step[step_num] = step_result
+        if on_progress:
+            try:
+                await on_progress(step_result)
+            except Exception as e:
+                logger.error(f"Error reporting progress of step {step_num}: {str(e)}")
+        return step_result
+    
+    for step_num, step in zip(validate_plan_steps(steps), steps):
+        references = {int(number) for number in _STEP_REFERENCE.findall(step.get('sql_query') or '')}
+        declared = {int(number) for number in step.get('depends_on') or [] if str(number).isdigit()}
+        dependencies = sorted(number for number in references | declared if number in tasks)
+        ignored = (references | declared) - set(dependencies)
+        if ignored:
+            logger.warning(f"Step {step_num} depends on unknown or later steps {sorted(ignored)}, ignoring them")
+        dependency_map[step_num] = dependencies
+        tasks[step_num] = asyncio.create_task(run_step(step_num, step, dependencies))
+    
+    independent = sum(1 for step_num in tasks if not dependency_map[step_num])
+    logger.info(f"Executing {len(tasks)} agent steps, {independent} without dependencies, concurrency {AGENT_QUERY_CONCURRENCY}")
+    return list(await asyncio.gather(*tasks.values()))
+
 async def enrich_query_results(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
     Enrich query results by adding human-readable names for IDs
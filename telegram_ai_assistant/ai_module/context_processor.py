@@ -1,16 +1,70 @@
 import sys
 import os
 import json
+import re
 from typing import List, Dict, Any, Optional
 from datetime import datetime
-from openai import AsyncOpenAI
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from config import OPENAI_API_KEY, OPENAI_MODEL
+from config import OPENAI_API_KEY, OPENAI_MODEL, RESULT_RAW_ROWS
 from utils.logging_utils import setup_ai_logger
+from telegram_ai_assistant.utils.stream_utils import stream_chat_completion
+from telegram_ai_assistant.ai_module.llm_gateway import client, chat_completion, bounded
+from telegram_ai_assistant.ai_module.schema_prompt import get_schema_prompt
+from telegram_ai_assistant.ai_module.result_digest import format_result_for_prompt
 
 logger = setup_ai_logger()
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# Временные указания в вопросах и соответствующие периоды
+TIME_INDICATORS = {
+    "сегодня": "today",
+    "вчера": "yesterday",
+    "неделю": "week",
+    "неделя": "week",
+    "этой неделе": "week",
+    "на этой неделе": "week",
+    "за неделю": "week", 
+    "месяц": "month",
+    "за месяц": "month",
+    "в этом месяце": "month",
+    "текущий месяц": "month",
+    "прошлый месяц": "last_month",
+    "прошлом месяце": "last_month",
+    "прошлой неделе": "last_week",
+    "на прошлой неделе": "last_week",
+    "за прошлую неделю": "last_week",
+    "год": "year",
+    "за год": "year",
+    "в этом году": "year",
+    "today": "today",
+    "yesterday": "yesterday",
+    "week": "week",
+    "this week": "week",
+    "last week": "last_week",
+    "month": "month",
+    "this month": "month",
+    "last month": "last_month",
+    "year": "year",
+    "this year": "year"
+}
+
+def detect_time_period(message_text: str) -> Optional[str]:
+    """
+    Находит временной период, указанный в вопросе
+    
+    Более длинные указания проверяются первыми, чтобы "за прошлую неделю" не считалось текущей неделей.
+    
+    Args:
+        message_text: Текст вопроса
+        
+    Returns:
+        Период из TIME_INDICATORS или None
+    """
+    text = message_text.lower()
+    for indicator in sorted(TIME_INDICATORS, key=len, reverse=True):
+        if re.search(rf"(?<!\w){re.escape(indicator)}", text):
+            return TIME_INDICATORS[indicator]
+    return None
 
 async def analyze_message_intent(message_text: str, context_messages: List[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
@@ -142,7 +196,8 @@ async def analyze_message_intent(message_text: str, context_messages: List[Dict[
         if context_text:
             user_content = f"Recent context:\n{context_text}\n\nMessage to analyze: {message_text}"
         
-        response = await client.chat.completions.create(
+        response = await chat_completion(
+            "analyze_message_intent",
             model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -208,32 +263,7 @@ async def get_required_context(message_text: str, available_chats: List[Dict[str
         Словарь с информацией о требуемых данных и дополнительном контексте
     """
     # Проверяем наличие временных указаний в вопросе
-    time_indicators = {
-        "сегодня": "today",
-        "вчера": "yesterday",
-        "неделю": "week",
-        "неделя": "week",
-        "этой неделе": "week",
-        "на этой неделе": "week",
-        "за неделю": "week", 
-        "месяц": "month",
-        "за месяц": "month",
-        "в этом месяце": "month",
-        "текущий месяц": "month",
-        "прошлый месяц": "last_month",
-        "прошлой неделе": "last_week",
-        "на прошлой неделе": "last_week",
-        "за прошлую неделю": "last_week",
-        "год": "year",
-        "за год": "year",
-        "в этом году": "year"
-    }
-    
-    time_period = None
-    for indicator, period in time_indicators.items():
-        if indicator in message_text.lower():
-            time_period = period
-            break
+    time_period = detect_time_period(message_text)
     
     # Форматируем информацию о доступных чатах
     chats_info = []
@@ -261,6 +291,7 @@ async def get_required_context(message_text: str, available_chats: List[Dict[str
             messages_formatted.append(f"[{timestamp_str}] {sender}: {text}")
         
         current_chat_context = "\n".join(messages_formatted)
+    current_chat_section = f"История текущего чата (последние сообщения):\n{current_chat_context}" if current_chat_context else ""
     
     # Добавляем информацию о выявленном временном периоде
     time_period_info = ""
@@ -337,93 +368,18 @@ async def get_required_context(message_text: str, available_chats: List[Dict[str
         }
     ]
     
-    # Описание схемы базы данных для подсказки LLM - ОБНОВЛЕННАЯ И ТОЧНАЯ СХЕМА
-    db_schema = """
-    Точная схема базы данных (используйте именно эти таблицы и поля):
-    
-    1. users
-       - id (INTEGER PRIMARY KEY)
-       - user_id (INTEGER) - Telegram user ID
-       - username (TEXT) - Telegram username
-       - first_name (TEXT) - User's first name
-       - last_name (TEXT) - User's last name
-       - is_bot (BOOLEAN) - Whether user is a bot
-       - created_at (TIMESTAMP) - When user was added to DB
-    
-    2. messages
-       - id (INTEGER PRIMARY KEY)
-       - message_id (INTEGER) - Telegram message ID
-       - chat_id (INTEGER) - ID of the chat where message was sent
-       - sender_id (INTEGER) - User ID who sent the message
-       - text (TEXT) - Message content
-       - attachments (TEXT) - JSON string with attachments
-       - timestamp (TIMESTAMP) - When message was sent
-       - is_important (BOOLEAN) - Important flag
-       - is_processed (BOOLEAN) - Processed flag
-       - category (TEXT) - Message category
-       - is_bot (BOOLEAN) - Whether sent by bot
-    
-    3. chats
-       - id (INTEGER PRIMARY KEY)
-       - chat_id (INTEGER) - Telegram chat ID
-       - chat_name (TEXT) - Chat name
-       - is_active (BOOLEAN) - Active status
-       - last_summary_time (TIMESTAMP) - Last summary generation time
-       - linear_team_id (TEXT) - Associated Linear team ID
-    
-    4. tasks
-       - id (INTEGER PRIMARY KEY)
-       - linear_id (TEXT) - Linear task ID
-       - title (TEXT) - Task title
-       - description (TEXT) - Task description
-       - status (TEXT) - Task status
-       - created_at (TIMESTAMP) - Creation time
-       - due_date (TIMESTAMP) - Due date
-       - assignee_id (INTEGER) - Assigned user ID
-       - message_id (INTEGER) - Origin message ID
-       - chat_id (INTEGER) - Origin chat ID
-    
-    5. unanswered_questions
-       - id (INTEGER PRIMARY KEY)
-       - message_id (INTEGER) - Question message ID
-       - chat_id (INTEGER) - Chat where question was asked
-       - target_user_id (INTEGER) - User who should answer
-       - sender_id (INTEGER) - User who asked
-       - question (TEXT) - Question text
-       - asked_at (TIMESTAMP) - When asked
-       - is_answered (BOOLEAN) - Answered status
-       - answered_at (TIMESTAMP) - When answered
-       - reminder_count (INTEGER) - Reminder count
-       - last_reminder_at (TIMESTAMP) - Last reminder time
-       - is_bot (BOOLEAN) - Whether from bot
-    
-    6. team_productivity
-       - id (INTEGER PRIMARY KEY)
-       - user_id (INTEGER) - User ID
-       - date (TIMESTAMP) - Record date
-       - message_count (INTEGER) - Message count
-       - tasks_created (INTEGER) - Tasks created
-       - tasks_completed (INTEGER) - Tasks completed
-       - avg_response_time (INTEGER) - Average response time
-       
-    Примечания:
-    - Таблицы 'chat_history' НЕ существует
-    - Все запросы к чатам должны идти через таблицу messages, используя поле chat_id
-    - Для связи пользователей используйте соединение messages.sender_id = users.user_id
-    - Для статистики общения рекомендуется использовать таблицу team_productivity
-    - Для фильтрации по дате используйте messages.timestamp или team_productivity.date
-    """
-    
     try:
         logger.info(f"Определение необходимого контекста для сообщения: {message_text[:50]}...")
-        response = await client.chat.completions.create(
+        # The schema goes first so that every SQL-generating prompt shares the same cacheable prefix
+        response = await chat_completion(
+            "get_required_context",
             model=OPENAI_MODEL,
             messages=[
-                {"role": "system", "content": f"""Ты опытный аналитик, который помогает пользователям получать информацию о коммуникациях и задачах команды.
+                {"role": "system", "content": get_schema_prompt() + """
 
-Твоя основная задача - определить, какую информацию запросить для полного ответа на вопрос пользователя.
+Ты опытный аналитик, который помогает пользователям получать информацию о коммуникациях и задачах команды.
 
-{db_schema}
+Твоя основная задача - определить, какую информацию запросить для полного ответа на вопрос пользователя.
 
 Помни, что вопросы о статистике, количестве сообщений, активности пользователей или задачах почти всегда требуют запроса к базе данных. Предпочитай получать актуальные и точные данные из базы, а не из ограниченного контекста сообщений.
 
@@ -455,7 +411,7 @@ async def get_required_context(message_text: str, available_chats: List[Dict[str
                 Доступные чаты:
                 {chats_context}
                 
-                {f"История текущего чата (последние сообщения):\n{current_chat_context}" if current_chat_context else ""}
+                {current_chat_section}
                 {time_period_info}
                 """}
             ],
@@ -518,7 +474,7 @@ async def get_required_context(message_text: str, available_chats: List[Dict[str
             "message": "Произошла ошибка при определении необходимых данных."
         }
 
-async def process_question_with_context(question, chat_id, available_chats=None):
+async def process_question_with_context(question, chat_id, available_chats=None, stream_writer=None):
     """
     Process a question with appropriate context from chat history or database
     
@@ -526,6 +482,7 @@ async def process_question_with_context(question, chat_id, available_chats=None)
         question: The question text
         chat_id: Current chat ID
         available_chats: List of available chats (optional)
+        stream_writer: TelegramStreamWriter to stream the answer into (optional)
         
     Returns:
         Answer text based on the available context
@@ -564,83 +521,6 @@ async def process_question_with_context(question, chat_id, available_chats=None)
                 logger.error(f"Error retrieving available chats: {str(e)}")
                 available_chats = []
         
-        # Database schema to ensure accurate SQL queries
-        db_schema = """
-        Точная схема базы данных (используйте именно эти таблицы и поля):
-        
-        1. users
-           - id (INTEGER PRIMARY KEY)
-           - user_id (INTEGER) - Telegram user ID
-           - username (TEXT) - Telegram username
-           - first_name (TEXT) - User's first name
-           - last_name (TEXT) - User's last name
-           - is_bot (BOOLEAN) - Whether user is a bot
-           - created_at (TIMESTAMP) - When user was added to DB
-        
-        2. messages
-           - id (INTEGER PRIMARY KEY)
-           - message_id (INTEGER) - Telegram message ID
-           - chat_id (INTEGER) - ID of the chat where message was sent
-           - sender_id (INTEGER) - User ID who sent the message
-           - text (TEXT) - Message content
-           - attachments (TEXT) - JSON string with attachments
-           - timestamp (TIMESTAMP) - When message was sent
-           - is_important (BOOLEAN) - Important flag
-           - is_processed (BOOLEAN) - Processed flag
-           - category (TEXT) - Message category
-           - is_bot (BOOLEAN) - Whether sent by bot
-        
-        3. chats
-           - id (INTEGER PRIMARY KEY)
-           - chat_id (INTEGER) - Telegram chat ID
-           - chat_name (TEXT) - Chat name
-           - is_active (BOOLEAN) - Active status
-           - last_summary_time (TIMESTAMP) - Last summary generation time
-           - linear_team_id (TEXT) - Associated Linear team ID
-        
-        4. tasks
-           - id (INTEGER PRIMARY KEY)
-           - linear_id (TEXT) - Linear task ID
-           - title (TEXT) - Task title
-           - description (TEXT) - Task description
-           - status (TEXT) - Task status
-           - created_at (TIMESTAMP) - Creation time
-           - due_date (TIMESTAMP) - Due date
-           - assignee_id (INTEGER) - Assigned user ID
-           - message_id (INTEGER) - Origin message ID
-           - chat_id (INTEGER) - Origin chat ID
-        
-        5. unanswered_questions
-           - id (INTEGER PRIMARY KEY)
-           - message_id (INTEGER) - Question message ID
-           - chat_id (INTEGER) - Chat where question was asked
-           - target_user_id (INTEGER) - User who should answer
-           - sender_id (INTEGER) - User who asked
-           - question (TEXT) - Question text
-           - asked_at (TIMESTAMP) - When asked
-           - is_answered (BOOLEAN) - Answered status
-           - answered_at (TIMESTAMP) - When answered
-           - reminder_count (INTEGER) - Reminder count
-           - last_reminder_at (TIMESTAMP) - Last reminder time
-           - is_bot (BOOLEAN) - Whether from bot
-        
-        6. team_productivity
-           - id (INTEGER PRIMARY KEY)
-           - user_id (INTEGER) - User ID
-           - date (TIMESTAMP) - Record date
-           - message_count (INTEGER) - Message count
-           - tasks_created (INTEGER) - Tasks created
-           - tasks_completed (INTEGER) - Tasks completed
-           - avg_response_time (INTEGER) - Average response time
-           
-        Примечания:
-        - Таблицы 'chat_history' НЕ существует
-        - Все запросы к чатам должны идти через таблицу messages, используя поле chat_id
-        - Для связи пользователей используйте соединение messages.sender_id = users.user_id
-        - Для статистики общения рекомендуется использовать таблицу team_productivity
-        - Для фильтрации по дате используйте messages.timestamp или team_productivity.date
-        """
-        
         # Determine what context is needed to answer the question
         context_analysis_result = await get_required_context(
             message_text=question,
@@ -865,7 +745,10 @@ async def process_question_with_context(question, chat_id, available_chats=None)
                         sql_results_text = f"⚠️ Ошибка выполнения SQL запроса: {sql_results[0]['error']}"
                     else:
                         # Format as table if multiple rows
-                        if len(sql_results) > 1:
+                        if len(sql_results) > RESULT_RAW_ROWS:
+                            # Large results are described by statistics over all rows plus a sample
+                            sql_results_text = "Результаты SQL запроса:\n\n" + format_result_for_prompt(sql_results)
+                        elif len(sql_results) > 1:
                             # Get column names from first row
                             columns = list(sql_results[0].keys())
                             
@@ -876,15 +759,9 @@ async def process_question_with_context(question, chat_id, available_chats=None)
                             sql_results_text += " | ".join(columns) + "\n"
                             sql_results_text += "-" * (len(" | ".join(columns))) + "\n"
                             
-                            # Add rows (limit to 10 rows to avoid too long context)
-                            max_rows = min(10, len(sql_results))
-                            for i in range(max_rows):
-                                row = sql_results[i]
+                            for row in sql_results:
                                 row_values = [str(row.get(col, "")) for col in columns]
                                 sql_results_text += " | ".join(row_values) + "\n"
-                                
-                            if len(sql_results) > 10:
-                                sql_results_text += f"\n... и еще {len(sql_results) - 10} строк (всего {len(sql_results)})"
                         else:
                             # Format as key-value pairs for single row
                             sql_results_text = "Результаты SQL запроса:\n\n"
@@ -898,15 +775,24 @@ async def process_question_with_context(question, chat_id, available_chats=None)
                     answer_context += f"\n\nИспользованный SQL запрос:\n{context_analysis_result.get('sql_query', '')}"
         
         # Generate the answer
-        answer_response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": answer_system_prompt},
-                {"role": "user", "content": f"{answer_context}\n\nВопрос пользователя: {question}\n\nДай развернутый и полезный ответ."}
-            ]
-        )
-        
-        answer = answer_response.choices[0].message.content.strip()
+        answer_messages = [
+            {"role": "system", "content": answer_system_prompt},
+            {"role": "user", "content": f"{answer_context}\n\nВопрос пользователя: {question}\n\nДай развернутый и полезный ответ."}
+        ]
+        if stream_writer:
+            # Stream tokens into the bot message so the first words show up immediately
+            answer = await bounded(
+                stream_chat_completion(client, stream_writer, "process_question_with_context.answer", model=OPENAI_MODEL, messages=answer_messages),
+                "process_question_with_context.answer"
+            )
+            answer = answer.strip()
+        else:
+            answer_response = await chat_completion(
+                "process_question_with_context.answer",
+                model=OPENAI_MODEL,
+                messages=answer_messages
+            )
+            answer = answer_response.choices[0].message.content.strip()
         
         # Add context details for debugging if needed
         processing_result = {
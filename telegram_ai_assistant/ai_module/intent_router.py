@@ -0,0 +1,373 @@
+import re
+from datetime import datetime, timedelta
+from html import escape
+from typing import Dict, Any, List, Optional, Tuple
+from telegram_ai_assistant.ai_module.context_processor import detect_time_period, TIME_INDICATORS
+from telegram_ai_assistant.utils.db_utils import execute_sql_query, get_active_chats
+from telegram_ai_assistant.utils.logging_utils import setup_ai_logger
+logger = setup_ai_logger()
+INTENT_PATTERNS = {
+    "top_senders": [
+        r"кто\s+(?:больше|чаще)\s+(?:всех|всего)",
+        r"(?:самы[ей]|наиболее)\s+активн",
+        r"топ[-\s]?\d*\s*(?:отправител|участник|автор|активн)",
+        r"\btop[-\s]?\d*\s*(?:senders|posters|authors|users|members)",
+        r"who\s+(?:sent|wrote|posted)\s+(?:the\s+)?most",
+        r"most\s+active\s+(?:users|members|people|senders)"
+    ],
+    "unanswered_questions": [
+        r"неотвеч",
+        r"вопрос\w*\s+без\s+ответа",
+        r"не\s+ответил\w*\s+на\s+вопрос",
+        r"unanswered\s+questions?",
+        r"questions?\s+without\s+(?:an\s+)?answers?"
+    ],
+    "tasks_due": [
+        r"(?:задач\w*|таск\w*)\s+(?:со\s+сроком|с\s+дедлайном|к\s+сроку|на\s+сегодня|на\s+неделю)",
+        r"дедлайн",
+        r"срок\w*\s+(?:задач|сдачи)",
+        r"просроч",
+        r"\btasks?\s+due\b",
+        r"\bdue\s+tasks?\b",
+        r"\bdeadlines?\b",
+        r"\boverdue\b"
+    ],
+    "chat_messages": [
+        r"сообщени\w*\s+(?:было\s+)?в\s+чате",
+        r"что\s+(?:писали|обсуждали)\s+в\s+чате",
+        r"\bmessages?\s+(?:were\s+)?(?:in|to)\s+(?:the\s+)?(?:chat\s+)?",
+    ]
+}
+_COMPILED_PATTERNS = {intent: [re.compile(p, re.IGNORECASE) for p in patterns] for intent, patterns in INTENT_PATTERNS.items()}
+# Words a question may contain besides the intent phrase, chat name, period and top N. Anything else
+# ("про релиз", "for the API migration") is a qualifier the canned query would ignore, so the LLM answers.
+_FILLER_WORDS = frozenset("""
+кто что какие какой какая каких покажи показать список скажи мне нам пожалуйста а и был была были было
+есть за в на с у нас все всех всего сейчас чат чате чатах
+who what which show me list tell give please the a an are is were was there any all in on for during of
+our we us have has s chat chats
+""".split())
+_INTENT_WORDS = {
+    "top_senders": frozenset("""
+    больше чаще всех всего самые самый самых активные активный активных наиболее участники участников
+    пользователи пользователей отправители отправителей авторы авторов писал писала писали пишет пишут
+    написал написала написали отправил отправила отправили сообщений сообщения топ люди людей
+    sent wrote posted most active users members people senders posters authors top messages
+    """.split()),
+    "unanswered_questions": frozenset("""
+    неотвеченные неотвеченных неотвеченный вопросы вопросов вопрос без ответа не ответили ответил ответила
+    остались осталось
+    unanswered question questions without answer answers open still left remaining
+    """.split()),
+    "tasks_due": frozenset("""
+    задачи задач таски тасков со сроком с дедлайном дедлайны дедлайнов дедлайн к сроку сроки срок сдачи
+    просроченные просроченных просрочены горят
+    tasks task due deadline deadlines overdue upcoming coming up next
+    """.split()),
+    "chat_messages": frozenset("""
+    сколько сообщений сообщения было писали обсуждали чате
+    how many messages message were sent to chat
+    """.split())
+}
+# Intent patterns extended to whole words, so "самые активные" leaves no word stubs behind
+_REMOVABLE_PATTERNS = {intent: [re.compile(p + r"\w*", re.IGNORECASE) for p in patterns] for intent, patterns in INTENT_PATTERNS.items()}
+_THIS_WEEK = re.compile(r"(?:на\s+)?(?:этой|текущей)\s+неделе|(?:за\s+)?(?:эту|текущую)\s+неделю|\b(?:this|current)\s+week\b", re.IGNORECASE)
+_PERIOD_WORDS = re.compile(
+    "|".join(rf"(?<!\w){re.escape(indicator)}\w*" for indicator in sorted(TIME_INDICATORS, key=len, reverse=True)),
+    re.IGNORECASE
+)
+_CHAT_NAME_PATTERNS = [
+    re.compile(r"\bв\s+чате\s+(?P<name>.+?)(?=\s+(?:за|сегодня|вчера|на|в|с|кто|было)\b|[?.!,]|$)", re.IGNORECASE),
+    re.compile(r"\bin\s+(?:the\s+)?chat\s+(?P<name>.+?)(?=\s+(?:today|yesterday|this|last|during|for|in|over)\b|[?.!,]|$)", re.IGNORECASE),
+    re.compile(r"\bin\s+(?:the\s+)?(?P<name>.+?)\s+chat\b", re.IGNORECASE)
+]
+_QUOTED_NAME = re.compile(r'"([^"]+)"|«([^»]+)»|“([^”]+)”')
+_LIMIT = re.compile(r"(?:топ|top)[-\s]?(\d+)", re.IGNORECASE)
+_SENDER_NAME_SQL = "COALESCE(NULLIF(TRIM(COALESCE({u}.first_name, '') || ' ' || COALESCE({u}.last_name, '')), ''), {u}.username, 'User ' || {id})"
+TOP_SENDERS_SQL = f"""
+SELECT {_SENDER_NAME_SQL.format(u="u", id="m.sender_id")} AS name, COUNT(*) AS message_count
+FROM messages m
+LEFT JOIN users u ON u.user_id = m.sender_id
+WHERE m.timestamp >= :start AND m.timestamp < :end
+AND COALESCE(m.is_bot, FALSE) = FALSE
+AND m.deleted_at IS NULL
+{{chat_filter}}
+GROUP BY m.sender_id
+ORDER BY message_count DESC
+LIMIT :limit
+"""
+UNANSWERED_QUESTIONS_SQL = f"""
+SELECT q.question, q.asked_at, c.chat_name,
+       {_SENDER_NAME_SQL.format(u="t", id="q.target_user_id")} AS target_name,
+       {_SENDER_NAME_SQL.format(u="s", id="q.sender_id")} AS sender_name
+FROM unanswered_questions q
+LEFT JOIN users t ON t.user_id = q.target_user_id
+LEFT JOIN users s ON s.user_id = q.sender_id
+LEFT JOIN chats c ON c.chat_id = q.chat_id
+WHERE q.is_answered = FALSE
+AND q.asked_at >= :start AND q.asked_at < :end
+{{chat_filter}}
+ORDER BY q.asked_at DESC
+LIMIT :limit
+"""
+TASKS_DUE_SQL = f"""
+SELECT t.title, t.status, t.due_date, t.linear_id,
+       {_SENDER_NAME_SQL.format(u="u", id="t.assignee_id")} AS assignee_name
+FROM tasks t
+LEFT JOIN users u ON u.user_id = t.assignee_id
+WHERE t.due_date IS NOT NULL
+AND t.due_date >= :start AND t.due_date < :end
+AND COALESCE(t.status, '') NOT IN ('Done', 'Completed', 'Merged', 'Canceled', 'Cancelled')
+{{chat_filter}}
+ORDER BY t.due_date
+LIMIT :limit
+"""
+CHAT_MESSAGES_SQL = f"""
+SELECT {_SENDER_NAME_SQL.format(u="u", id="m.sender_id")} AS name, COUNT(*) AS message_count
+FROM messages m
+LEFT JOIN users u ON u.user_id = m.sender_id
+WHERE m.chat_id = :chat_id
+AND m.timestamp >= :start AND m.timestamp < :end
+AND m.deleted_at IS NULL
+GROUP BY m.sender_id
+ORDER BY message_count DESC
+"""
+PERIOD_LABELS = {
+    "today": ("сегодня", "today"),
+    "yesterday": ("вчера", "yesterday"),
+    "week": ("за последние 7 дней", "in the last 7 days"),
+    "this_week": ("на этой неделе", "this week"),
+    "last_week": ("на прошлой неделе", "last week"),
+    "month": ("в этом месяце", "this month"),
+    "last_month": ("в прошлом месяце", "last month"),
+    "year": ("в этом году", "this year"),
+    "all": ("за всё время", "overall")
+}
+DUE_PERIOD_LABELS = {
+    "today": ("со сроком сегодня", "due today"),
+    "week": ("со сроком в ближайшие 7 дней", "due in the next 7 days"),
+    "this_week": ("со сроком до конца недели", "due by the end of the week"),
+    "month": ("со сроком до конца месяца", "due by the end of the month"),
+    "overdue": ("с истёкшим сроком", "overdue")
+}
+_stats = {"routed": 0, "fallbacks": 0}
+def period_range(period: str, now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """
+    Convert a period from TIME_INDICATORS into a UTC [start, end) range
+    Args:
+        period: today, yesterday, week (last 7 days), this_week (since Monday), last_week, month,
+            last_month, year or all
+        now: Current UTC time (defaults to utcnow)
+    Returns:
+        Tuple of (start, end)
+    """
+    now = now or datetime.utcnow()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    tomorrow = today + timedelta(days=1)
+    if period == "today":
+        return today, tomorrow
+    if period == "yesterday":
+        return today - timedelta(days=1), today
+    if period == "week":
+        return today - timedelta(days=6), tomorrow
+    if period == "this_week":
+        return today - timedelta(days=today.weekday()), tomorrow
+    if period == "last_week":
+        this_monday = today - timedelta(days=today.weekday())
+        return this_monday - timedelta(days=7), this_monday
+    if period == "month":
+        return today.replace(day=1), tomorrow
+    if period == "last_month":
+        this_month = today.replace(day=1)
+        return (this_month - timedelta(days=1)).replace(day=1), this_month
+    if period == "year":
+        return today.replace(month=1, day=1), tomorrow
+    return datetime(1970, 1, 1), now + timedelta(days=1)
+def due_range(period: str, now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """Forward-looking range for task due dates"""
+    now = now or datetime.utcnow()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "overdue":
+        return datetime(1970, 1, 1), now
+    if period == "today":
+        return today, today + timedelta(days=1)
+    if period == "this_week":
+        return today, today + timedelta(days=7 - today.weekday())
+    if period == "month":
+        next_month = (today.replace(day=28) + timedelta(days=4)).replace(day=1)
+        return today, next_month
+    return today, today + timedelta(days=7)
+def detect_intent(question: str) -> Optional[str]:
+    """Return the first intent whose patterns match the question, or None"""
+    for intent, patterns in _COMPILED_PATTERNS.items():
+        if any(pattern.search(question) for pattern in patterns):
+            return intent
+    return None
+def detect_period(question: str) -> Optional[str]:
+    """Period of the question; unlike detect_time_period, "this week" means the calendar week"""
+    if _THIS_WEEK.search(question):
+        return "this_week"
+    return detect_time_period(question)
+def unexplained_words(question: str, intent: str) -> List[str]:
+    """
+    Words of a question that neither the intent nor its parameters account for
+    Args:
+        question: Question text
+        intent: Intent detected for the question
+    Returns:
+        Leftover words; a question with any of them asks for more than the canned query answers
+    """
+    text = question
+    chat_name = _extract_chat_name(question)
+    if chat_name:
+        text = re.sub(re.escape(chat_name), " ", text, flags=re.IGNORECASE)
+    for pattern in _REMOVABLE_PATTERNS[intent] + [_THIS_WEEK, _PERIOD_WORDS, _LIMIT]:
+        text = pattern.sub(" ", text)
+    allowed = _FILLER_WORDS | _INTENT_WORDS[intent]
+    return [word for word in re.findall(r"\w+", text.lower()) if word not in allowed]
+def _is_russian(question: str) -> bool:
+    return bool(re.search(r"[а-яё]", question, re.IGNORECASE))
+def _extract_chat_name(question: str) -> Optional[str]:
+    quoted = _QUOTED_NAME.search(question)
+    if quoted:
+        return next(group for group in quoted.groups() if group).strip()
+    for pattern in _CHAT_NAME_PATTERNS:
+        match = pattern.search(question)
+        if match:
+            return match.group("name").strip(" \"'«»")
+    return None
+async def _find_chat(name: str) -> Optional[Dict[str, Any]]:
+    """Find an active chat by exact or partial name, case-insensitively"""
+    name = name.lower()
+    chats = await get_active_chats()
+    for chat in chats:
+        if chat["chat_name"].lower() == name:
+            return chat
+    matches = [chat for chat in chats if name in chat["chat_name"].lower()]
+    return matches[0] if len(matches) == 1 else None
+def _format_date(value) -> str:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.strftime("%Y-%m-%d %H:%M") if value else ""
+def _with_chat_filter(sql: str, column: str, chat: Optional[Dict[str, Any]]) -> Tuple[str, Dict[str, Any]]:
+    """Restrict a query to one chat only when a chat was named; an untyped NULL parameter breaks PostgreSQL"""
+    if chat is None:
+        return sql.format(chat_filter=""), {}
+    return sql.format(chat_filter=f"AND {column} = :chat_id"), {"chat_id": chat["chat_id"]}
+async def _run(sql: str, params: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    rows = await execute_sql_query(sql, params)
+    if rows and "error" in rows[0]:
+        logger.error(f"Fast-path query failed: {rows[0]['error']}")
+        return None
+    return rows
+async def _answer_top_senders(question: str, ru: bool, chat: Optional[Dict[str, Any]]) -> Optional[str]:
+    period = detect_period(question) or "week"
+    start, end = period_range(period)
+    limit_match = _LIMIT.search(question)
+    limit = min(int(limit_match.group(1)), 50) if limit_match else 5
+    sql, params = _with_chat_filter(TOP_SENDERS_SQL, "m.chat_id", chat)
+    rows = await _run(sql, dict(params, start=start, end=end, limit=limit))
+    if rows is None:
+        return None
+    label = PERIOD_LABELS[period][0 if ru else 1]
+    where = f" в чате {escape(chat['chat_name'])}" if chat and ru else (f" in {escape(chat['chat_name'])}" if chat else "")
+    if not rows:
+        return f"Сообщений{where} {label} не найдено." if ru else f"No messages{where} {label}."
+    title = f"<b>Самые активные участники{where} {label}:</b>" if ru else f"<b>Most active senders{where} {label}:</b>"
+    lines = [f"{i}. {escape(row['name'])} — {row['message_count']}" for i, row in enumerate(rows, 1)]
+    return "\n".join([title] + lines)
+async def _answer_unanswered_questions(question: str, ru: bool, chat: Optional[Dict[str, Any]]) -> Optional[str]:
+    period = detect_period(question) or "all"
+    start, end = period_range(period)
+    sql, params = _with_chat_filter(UNANSWERED_QUESTIONS_SQL, "q.chat_id", chat)
+    rows = await _run(sql, dict(params, start=start, end=end, limit=20))
+    if rows is None:
+        return None
+    label = PERIOD_LABELS[period][0 if ru else 1]
+    if not rows:
+        return f"Неотвеченных вопросов {label} нет." if ru else f"No unanswered questions {label}."
+    title = f"<b>Неотвеченные вопросы {label} ({len(rows)}):</b>" if ru else f"<b>Unanswered questions {label} ({len(rows)}):</b>"
+    lines = []
+    for row in rows:
+        who = f"{escape(row['sender_name'])} → {escape(row['target_name'])}"
+        lines.append(f"• [{_format_date(row['asked_at'])}, {escape(row['chat_name'] or '')}] {who}: {escape((row['question'] or '')[:200])}")
+    return "\n".join([title] + lines)
+async def _answer_tasks_due(question: str, ru: bool, chat: Optional[Dict[str, Any]]) -> Optional[str]:
+    if re.search(r"просроч|overdue", question, re.IGNORECASE):
+        period = "overdue"
+    else:
+        period = {"today": "today", "this_week": "this_week", "month": "month"}.get(detect_period(question), "week")
+    start, end = due_range(period)
+    sql, params = _with_chat_filter(TASKS_DUE_SQL, "t.chat_id", chat)
+    rows = await _run(sql, dict(params, start=start, end=end, limit=30))
+    if rows is None:
+        return None
+    label = DUE_PERIOD_LABELS[period][0 if ru else 1]
+    where = f" в чате {escape(chat['chat_name'])}" if chat and ru else (f" in {escape(chat['chat_name'])}" if chat else "")
+    if not rows:
+        return f"Задач{where} {label} нет." if ru else f"No tasks{where} {label}."
+    title = f"<b>Задачи{where} {label} ({len(rows)}):</b>" if ru else f"<b>Tasks{where} {label} ({len(rows)}):</b>"
+    lines = [
+        f"• {escape(row['title'] or '')} — {escape(row['status'] or '')}, {_format_date(row['due_date'])[:10]}, {escape(row['assignee_name'])}"
+        for row in rows
+    ]
+    return "\n".join([title] + lines)
+async def _answer_chat_messages(question: str, ru: bool, chat: Optional[Dict[str, Any]]) -> Optional[str]:
+    if not chat:
+        return None
+    period = detect_period(question) or "today"
+    start, end = period_range(period)
+    rows = await _run(CHAT_MESSAGES_SQL, {"chat_id": chat["chat_id"], "start": start, "end": end})
+    if rows is None:
+        return None
+    label = PERIOD_LABELS[period][0 if ru else 1]
+    name = escape(chat["chat_name"])
+    total = sum(row["message_count"] for row in rows)
+    if not total:
+        return f"В чате {name} {label} сообщений не было." if ru else f"No messages in {name} {label}."
+    top = ", ".join(f"{escape(row['name'])} ({row['message_count']})" for row in rows[:5])
+    if ru:
+        return f"В чате <b>{name}</b> {label}: {total} сообщений от {len(rows)} участников.\nСамые активные: {top}"
+    return f"<b>{name}</b> {label}: {total} messages from {len(rows)} senders.\nMost active: {top}"
+_HANDLERS = {
+    "top_senders": _answer_top_senders,
+    "unanswered_questions": _answer_unanswered_questions,
+    "tasks_due": _answer_tasks_due,
+    "chat_messages": _answer_chat_messages
+}
+async def route_question(question: str) -> Optional[Dict[str, Any]]:
+    """
+    Answer common analytics questions with precompiled queries and templated answers.
+    Args:
+        question: Question text in Russian or English
+    Returns:
+        Dict with intent and answer (HTML), or None when the question should go to the LLM
+    """
+    intent = detect_intent(question)
+    if intent is None:
+        return None
+    extra = unexplained_words(question, intent)
+    if extra:
+        logger.info(f"Fast path: question qualifies intent {intent} with {extra[:5]}, falling back to LLM")
+        _stats["fallbacks"] += 1
+        return None
+    try:
+        chat = None
+        chat_name = _extract_chat_name(question)
+        if chat_name:
+            chat = await _find_chat(chat_name)
+            if chat is None:
+                # A chat we cannot resolve would silently widen the query to all chats
+                logger.info(f"Fast path: chat '{chat_name}' not found, falling back to LLM")
+                _stats["fallbacks"] += 1
+                return None
+        answer = await _HANDLERS[intent](question, _is_russian(question), chat)
+    except Exception as e:
+        logger.error(f"Error in fast-path router for intent {intent}: {str(e)}", exc_info=True)
+        answer = None
+    if answer is None:
+        _stats["fallbacks"] += 1
+        return None
+    _stats["routed"] += 1
+    logger.info(f"Fast path answered intent {intent} without LLM ({_stats['routed']} routed, {_stats['fallbacks']} fallbacks)")
+    return {"intent": intent, "answer": answer}
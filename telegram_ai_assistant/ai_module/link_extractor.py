@@ -0,0 +1,194 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import httpx
+from bs4 import BeautifulSoup
+from telegram_ai_assistant.config import (
+    LINK_FETCH_CONCURRENCY,
+    LINK_FETCH_TIMEOUT,
+    LINK_MAX_BYTES,
+    LINK_MAX_PER_MESSAGE,
+    LINK_CACHE_SIZE,
+    LINK_CACHE_TTL,
+    LINK_CONTEXT_TOKENS
+)
+from telegram_ai_assistant.utils.logging_utils import setup_ai_logger
+logger = setup_ai_logger()
+# Rough characters-per-token ratio used to turn token budgets into text lengths
+CHARS_PER_TOKEN = 4
+_URL = re.compile(r"https?://[^\s<>\"'`]+", re.IGNORECASE)
+_TRAILING_PUNCTUATION = ".,;:!?)]}»"
+_WHITESPACE = re.compile(r"\s+")
+_NON_CONTENT_TAGS = ("script", "style", "noscript", "template", "svg", "nav", "header", "footer", "aside", "form")
+_TEXT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+_client: Optional[httpx.AsyncClient] = None
+_fetch_semaphore = asyncio.Semaphore(LINK_FETCH_CONCURRENCY)
+# Extracted pages by URL, least recently used first
+_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+# Fetches in flight, so concurrent messages with the same link share one request
+_in_flight: Dict[str, asyncio.Task] = {}
+_stats = {"fetches": 0, "cache_hits": 0, "revalidated": 0, "errors": 0}
+def extract_urls(text: Optional[str], limit: int = LINK_MAX_PER_MESSAGE) -> List[str]:
+    """
+    Find the distinct http(s) links of a message in order of appearance
+    Args:
+        text: Message text
+        limit: Maximum number of links returned
+    Returns:
+        List of URLs
+    """
+    urls: List[str] = []
+    for match in _URL.finditer(text or ""):
+        url = match.group(0).rstrip(_TRAILING_PUNCTUATION)
+        if url not in urls:
+            urls.append(url)
+        if len(urls) >= limit:
+            break
+    return urls
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=httpx.Timeout(LINK_FETCH_TIMEOUT),
+            limits=httpx.Limits(max_connections=LINK_FETCH_CONCURRENCY * 2, max_keepalive_connections=LINK_FETCH_CONCURRENCY),
+            headers={"User-Agent": "Mozilla/5.0 (compatible; TelegramAIAssistant/1.0)"}
+        )
+    return _client
+async def close_link_client():
+    """Close the pooled HTTP client on shutdown"""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+def _parse_page(body: bytes, encoding: Optional[str], content_type: str) -> Dict[str, str]:
+    """Extract the title and readable text of a page; runs in a worker thread"""
+    if content_type.startswith("text/plain"):
+        text = body.decode(encoding or "utf-8", errors="replace")
+        return {"title": "", "text": _WHITESPACE.sub(" ", text).strip()}
+    soup = BeautifulSoup(body, "html.parser", from_encoding=encoding)
+    title = soup.title.get_text(" ", strip=True) if soup.title else ""
+    for tag in soup(_NON_CONTENT_TAGS):
+        tag.decompose()
+    root = soup.find("article") or soup.find("main") or soup.body or soup
+    return {"title": title, "text": _WHITESPACE.sub(" ", root.get_text(" ", strip=True)).strip()}
+async def _read_capped(response: httpx.Response) -> bytes:
+    """Read at most LINK_MAX_BYTES of a streamed response body"""
+    chunks = []
+    size = 0
+    async for chunk in response.aiter_bytes():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= LINK_MAX_BYTES:
+            logger.debug(f"Truncated {response.url} at {LINK_MAX_BYTES} bytes")
+            break
+    return b"".join(chunks)[:LINK_MAX_BYTES]
+def _remember(url: str, entry: Dict[str, Any]):
+    _cache[url] = entry
+    _cache.move_to_end(url)
+    while len(_cache) > LINK_CACHE_SIZE:
+        _cache.popitem(last=False)
+async def _fetch(url: str, cached: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    async with _fetch_semaphore:
+        async with _get_client().stream("GET", url, headers=headers) as response:
+            if response.status_code == 304 and cached:
+                _stats["revalidated"] += 1
+                logger.debug(f"Link {url} not modified, keeping cached content")
+                return dict(cached, fetched_at=time.time())
+            if response.status_code != 200:
+                raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request, response=response)
+            content_type = response.headers.get("content-type", "").lower()
+            if not content_type.startswith(_TEXT_TYPES):
+                # Images, PDFs and other binaries are described by their type only
+                body, page = None, {"title": "", "text": ""}
+            else:
+                body = await _read_capped(response)
+            etag = response.headers.get("etag")
+            last_modified = response.headers.get("last-modified")
+            encoding = response.charset_encoding
+            final_url = str(response.url)
+    _stats["fetches"] += 1
+    if body is not None:
+        page = await asyncio.to_thread(_parse_page, body, encoding, content_type)
+    return {
+        "url": url,
+        "final_url": final_url,
+        "content_type": content_type.split(";")[0],
+        "title": page["title"],
+        "text": page["text"],
+        "etag": etag,
+        "last_modified": last_modified,
+        "fetched_at": time.time()
+    }
+async def fetch_link(url: str) -> Optional[Dict[str, Any]]:
+    """
+    Fetch and extract a linked page, using the cache while it is fresh and revalidating it afterwards
+    Args:
+        url: Link to fetch
+    Returns:
+        Dict with url, final_url, content_type, title and text, or None if the page could not be fetched
+    """
+    cached = _cache.get(url)
+    if cached and time.time() - cached["fetched_at"] < LINK_CACHE_TTL:
+        _cache.move_to_end(url)
+        _stats["cache_hits"] += 1
+        return cached
+    task = _in_flight.get(url)
+    if task is None:
+        task = asyncio.create_task(_fetch(url, cached))
+        _in_flight[url] = task
+        task.add_done_callback(lambda _: _in_flight.pop(url, None))
+    try:
+        entry = await asyncio.shield(task)
+    except Exception as e:
+        _stats["errors"] += 1
+        logger.warning(f"Error fetching link {url}: {str(e)}")
+        # A stale copy is better than nothing when the site is temporarily unreachable
+        return cached
+    _remember(url, entry)
+    return entry
+def _format_page(page: Dict[str, Any], token_budget: int) -> str:
+    header = f"Link: {page['url']}"
+    if page.get("title"):
+        header += f"\nTitle: {page['title']}"
+    if not page.get("text"):
+        return f"{header}\n[No readable text, content type {page.get('content_type') or 'unknown'}]"
+    max_chars = max(token_budget * CHARS_PER_TOKEN - len(header), 0)
+    text = page["text"]
+    if len(text) > max_chars:
+        text = text[:max_chars].rsplit(" ", 1)[0] + " …"
+    return f"{header}\n{text}"
+async def build_link_context(text: Optional[str], token_budget: int = LINK_CONTEXT_TOKENS) -> str:
+    """
+    Fetch the links of a message concurrently and render their content for the analysis prompt
+    The budget is split evenly between the links that returned readable text, so one long page
+    cannot crowd out the others.
+    Args:
+        text: Message text
+        token_budget: Approximate number of prompt tokens all link content may use
+    Returns:
+        Text block describing the linked pages, or an empty string if there are none
+    """
+    urls = extract_urls(text)
+    if not urls or token_budget <= 0:
+        return ""
+    pages = [page for page in await asyncio.gather(*(fetch_link(url) for url in urls)) if page]
+    if not pages:
+        return ""
+    per_page = token_budget // len(pages)
+    context = "\n\n".join(_format_page(page, per_page) for page in pages)
+    logger.debug(f"Link context for {len(pages)} of {len(urls)} links: ~{estimate_tokens(context)} tokens")
+    return context
+def get_link_stats() -> Dict[str, int]:
+    """Return link fetch and cache counters since startup"""
+    return dict(_stats, cached=len(_cache))
@@ -0,0 +1,286 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, Deque, Optional
+import numpy as np
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from telegram_ai_assistant.config import (
+    OPENAI_API_KEY,
+    LLM_HEDGE_MIN_SAMPLES,
+    LLM_LATENCY_WINDOW,
+    LLM_HEDGE_MAX_RATIO,
+    LLM_BREAKER_FAILURES,
+    LLM_BREAKER_COOLDOWN
+)
+from telegram_ai_assistant.ai_module.usage_tracker import BudgetExceeded, check_budget, record_usage
+from telegram_ai_assistant.utils.logging_utils import setup_ai_logger
+logger = setup_ai_logger()
+client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Cumulative prompt/cached token counts per call site since startup
+_cache_stats: Dict[str, Dict[str, int]] = {}
+# Recent request latencies (seconds) per call site; cancelled attempts count with the time they ran
+_latencies: Dict[str, Deque[float]] = {}
+# Whether each of the recent requests per call site was hedged, to keep hedges a small share of the load
+_hedge_history: Dict[str, Deque[bool]] = {}
+_hedge_stats: Dict[str, Dict[str, int]] = {}
+# Absolute time.monotonic() deadline of the current interactive flow, inherited by tasks it starts
+_deadline: ContextVar[Optional[float]] = ContextVar("llm_deadline", default=None)
+# Errors that mean the provider is unavailable, as opposed to a bad request
+PROVIDER_ERRORS = (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError)
+# Circuit breaker: "closed" sends requests, "open" rejects them until LLM_BREAKER_COOLDOWN has passed,
+# then "half_open" lets a single trial request through to decide whether to close again
+_breaker: Dict[str, Any] = {"state": "closed", "failures": 0, "opened_at": 0.0, "trial_in_flight": False, "rejected": 0}
+class DeadlineExceeded(Exception):
+    """Raised when an LLM request cannot finish before the deadline of the current flow"""
+class LLMUnavailable(Exception):
+    """Raised without contacting the provider while the circuit breaker is open"""
+def is_outage_error(error: BaseException) -> bool:
+    """Whether a request failed because the LLM is unavailable or over budget, so the work should be retried later"""
+    return isinstance(error, (LLMUnavailable, BudgetExceeded) + PROVIDER_ERRORS)
+def llm_available() -> bool:
+    """Whether the circuit breaker currently lets requests through"""
+    if _breaker["state"] == "closed":
+        return True
+    if _breaker["state"] == "open":
+        return time.monotonic() - _breaker["opened_at"] >= LLM_BREAKER_COOLDOWN
+    return not _breaker["trial_in_flight"]
+def get_circuit_state() -> Dict[str, Any]:
+    """Return the circuit breaker state and counters"""
+    return {key: value for key, value in _breaker.items() if key != "trial_in_flight"}
+def _before_request(call_site: str) -> bool:
+    """Reject the request while the breaker is open; returns True if this is the half-open trial"""
+    if not llm_available():
+        _breaker["rejected"] += 1
+        raise LLMUnavailable(f"{call_site}: LLM circuit breaker is open")
+    if _breaker["state"] == "closed":
+        return False
+    _breaker["state"] = "half_open"
+    _breaker["trial_in_flight"] = True
+    logger.info(f"[{call_site}] LLM circuit breaker half-open, sending trial request")
+    return True
+def _after_request(call_site: str, trial: bool, error: Optional[BaseException] = None):
+    if trial:
+        _breaker["trial_in_flight"] = False
+    if error is None:
+        if _breaker["state"] != "closed":
+            logger.info(f"[{call_site}] LLM circuit breaker closed, provider recovered")
+        _breaker["state"] = "closed"
+        _breaker["failures"] = 0
+        return
+    if not isinstance(error, PROVIDER_ERRORS):
+        if trial:
+            # The trial was inconclusive, let the next request try again
+            _breaker["state"] = "open"
+            _breaker["opened_at"] = time.monotonic() - LLM_BREAKER_COOLDOWN
+        return
+    _breaker["failures"] += 1
+    if trial or _breaker["failures"] >= LLM_BREAKER_FAILURES:
+        if _breaker["state"] != "open":
+            logger.warning(
+                f"[{call_site}] LLM circuit breaker opened after {_breaker['failures']} failures "
+                f"({type(error).__name__}), pausing requests for {LLM_BREAKER_COOLDOWN}s"
+            )
+        _breaker["state"] = "open"
+        _breaker["opened_at"] = time.monotonic()
+@contextmanager
+def circuit_breaker(call_site: str):
+    """
+    Run a request under the circuit breaker: raise LLMUnavailable while it is open, and count
+    the outcome of the block towards opening or closing it. For requests that do not go through
+    chat_completion, such as streamed completions.
+    Args:
+        call_site: Name of the code path making the request, used in logs
+    """
+    trial = _before_request(call_site)
+    try:
+        yield
+    except BaseException as e:
+        _after_request(call_site, trial, e)
+        raise
+    _after_request(call_site, trial)
+@contextmanager
+def llm_deadline(seconds: float):
+    """
+    Give every LLM request made inside the block, including from tasks started in it,
+    a shared deadline. A nested deadline can only shorten the outer one.
+    Args:
+        seconds: Time budget from now
+    """
+    deadline_at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(min(deadline_at, current) if current is not None else deadline_at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+async def with_deadline(coro, seconds: float):
+    """Await a coroutine under llm_deadline, for flows started with asyncio.create_task"""
+    with llm_deadline(seconds):
+        return await coro
+def remaining_time() -> Optional[float]:
+    """Seconds left until the current deadline, or None if the flow has no deadline"""
+    deadline_at = _deadline.get()
+    return None if deadline_at is None else deadline_at - time.monotonic()
+def latency_percentile(call_site: str, percentile: float = 95) -> Optional[float]:
+    """Observed latency percentile of a call site, or None until LLM_HEDGE_MIN_SAMPLES requests were seen"""
+    samples = _latencies.get(call_site)
+    if not samples or len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return float(np.percentile(np.fromiter(samples, dtype=np.float64), percentile))
+def fits_deadline(*call_sites: str) -> bool:
+    """
+    Whether the given sequence of requests is likely to finish before the current deadline,
+    judged by the median latency of each call site. Flows use this to skip optional steps.
+    """
+    remaining = remaining_time()
+    if remaining is None:
+        return True
+    expected = sum(latency_percentile(call_site, 50) or 0.0 for call_site in call_sites)
+    return remaining > expected
+def _record_latency(call_site: str, seconds: float):
+    _latencies.setdefault(call_site, deque(maxlen=LLM_LATENCY_WINDOW)).append(seconds)
+async def _timed_request(call_site: str, kwargs: Dict[str, Any]):
+    started = time.monotonic()
+    try:
+        response = await client.chat.completions.create(**kwargs)
+    except asyncio.CancelledError:
+        # The request would have taken at least this long; leaving it out would bias p95 towards fast requests
+        _record_latency(call_site, time.monotonic() - started)
+        raise
+    _record_latency(call_site, time.monotonic() - started)
+    return response
+def _may_hedge(call_site: str) -> bool:
+    """
+    Whether a slow request of the call site may be duplicated: not while the provider is failing,
+    where a hedge only adds load, and not beyond LLM_HEDGE_MAX_RATIO of the recent requests
+    """
+    if _breaker["state"] != "closed" or _breaker["failures"] > 0:
+        return False
+    history = _hedge_history.get(call_site)
+    return not history or sum(history) < LLM_HEDGE_MAX_RATIO * len(history)
+async def _hedged_request(call_site: str, kwargs: Dict[str, Any]):
+    """
+    Send a request and, if it is still running after the call site's observed p95 latency,
+    a duplicate of it, within the limits of _may_hedge. The first successful response wins
+    and the other one is cancelled.
+    The whole exchange is bounded by the current deadline.
+    """
+    hedge_delay = latency_percentile(call_site) if _may_hedge(call_site) else None
+    attempts = [asyncio.create_task(_timed_request(call_site, kwargs))]
+    pending = set(attempts)
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            remaining = remaining_time()
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceeded(f"{call_site}: deadline exceeded")
+            timeout = remaining
+            can_hedge = len(attempts) == 1 and hedge_delay is not None
+            if can_hedge:
+                timeout = hedge_delay if remaining is None else min(hedge_delay, remaining)
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if len(attempts) > 1:
+                        stats = _hedge_stats.setdefault(call_site, {"hedged": 0, "hedge_won": 0})
+                        stats["hedge_won"] += task is attempts[1]
+                    return task.result()
+                error = task.exception()
+            if not done and can_hedge and not _may_hedge(call_site):
+                # The breaker or the hedge budget changed while waiting, keep waiting for the first attempt
+                hedge_delay = None
+            elif not done and can_hedge and (remaining is None or remaining > hedge_delay):
+                logger.info(f"[{call_site}] no response after p95 {hedge_delay:.1f}s, sending hedged request")
+                _hedge_stats.setdefault(call_site, {"hedged": 0, "hedge_won": 0})["hedged"] += 1
+                hedge = asyncio.create_task(_timed_request(call_site, kwargs))
+                attempts.append(hedge)
+                pending.add(hedge)
+            elif not done and not can_hedge:
+                raise DeadlineExceeded(f"{call_site}: deadline exceeded")
+        raise error
+    finally:
+        _hedge_history.setdefault(call_site, deque(maxlen=LLM_LATENCY_WINDOW)).append(len(attempts) > 1)
+        for task in attempts:
+            if not task.done():
+                task.cancel()
+def record_prompt_cache_usage(call_site: str, usage) -> None:
+    """
+    Log how much of a prompt was served from the provider's prompt cache
+    Args:
+        call_site: Name of the code path that made the request
+        usage: The usage object of a chat completion response
+    """
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    stats = _cache_stats.setdefault(call_site, {"prompt_tokens": 0, "cached_tokens": 0, "requests": 0})
+    stats["prompt_tokens"] += prompt_tokens
+    stats["cached_tokens"] += cached_tokens
+    stats["requests"] += 1
+    ratio = cached_tokens / prompt_tokens if prompt_tokens else 0.0
+    total_ratio = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+    logger.info(
+        f"[{call_site}] prompt cache: {cached_tokens}/{prompt_tokens} tokens cached ({ratio:.0%}), "
+        f"{total_ratio:.0%} over {stats['requests']} requests"
+    )
+def get_prompt_cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Return cumulative prompt cache statistics per call site"""
+    return {
+        call_site: dict(stats, ratio=stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0)
+        for call_site, stats in _cache_stats.items()
+    }
+def get_latency_stats() -> Dict[str, Dict[str, Any]]:
+    """Return observed latency percentiles and hedging counters per call site"""
+    return {
+        call_site: {
+            "requests": len(samples),
+            "p50": latency_percentile(call_site, 50),
+            "p95": latency_percentile(call_site, 95),
+            **_hedge_stats.get(call_site, {"hedged": 0, "hedge_won": 0})
+        }
+        for call_site, samples in _latencies.items()
+    }
+async def chat_completion(call_site: str, **kwargs):
+    """
+    Create a chat completion and record its prompt cache and token usage
+    Requests slower than the call site's p95 latency are hedged, and requests made under
+    llm_deadline raise DeadlineExceeded instead of overshooting it. After LLM_BREAKER_FAILURES
+    consecutive provider errors the circuit breaker opens and requests raise LLMUnavailable
+    without being sent, until a trial request after LLM_BREAKER_COOLDOWN succeeds. Requests
+    whose feature or chat has used up its daily token budget raise BudgetExceeded.
+    Args:
+        call_site: Name of the code path making the request, used in logs, latency and usage stats
+        **kwargs: Arguments for client.chat.completions.create
+    Returns:
+        The chat completion response
+    """
+    await check_budget(call_site)
+    with circuit_breaker(call_site):
+        response = await _hedged_request(call_site, kwargs)
+    record_prompt_cache_usage(call_site, getattr(response, "usage", None))
+    await record_usage(call_site, kwargs.get("model"), getattr(response, "usage", None))
+    return response
+async def bounded(coro, call_site: str):
+    """
+    Await a coroutine that cannot be hedged, such as a streamed completion, within the current deadline
+    Args:
+        coro: Coroutine to await
+        call_site: Name used for latency stats and errors
+    Returns:
+        The coroutine result
+    """
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        coro.close()
+        raise DeadlineExceeded(f"{call_site}: deadline exceeded")
+    started = time.monotonic()
+    try:
+        result = await asyncio.wait_for(coro, timeout=remaining)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"{call_site}: deadline exceeded")
+    _record_latency(call_site, time.monotonic() - started)
+    return result
@@ -0,0 +1,150 @@
+import json
+import numbers
+import re
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional
+import numpy as np
+from telegram_ai_assistant.config import RESULT_RAW_ROWS, RESULT_SAMPLE_ROWS
+TOP_K = 5
+QUANTILES = (0.25, 0.5, 0.75, 0.9)
+MAX_HISTOGRAM_BUCKETS = 40
+# Histogram bucket units from finest to coarsest, as numpy datetime64 units
+HISTOGRAM_UNITS = (("h", "hour"), ("D", "day"), ("W", "week"), ("M", "month"), ("Y", "year"))
+_ISO_DATETIME = re.compile(r"^\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$")
+_TIMEZONE_SUFFIX = re.compile(r"(Z|[+-]\d{2}:?\d{2})$")
+def _round(value: float) -> Any:
+    value = float(value)
+    return int(value) if value.is_integer() else round(value, 4)
+def _as_datetimes(values: List[Any]) -> Optional[np.ndarray]:
+    """
+    Parse timestamps, or None if any value is not one
+    Accepts ISO strings (as returned by SQLite and execute_sql_query) and the datetime and date objects
+    returned by PostgreSQL drivers; aware datetimes are converted to UTC.
+    """
+    cleaned = []
+    for value in values:
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc).replace(tzinfo=None)
+            cleaned.append(value.isoformat())
+            continue
+        if isinstance(value, date):
+            cleaned.append(value.isoformat())
+            continue
+        if not isinstance(value, str):
+            return None
+        value = _TIMEZONE_SUFFIX.sub("", value.strip())
+        if not _ISO_DATETIME.match(value):
+            return None
+        cleaned.append(value)
+    try:
+        return np.array(cleaned, dtype="datetime64[s]")
+    except ValueError:
+        return None
+def _top_values(values: List[Any], top_k: int = TOP_K) -> List[Dict[str, Any]]:
+    labels, counts = np.unique(np.array([str(value) for value in values], dtype=object), return_counts=True)
+    order = np.argsort(-counts, kind="stable")[:top_k]
+    return [{"value": labels[i], "count": int(counts[i])} for i in order]
+def _numeric_stats(values: List[Any]) -> Dict[str, Any]:
+    array = np.asarray(values, dtype=np.float64)
+    quantiles = np.quantile(array, QUANTILES)
+    return {
+        "sum": _round(array.sum()),
+        "mean": _round(array.mean()),
+        "min": _round(array.min()),
+        "max": _round(array.max()),
+        "quantiles": {f"p{int(q * 100)}": _round(v) for q, v in zip(QUANTILES, quantiles)}
+    }
+def _time_histogram(timestamps: np.ndarray) -> Dict[str, Any]:
+    """Count timestamps per bucket, using the finest unit that fits in MAX_HISTOGRAM_BUCKETS"""
+    for unit, label in HISTOGRAM_UNITS:
+        buckets, counts = np.unique(timestamps.astype(f"datetime64[{unit}]"), return_counts=True)
+        if len(buckets) <= MAX_HISTOGRAM_BUCKETS or unit == HISTOGRAM_UNITS[-1][0]:
+            return {"bucket": label, "counts": {str(bucket): int(count) for bucket, count in zip(buckets, counts)}}
+def summarize_column(name: str, values: List[Any]) -> Dict[str, Any]:
+    """
+    Compute a digest of one result column
+    Args:
+        name: Column name
+        values: All values of the column, including None
+    Returns:
+        Dict with type, count, nulls, distinct and type-specific statistics
+    """
+    present = [value for value in values if value is not None and value != ""]
+    digest: Dict[str, Any] = {"count": len(present), "nulls": len(values) - len(present)}
+    if not present:
+        digest["type"] = "empty"
+        return digest
+    digest["distinct"] = len({str(value) for value in present})
+    if all(isinstance(value, bool) for value in present):
+        digest["type"] = "boolean"
+        digest["true"] = sum(1 for value in present if value)
+        digest["false"] = len(present) - digest["true"]
+        return digest
+    # Decimal (PostgreSQL NUMERIC) counts as a number; bool is an int subclass and handled above
+    if all(isinstance(value, numbers.Number) and not isinstance(value, (bool, complex)) for value in present):
+        digest["type"] = "number"
+        digest.update(_numeric_stats(present))
+        # IDs and other low-cardinality numbers are more useful as frequencies than as sums
+        if name.endswith("_id") or digest["distinct"] <= TOP_K:
+            digest["top"] = _top_values(present)
+        return digest
+    timestamps = _as_datetimes(present)
+    if timestamps is not None:
+        digest["type"] = "datetime"
+        digest["min"] = str(timestamps.min())
+        digest["max"] = str(timestamps.max())
+        digest["histogram"] = _time_histogram(timestamps)
+        return digest
+    digest["type"] = "text"
+    lengths = np.array([len(str(value)) for value in present])
+    digest["avg_length"] = _round(lengths.mean())
+    digest["top"] = _top_values(present)
+    return digest
+def summarize_rows(rows: List[Dict[str, Any]], sample_size: int = RESULT_SAMPLE_ROWS) -> Dict[str, Any]:
+    """
+    Summarize a full query result locally so it can be described to the model compactly
+    Args:
+        rows: Query result rows
+        sample_size: Number of rows to include verbatim, spread evenly over the result
+    Returns:
+        Dict with row_count, per-column digests and a sample of rows
+    """
+    columns: List[str] = []
+    for row in rows:
+        columns.extend(key for key in row if key not in columns)
+    positions = np.unique(np.linspace(0, len(rows) - 1, num=min(sample_size, len(rows))).astype(int)) if rows else []
+    return {
+        "row_count": len(rows),
+        "columns": {column: summarize_column(column, [row.get(column) for row in rows]) for column in columns},
+        "sample": [rows[i] for i in positions]
+    }
+def compact_result(rows: List[Dict[str, Any]], max_raw_rows: int = RESULT_RAW_ROWS) -> Any:
+    """Return small results unchanged and a digest with a sample for larger ones"""
+    if not isinstance(rows, list) or len(rows) <= max_raw_rows:
+        return rows
+    return summarize_rows(rows)
+def format_result_for_prompt(rows: List[Dict[str, Any]], max_raw_rows: int = RESULT_RAW_ROWS) -> str:
+    """
+    Render a query result for an LLM prompt
+    Results of up to max_raw_rows rows are passed as JSON rows; larger ones as a digest computed
+    over all rows plus an evenly spaced sample, so counts and totals stay correct.
+    Args:
+        rows: Query result rows
+        max_raw_rows: Largest result passed verbatim
+    Returns:
+        Text for the prompt
+    """
+    if len(rows) <= max_raw_rows:
+        return json.dumps(rows, indent=2, ensure_ascii=False, default=str)
+    digest = summarize_rows(rows)
+    column_lines = "\n".join(
+        f"- {column}: {json.dumps(stats, ensure_ascii=False, default=str)}" for column, stats in digest["columns"].items()
+    )
+    sample_lines = "\n".join(json.dumps(row, ensure_ascii=False, default=str) for row in digest["sample"])
+    return (
+        f"Result has {digest['row_count']} rows. Statistics are computed over all rows; "
+        f"the sample shows {len(digest['sample'])} of them.\n"
+        f"Column statistics:\n{column_lines}\n"
+        f"Sample rows:\n{sample_lines}"
+    )
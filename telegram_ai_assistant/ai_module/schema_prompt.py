@@ -0,0 +1,152 @@
+from functools import lru_cache
+from typing import Dict, List, Optional
+from sqlalchemy import MetaData, String, Table, UniqueConstraint, func, select
+from telegram_ai_assistant.utils.db_utils import engine, Base
+from telegram_ai_assistant.utils.logging_utils import setup_ai_logger
+logger = setup_ai_logger()
+EXAMPLE_VALUES_PER_COLUMN = 3
+EXAMPLE_VALUE_MAX_LENGTH = 40
+# Tables and columns generated SQL may use; bookkeeping tables and columns (usage, caches, media store,
+# sync state, fingerprints, analysis retries) stay out of the prompt
+SCHEMA_TABLES = {
+    "chats": ("chat_id", "chat_name", "is_active", "linear_team_id"),
+    "users": ("user_id", "username", "first_name", "last_name", "is_bot"),
+    "messages": (
+        "message_id", "chat_id", "sender_id", "text", "timestamp", "is_important", "category", "is_bot",
+        "has_task", "is_question", "reply_to_message_id", "edited_at", "deleted_at"
+    ),
+    "tasks": ("linear_id", "title", "description", "status", "created_at", "due_date", "assignee_id", "message_id", "chat_id"),
+    "unanswered_questions": (
+        "message_id", "chat_id", "target_user_id", "sender_id", "question", "asked_at", "is_answered", "answered_at", "is_bot"
+    ),
+    "team_productivity": ("user_id", "date", "message_count", "tasks_created", "tasks_completed", "avg_response_time")
+}
+# Columns whose values mean nothing to the model even when they are short strings
+_OPAQUE_COLUMN_WORDS = ("hash", "path", "file_key")
+# Dialect name and date filter examples per engine.dialect.name
+DIALECT_NOTES = {
+    "sqlite": (
+        "SQLite",
+        "Today: DATE(messages.timestamp) = DATE('now'); this week: DATE(messages.timestamp) >= DATE('now', '-6 days', 'weekday 1'); "
+        "this month: DATE(messages.timestamp) >= DATE('now', 'start of month')."
+    ),
+    "postgresql": (
+        "PostgreSQL",
+        "Today: messages.timestamp >= date_trunc('day', now() AT TIME ZONE 'UTC'); this week: messages.timestamp >= date_trunc('week', now() AT TIME ZONE 'UTC'); "
+        "this month: messages.timestamp >= date_trunc('month', now() AT TIME ZONE 'UTC'). Do not use SQLite functions such as strftime or datetime('now')."
+    )
+}
+SCHEMA_NOTES = """Notes:
+- SQL dialect is {dialect}. All timestamps are stored in UTC.
+- {date_hints}
+- There is no chat_history table: chat messages live in messages, filtered by messages.chat_id.
+- Messages with deleted_at set were deleted in Telegram: always exclude them with messages.deleted_at IS NULL.
+- Join users on messages.sender_id = users.user_id and chats on messages.chat_id = chats.chat_id, and show names instead of raw IDs.
+- Use ORDER BY with GROUP BY for "most"/"least"/"top" questions."""
+def render_schema_notes(dialect_name: str) -> str:
+    """General notes for the given SQLAlchemy dialect name; unknown dialects get no date examples"""
+    dialect, date_hints = DIALECT_NOTES.get(dialect_name, (dialect_name, "Use the date functions of this dialect."))
+    return SCHEMA_NOTES.format(dialect=dialect, date_hints=date_hints)
+def _is_example_column(column) -> bool:
+    """Short string columns carry categorical values worth showing; IDs, hashes, paths and free text do not"""
+    return (
+        isinstance(column.type, String)
+        and column.type.length is not None
+        and not column.name.endswith("_id")
+        and not any(word in column.name for word in _OPAQUE_COLUMN_WORDS)
+    )
+def _schema_tables(metadata: MetaData) -> List[Table]:
+    return [table for table in metadata.sorted_tables if table.name in SCHEMA_TABLES]
+def _schema_columns(table: Table) -> List:
+    return [table.columns[name] for name in SCHEMA_TABLES[table.name] if name in table.columns]
+def load_example_values(metadata: MetaData) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Fetch the most frequent values of the short string columns in SCHEMA_TABLES
+    Args:
+        metadata: Metadata with the tables to sample
+    Returns:
+        Dict of table name -> column name -> example values
+    """
+    examples: Dict[str, Dict[str, List[str]]] = {}
+    with engine.connect() as connection:
+        for table in _schema_tables(metadata):
+            for column in _schema_columns(table):
+                if not _is_example_column(column):
+                    continue
+                try:
+                    rows = connection.execute(
+                        select(column)
+                        .where(column.isnot(None), column != "")
+                        .group_by(column)
+                        .order_by(func.count().desc())
+                        .limit(EXAMPLE_VALUES_PER_COLUMN)
+                    ).fetchall()
+                except Exception as e:
+                    logger.debug(f"Could not sample {table.name}.{column.name}: {str(e)}")
+                    continue
+                values = [str(row[0])[:EXAMPLE_VALUE_MAX_LENGTH] for row in rows]
+                if values:
+                    examples.setdefault(table.name, {})[column.name] = values
+    return examples
+def _render_column(column, examples: List[str]) -> str:
+    parts = [f"  - {column.name} {column.type.compile(dialect=engine.dialect)}"]
+    if column.primary_key:
+        parts.append("PK")
+    elif not column.nullable:
+        parts.append("NOT NULL")
+    for foreign_key in column.foreign_keys:
+        parts.append(f"-> {foreign_key.target_fullname}")
+    line = " ".join(parts)
+    if column.comment:
+        line += f": {column.comment}"
+    if examples:
+        line += " (e.g. " + ", ".join(repr(value) for value in examples) + ")"
+    return line
+def _render_table(table: Table, examples: Dict[str, List[str]]) -> str:
+    columns = _schema_columns(table)
+    names = {column.name for column in columns}
+    lines = [f"{table.name}:"]
+    lines += [_render_column(column, examples.get(column.name)) for column in columns]
+    keys = []
+    for constraint in sorted(table.constraints, key=lambda c: [col.name for col in c.columns]):
+        if isinstance(constraint, UniqueConstraint) and {col.name for col in constraint.columns} <= names:
+            keys.append("unique(" + ", ".join(col.name for col in constraint.columns) + ")")
+    for index in sorted(table.indexes, key=lambda i: i.name or ""):
+        if not {col.name for col in index.columns} <= names:
+            continue
+        kind = "unique index" if index.unique else "index"
+        keys.append(f"{kind}(" + ", ".join(col.name for col in index.columns) + ")")
+    if keys:
+        lines.append("  keys: " + "; ".join(keys))
+    return "\n".join(lines)
+def render_schema(metadata: MetaData, examples: Optional[Dict[str, Dict[str, List[str]]]] = None,
+                  dialect_name: Optional[str] = None) -> str:
+    """
+    Render a compact schema description for SQL-generating prompts
+    Args:
+        metadata: SQLAlchemy metadata; only the tables and columns of SCHEMA_TABLES are rendered
+        examples: Optional example values from load_example_values
+        dialect_name: SQLAlchemy dialect the SQL must be written for (defaults to the engine's)
+    Returns:
+        Schema text: one block per table with columns, keys and example values, then general notes
+    """
+    examples = examples or {}
+    tables = [_render_table(table, examples.get(table.name, {})) for table in _schema_tables(metadata)]
+    return "Database schema (use only these tables and columns):\n\n" + "\n\n".join(tables) + "\n\n" + render_schema_notes(
+        dialect_name or engine.dialect.name
+    )
+@lru_cache(maxsize=1)
+def get_schema_prompt() -> str:
+    """
+    Return the schema description used at the start of every SQL-generating system prompt.
+    It is rendered once per process and never changes afterwards, so every prompt begins
+    with the same bytes and the provider's prompt cache can reuse the prefix.
+    """
+    try:
+        examples = load_example_values(Base.metadata)
+    except Exception as e:
+        logger.warning(f"Could not load example values for schema prompt: {str(e)}")
+        examples = {}
+    schema = render_schema(Base.metadata, examples)
+    logger.info(f"Schema prompt rendered: {len(schema)} characters, {len(SCHEMA_TABLES)} tables")
+    return schema
@@ -0,0 +1,265 @@
+import re
+import zlib
+from math import sqrt
+from typing import Dict, Any, List, Optional, Tuple
+from telegram_ai_assistant.config import SQL_CACHE_SIMILARITY
+from telegram_ai_assistant.utils.db_utils import (
+    get_sql_templates,
+    save_sql_template,
+    record_sql_template_hit,
+    delete_sql_template
+)
+from telegram_ai_assistant.utils.logging_utils import setup_ai_logger
+logger = setup_ai_logger()
+EMBEDDING_DIMS = 1024
+_QUOTED = re.compile(r'"([^"]+)"|«([^»]+)»|“([^”]+)”|\'([^\']+)\'')
+_NUMBER = re.compile(r'(?<![\w.])\d+(?:\.\d+)?(?![\w.])')
+_SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+_PLACEHOLDER = re.compile(r"<([sn]\d+)>")
+_DIGITS = re.compile(r"(?<![<sn])\d+(?:\.\d+)?")
+# Words that change what a question asks for: order, comparison, period and number words.
+# A similar question must use exactly the same ones; an extra miss is cheap, a wrong query is not.
+_QUALIFIER_WORDS = frozenset("""
+most least top bottom highest lowest max maximum min minimum first last more less fewer greater than
+above below over under not no without except before after since until between only
+today yesterday tomorrow hour hours day days daily week weeks weekly month months monthly quarter
+year years yearly this previous next current ascending descending asc desc earliest latest newest oldest
+one two three four five six seven eight nine ten twice half dozen hundred
+не без кроме до после от между только час часа часов день дня дней год года лет
+этот эта это этой этом эту один одна одну одно два две три
+""".split())
+_QUALIFIER_STEMS = (
+    "больш", "меньш", "наибол", "наимен", "максим", "миним", "самы", "само", "сама", "топ",
+    "перв", "последн", "предыдущ", "прошл", "следующ", "текущ", "выше", "ниже", "чаще", "реже",
+    "более", "менее", "раньше", "позже", "сегодн", "вчера", "завтра", "недел", "месяц", "квартал",
+    "минут", "суток", "сутк", "ежедн", "еженед", "ежемес", "четыр", "пят", "шест", "сем", "восем",
+    "девят", "десят", "сотн", "дважды", "половин"
+)
+# Loaded lazily from the database: dicts from get_sql_templates plus an "embedding" key
+_templates: Optional[List[Dict[str, Any]]] = None
+_stats = {"lookups": 0, "exact_hits": 0, "similar_hits": 0, "misses": 0, "fallbacks": 0}
+def normalize_question(question: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Reduce a question to a template with its literal values pulled out
+    Quoted strings become <s0>, <s1>..., numbers become <n0>, <n1>...; the rest is
+    lowercased with punctuation and repeated whitespace removed.
+    Args:
+        question: Question text
+    Returns:
+        Tuple of (template, values by placeholder name)
+    """
+    values: Dict[str, Any] = {}
+    def replace_quoted(match):
+        name = f"s{sum(1 for key in values if key[0] == 's')}"
+        values[name] = next(group for group in match.groups() if group)
+        return f" <{name}> "
+    def replace_number(match):
+        name = f"n{sum(1 for key in values if key[0] == 'n')}"
+        raw = match.group(0)
+        values[name] = float(raw) if "." in raw else int(raw)
+        return f" <{name}> "
+    text = _QUOTED.sub(replace_quoted, question)
+    text = _NUMBER.sub(replace_number, text)
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"[^\w<>\s]", " ", text)
+    return " ".join(text.split()), values
+def embed(text: str) -> Dict[int, float]:
+    """
+    Local embedding of a question template: hashed character trigrams, L2-normalized.
+    Cheap enough to compute for every cached template and robust to small wording changes.
+    """
+    padded = f" {text} "
+    vector: Dict[int, float] = {}
+    for i in range(len(padded) - 2):
+        bucket = zlib.crc32(padded[i:i + 3].encode("utf-8")) % EMBEDDING_DIMS
+        vector[bucket] = vector.get(bucket, 0.0) + 1.0
+    norm = sqrt(sum(value * value for value in vector.values())) or 1.0
+    return {bucket: value / norm for bucket, value in vector.items()}
+def cosine_similarity(a: Dict[int, float], b: Dict[int, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(value * b.get(bucket, 0.0) for bucket, value in a.items())
+def _split_sql(sql: str) -> List[Tuple[bool, str]]:
+    """Split SQL into (is_string_literal, text) segments"""
+    segments = []
+    position = 0
+    for match in _SQL_STRING.finditer(sql):
+        if match.start() > position:
+            segments.append((False, sql[position:match.start()]))
+        segments.append((True, match.group(0)))
+        position = match.end()
+    if position < len(sql):
+        segments.append((False, sql[position:]))
+    return segments
+def parameterize_sql(sql: str, values: Dict[str, Any]) -> Tuple[str, Dict[str, str]]:
+    """
+    Replace literals that came from the question with named bind parameters
+    Numbers are replaced outside of string literals, strings when a whole literal equals the
+    value, optionally wrapped in LIKE wildcards.
+    Args:
+        sql: SQL generated for the question
+        values: Values extracted by normalize_question
+    Returns:
+        Tuple of (SQL with :name parameters, dict of parameter name -> format string)
+    """
+    segments = _split_sql(sql)
+    slots: Dict[str, str] = {}
+    for name, value in values.items():
+        for index, (is_literal, segment) in enumerate(segments):
+            if name[0] == "n" and not is_literal:
+                pattern = re.compile(rf"(?<![\w.:]){re.escape(str(value))}(?![\w.])")
+                replaced, count = pattern.subn(f":{name}", segment)
+            elif name[0] == "s" and is_literal:
+                match = re.fullmatch(rf"'(%?){re.escape(str(value))}(%?)'", segment, re.IGNORECASE)
+                replaced, count = (f":{name}", 1) if match else (segment, 0)
+                if count:
+                    slots[name] = f"{match.group(1)}{{}}{match.group(2)}"
+            else:
+                continue
+            if count:
+                segments[index] = (False, replaced)
+                slots.setdefault(name, "{}")
+    return "".join(segment for _, segment in segments), slots
+def _fill_template(template: str, values: Dict[str, Any], keep: Dict[str, Any]) -> str:
+    """Put literal values back into a template, except for the placeholders in keep"""
+    def replace(match):
+        name = match.group(1)
+        return match.group(0) if name in keep else str(values.get(name, match.group(0))).lower()
+    return _PLACEHOLDER.sub(replace, template)
+def _sql_string_literals(sql: str) -> List[str]:
+    return [segment[1:-1].replace("''", "'").strip("%").lower() for is_literal, segment in _split_sql(sql) if is_literal]
+def _same_literals(candidate: str, template: Dict[str, Any]) -> bool:
+    """
+    A similar question may only reuse SQL if it mentions every string baked into the SQL
+    and the same unparameterized numbers, so "за 7 дней" never reuses SQL written for 30 days
+    """
+    literals = [literal for literal in _sql_string_literals(template["sql_template"]) if literal and literal in template["question_template"]]
+    if not all(literal in candidate for literal in literals):
+        return False
+    return sorted(_DIGITS.findall(candidate)) == sorted(_DIGITS.findall(template["question_template"]))
+def _context_literals(sql_template: str, question_template: str) -> List[str]:
+    """
+    String literals with numbers that the question does not contain, such as a date the model
+    computed for "today" or an ID it looked up; SQL with them gives stale answers when replayed.
+    "-7 days" for "за 7 дней" is fine, the template keeps the 7 and only matches that value.
+    """
+    numbers = set(_DIGITS.findall(question_template))
+    return [
+        literal for literal in _sql_string_literals(sql_template)
+        if not set(_DIGITS.findall(literal)) <= numbers
+    ]
+def _qualifiers(text: str) -> set:
+    """Order, comparison, period and number words of a normalized question, reduced to their stems"""
+    qualifiers = set()
+    for word in text.split():
+        if word in _QUALIFIER_WORDS:
+            qualifiers.add(word)
+            continue
+        stem = next((stem for stem in _QUALIFIER_STEMS if word.startswith(stem)), None)
+        if stem:
+            qualifiers.add(stem)
+    return qualifiers
+async def _load_templates() -> List[Dict[str, Any]]:
+    global _templates
+    if _templates is None:
+        _templates = []
+        for template in await get_sql_templates():
+            if _context_literals(template["sql_template"], template["question_template"]):
+                # Cached before such SQL was rejected; it would be replayed with a stale value
+                await delete_sql_template(template["id"])
+                continue
+            template["embedding"] = embed(template["question_template"])
+            _templates.append(template)
+        logger.info(f"Loaded {len(_templates)} cached SQL templates")
+    return _templates
+def _log_lookup(outcome: str, question: str, similarity: float = 0.0):
+    _stats[outcome] += 1
+    hits = _stats["exact_hits"] + _stats["similar_hits"]
+    rate = hits / _stats["lookups"] if _stats["lookups"] else 0.0
+    label = {"exact_hits": "exact hit", "similar_hits": "similar hit", "misses": "miss"}[outcome]
+    logger.info(
+        f"SQL cache {label} (similarity {similarity:.2f}) for '{question[:50]}', "
+        f"hit rate {rate:.0%} ({hits}/{_stats['lookups']}), fallbacks {_stats['fallbacks']}"
+    )
+async def match_sql_template(question: str) -> Optional[Dict[str, Any]]:
+    """
+    Find cached SQL for a question
+    A template matches exactly when the normalized question is identical after its
+    parameters are filled in, or by embedding similarity of at least SQL_CACHE_SIMILARITY
+    when the question also mentions every string literal that is baked into the SQL and
+    uses the same order, comparison, period and number words ("most"/"least", "week"/"month").
+    Args:
+        question: Question text
+    Returns:
+        Dict with template_id, sql, params, similarity and match ("exact" or "similar"),
+        or None if no template is good enough
+    """
+    _stats["lookups"] += 1
+    normalized, values = normalize_question(question)
+    best = None
+    best_similarity = 0.0
+    for template in await _load_templates():
+        slots = template["param_slots"]
+        if any(name not in values for name in slots):
+            continue
+        candidate = _fill_template(normalized, values, slots)
+        if candidate == template["question_template"]:
+            best, best_similarity = template, 1.0
+            break
+        similarity = cosine_similarity(embed(candidate), template["embedding"])
+        if similarity > best_similarity and _same_literals(candidate, template) \
+                and _qualifiers(candidate) == _qualifiers(template["question_template"]):
+            best, best_similarity = template, similarity
+    if best is None or best_similarity < SQL_CACHE_SIMILARITY:
+        _log_lookup("misses", question, best_similarity)
+        return None
+    match = "exact" if best_similarity == 1.0 else "similar"
+    _log_lookup(f"{match}_hits", question, best_similarity)
+    await record_sql_template_hit(best["id"])
+    return {
+        "template_id": best["id"],
+        "sql": best["sql_template"],
+        "params": {name: fmt.format(values[name]) if fmt != "{}" else values[name] for name, fmt in best["param_slots"].items()},
+        "similarity": best_similarity,
+        "match": match
+    }
+async def remember_sql_template(question: str, sql: str):
+    """
+    Cache SQL that executed successfully for a question
+    Only read queries are cached. Values from the question that could not be found in
+    the SQL stay part of the template, so the template only matches that exact value.
+    SQL with literals that did not come from the question is not cached.
+    """
+    if not re.match(r"\s*(select|with)\b", sql, re.IGNORECASE):
+        return
+    normalized, values = normalize_question(question)
+    sql_template, slots = parameterize_sql(sql, values)
+    question_template = _fill_template(normalized, values, slots)
+    context_literals = _context_literals(sql_template, question_template)
+    if context_literals:
+        logger.info(f"Not caching SQL for '{question_template[:60]}': literals {context_literals[:3]} are not from the question")
+        return
+    template_id = await save_sql_template(question_template, sql_template, slots)
+    if template_id is None:
+        return
+    templates = await _load_templates()
+    templates[:] = [t for t in templates if t["question_template"] != question_template]
+    templates.append({
+        "id": template_id,
+        "question_template": question_template,
+        "sql_template": sql_template,
+        "param_slots": slots,
+        "hit_count": 0,
+        "embedding": embed(question_template)
+    })
+    logger.info(f"Cached SQL template for '{question_template[:60]}' with parameters {list(slots)}")
+async def forget_sql_template(template_id: int, reason: str):
+    """Drop a cached template whose SQL failed and count the LLM fallback"""
+    _stats["fallbacks"] += 1
+    logger.warning(f"Cached SQL template {template_id} failed ({reason}), falling back to the model")
+    await delete_sql_template(template_id)
+    templates = await _load_templates()
+    templates[:] = [t for t in templates if t["id"] != template_id]
+def get_sql_cache_stats() -> Dict[str, int]:
+    """Return SQL cache lookup counters since startup"""
+    return dict(_stats)
@@ -0,0 +1,170 @@
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, date
+from typing import Any, Dict, Optional, Set, Tuple
+from telegram_ai_assistant.config import USAGE_CHAT_DAILY_TOKENS, USAGE_FEATURE_DAILY_TOKENS, LLM_PRICES
+from telegram_ai_assistant.utils.db_utils import record_llm_usage, get_llm_usage_totals
+from telegram_ai_assistant.utils.logging_utils import setup_ai_logger
+logger = setup_ai_logger()
+# Feature each call site is billed to, by the part of the call site name before the first dot
+CALL_SITE_FEATURES = {
+    "analyze_message": "triage",
+    "extract_task_from_message": "triage",
+    "detect_question_target": "triage",
+    "generate_chat_summary": "summaries",
+    "fold_into_rolling_summary": "summaries",
+    "summarize_single_chat": "summaries",
+    "merge_chat_summaries": "summaries",
+    "iterative_discussion_summary": "summaries",
+    "ai_agent_query": "agent",
+    "iterative_reasoning": "reasoning",
+    "determine_and_execute_query": "ask",
+    "explain_query_result": "ask",
+    "get_required_context": "ask",
+    "process_question_with_context": "ask",
+    "analyze_message_intent": "ask",
+    "handle_message": "ask",
+    "suggest_response": "suggestions",
+    "analyze_productivity": "reports"
+}
+# USD per million input, cached input and output tokens, by model name prefix; LLM_PRICES overrides these
+DEFAULT_PRICES = {
+    "o3-mini": (1.10, 0.55, 4.40),
+    "o1-mini": (1.10, 0.55, 4.40),
+    "o1": (15.00, 7.50, 60.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00)
+}
+# Feature, chat and message the LLM requests of the current flow are attributed to, inherited by tasks it starts
+_scope: ContextVar[Dict[str, Any]] = ContextVar("usage_scope", default={})
+# Tokens used today (UTC) per feature and per chat, loaded from llm_usage on the first request after startup
+_today: Dict[str, Any] = {"day": None, "features": {}, "chats": {}}
+_load_lock = asyncio.Lock()
+class BudgetExceeded(Exception):
+    """Raised without contacting the provider when a daily token budget is used up"""
+@contextmanager
+def usage_scope(feature: Optional[str] = None, chat_id: Optional[int] = None, message_id: Optional[int] = None):
+    """
+    Attribute every LLM request made inside the block to a feature, chat and message.
+    Values left as None are inherited from the enclosing scope.
+    """
+    current = _scope.get()
+    updates = {"feature": feature, "chat_id": chat_id, "message_id": message_id}
+    token = _scope.set(dict(current, **{key: value for key, value in updates.items() if value is not None}))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+def feature_for(call_site: str) -> str:
+    """Feature a request is billed to: the current scope's, else the call site's, else "other" """
+    return _scope.get().get("feature") or CALL_SITE_FEATURES.get(call_site.split(".")[0], "other")
+def price_for(model: Optional[str]) -> Tuple[float, float, float]:
+    """Input, cached input and output price per million tokens of the longest matching model prefix"""
+    prices = dict(DEFAULT_PRICES, **{name: tuple(values) for name, values in LLM_PRICES.items()})
+    matches = [name for name in prices if model and model.startswith(name)]
+    return prices[max(matches, key=len)] if matches else (0.0, 0.0, 0.0)
+def estimate_cost(model: Optional[str], prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    input_price, cached_price, output_price = price_for(model)
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price + completion_tokens * output_price) / 1_000_000
+def _start_of_day(day: date) -> datetime:
+    return datetime(day.year, day.month, day.day)
+async def _ensure_today():
+    """Reset the daily counters at UTC midnight and load today's totals after a restart"""
+    today = datetime.utcnow().date()
+    if _today["day"] == today:
+        return
+    async with _load_lock:
+        if _today["day"] == today:
+            return
+        totals = {"features": {}, "chats": {}}
+        if _today["day"] is None:
+            totals = await get_llm_usage_totals(_start_of_day(today))
+        _today.update(day=today, features=totals["features"], chats=totals["chats"])
+def _feature_budget(feature: str) -> int:
+    return int(USAGE_FEATURE_DAILY_TOKENS.get(feature, 0) or 0)
+async def exhausted_budget(feature: str, chat_id: Optional[int] = None) -> Optional[str]:
+    """
+    Check the daily budgets of a feature and a chat
+    Args:
+        feature: Feature about to make requests
+        chat_id: Chat the requests are made for, if any
+    Returns:
+        Description of the exhausted budget, or None if requests may be made
+    """
+    await _ensure_today()
+    budget = _feature_budget(feature)
+    used = _today["features"].get(feature, 0)
+    if budget and used >= budget:
+        return f"daily token budget of '{feature}' is used up ({used:,}/{budget:,} tokens)"
+    if chat_id is not None and USAGE_CHAT_DAILY_TOKENS:
+        used = _today["chats"].get(chat_id, 0)
+        if used >= USAGE_CHAT_DAILY_TOKENS:
+            return f"daily token budget of chat {chat_id} is used up ({used:,}/{USAGE_CHAT_DAILY_TOKENS:,} tokens)"
+    return None
+async def exhausted_chats() -> Set[int]:
+    """Chats whose daily token budget is used up"""
+    await _ensure_today()
+    if not USAGE_CHAT_DAILY_TOKENS:
+        return set()
+    return {chat_id for chat_id, used in _today["chats"].items() if used >= USAGE_CHAT_DAILY_TOKENS}
+async def check_budget(call_site: str):
+    """Raise BudgetExceeded if the feature or chat of the current scope has no tokens left today"""
+    reason = await exhausted_budget(feature_for(call_site), _scope.get().get("chat_id"))
+    if reason:
+        raise BudgetExceeded(f"{call_site}: {reason}")
+async def record_usage(call_site: str, model: Optional[str], usage) -> Optional[Dict[str, Any]]:
+    """
+    Count the tokens of a completed request against today's budgets and store them in llm_usage
+    Args:
+        call_site: Name of the code path that made the request
+        model: Requested model name
+        usage: The usage object of a chat completion response or of the last chunk of a stream
+    Returns:
+        The stored usage row, or None if the response carried no usage
+    """
+    if usage is None:
+        return None
+    await _ensure_today()
+    scope = _scope.get()
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    total_tokens = getattr(usage, "total_tokens", 0) or prompt_tokens + completion_tokens
+    row = {
+        "call_site": call_site,
+        "feature": feature_for(call_site),
+        "model": model,
+        "chat_id": scope.get("chat_id"),
+        "message_id": scope.get("message_id"),
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": total_tokens,
+        "cost": estimate_cost(model, prompt_tokens, cached_tokens, completion_tokens)
+    }
+    features = _today["features"]
+    features[row["feature"]] = features.get(row["feature"], 0) + total_tokens
+    if row["chat_id"] is not None:
+        _today["chats"][row["chat_id"]] = _today["chats"].get(row["chat_id"], 0) + total_tokens
+    logger.debug(f"[{call_site}] {total_tokens} tokens (${row['cost']:.4f}) billed to {row['feature']}")
+    await record_llm_usage(row)
+    return row
+async def get_budget_status() -> Dict[str, Any]:
+    """Return today's token usage per feature and chat together with the configured budgets"""
+    await _ensure_today()
+    features = set(_today["features"]) | set(USAGE_FEATURE_DAILY_TOKENS)
+    return {
+        "day": str(_today["day"]),
+        "features": {
+            feature: {"used": _today["features"].get(feature, 0), "budget": _feature_budget(feature)}
+            for feature in sorted(features)
+        },
+        "chats": {
+            chat_id: {"used": used, "budget": USAGE_CHAT_DAILY_TOKENS}
+            for chat_id, used in sorted(_today["chats"].items(), key=lambda item: -item[1])
+        }
+    }
@@ -1,6 +1,7 @@
 import sys
 import os
 import asyncio
+import html
 import logging
 from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional, Union
@@ -14,7 +15,7 @@ import re
 import json
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from telegram_ai_assistant.bot.bot_config import BOT_TOKEN, ADMIN_USER_ID
-from telegram_ai_assistant.config import OPENAI_MODEL, LINEAR_TEAM_MAPPING
+from telegram_ai_assistant.config import OPENAI_MODEL, LINEAR_TEAM_MAPPING, INTERACTIVE_DEADLINE
 from telegram_ai_assistant.utils.db_utils import (
     get_recent_chat_messages, 
     get_pending_reminders, 
@@ -22,7 +23,9 @@ from telegram_ai_assistant.utils.db_utils import (
     get_tasks_by_due_date,
     get_team_productivity,
     get_user_chats,
-    execute_sql_query
+    get_active_chats,
+    execute_sql_query,
+    get_llm_usage_report
 )
 from telegram_ai_assistant.ai_module.ai_analyzer import (
     generate_chat_summary, 
@@ -32,12 +35,24 @@ from telegram_ai_assistant.ai_module.ai_analyzer import (
     generate_sql_from_question,
     iterative_reasoning,
     iterative_discussion_summary,
+    merge_chat_summaries,
     ai_agent_query
 )
 from telegram_ai_assistant.ai_module.context_processor import process_question_with_context, analyze_message_intent
+from telegram_ai_assistant.ai_module.schema_prompt import get_schema_prompt
+from telegram_ai_assistant.ai_module.intent_router import route_question
+from telegram_ai_assistant.ai_module.result_digest import format_result_for_prompt
+from telegram_ai_assistant.ai_module.llm_gateway import chat_completion, llm_deadline, with_deadline
+from telegram_ai_assistant.ai_module.usage_tracker import exhausted_budget, get_budget_status, usage_scope
 from telegram_ai_assistant.linear_integration.linear_client import LinearClient
 from telegram_ai_assistant.userbot.telegram_client import send_message_as_user
 from telegram_ai_assistant.utils.task_utils import pending_tasks
+from telegram_ai_assistant.utils.stream_utils import TelegramStreamWriter, split_message_text
+from telegram_ai_assistant.utils.summary_utils import (
+    refresh_rolling_summary,
+    refresh_all_rolling_summaries,
+    refresh_summaries_periodically
+)
 from telegram_ai_assistant.utils.logging_utils import setup_bot_logger, log_startup
 from aiogram.fsm.context import FSMContext
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
@@ -48,8 +63,18 @@ user_states = {}
 AWAITING_TASK_TITLE = "awaiting_title"
 AWAITING_TASK_DESCRIPTION = "awaiting_description"
 AWAITING_TASK_CONFIRMATION = "awaiting_task_confirmation"
+# /summary pages leave room under Telegram's 4096 characters for chat titles and notes
+SUMMARY_CHUNK_LIMIT = 4000
+SUMMARY_PAGE_LIMIT = 3500
 task_creation_data = defaultdict(dict)
 task_confirmation_data = defaultdict(dict)
+async def reject_if_over_budget(message: types.Message, feature: str) -> bool:
+    """Tell the admin instead of starting a flow whose daily token budget is used up"""
+    reason = await exhausted_budget(feature)
+    if reason:
+        await message.reply(f"⚠️ Not started: the {reason}. Budgets reset at midnight UTC, see /usage.")
+        return True
+    return False
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     """Handle /start command"""
@@ -110,11 +135,23 @@ async def cmd_help(message: types.Message):
 /start - Initialize the bot
 /help - Show this help message
 /status - Check system status
+/usage [days] [feature|call_site|chat|model|day] - LLM token usage, cost and budgets
 /settings - Configure bot settings
 
 For any issues or questions about the bot itself, contact the developer.
 """
     await message.reply(help_text, parse_mode="Markdown")
+def _escaped_pages(text: str, limit: int = SUMMARY_PAGE_LIMIT, raw_limit: Optional[int] = None) -> List[str]:
+    """HTML-escape text and split it into pages that stay within limit after escaping"""
+    pages = []
+    for page in split_message_text(text or "", raw_limit or limit):
+        escaped = html.escape(page, quote=False)
+        if len(escaped) > limit and len(page) > 1:
+            # Escaping made the page too long: split the raw text finer, never inside an entity
+            pages += _escaped_pages(page, limit, len(page) // 2)
+        else:
+            pages.append(escaped)
+    return pages
 @dp.message(Command("summary"))
 async def cmd_summary(message: types.Message):
     """Generate and send summary of recent conversations"""
@@ -126,24 +163,65 @@ async def cmd_summary(message: types.Message):
     logger.info(f"Summary requested for chat: {chat_name or 'All chats'}")
     processing_msg = await message.reply("Generating summary... This might take a moment.")
     try:
-        chat_id = None  # TODO: Implement chat name to ID mapping
-        chat_messages = await get_recent_chat_messages(chat_id, hours=24, limit=100)
-        if not chat_messages:
-            logger.info("No recent messages found to summarize")
+        if chat_name:
+            chats = await get_active_chats()
+            matching = [c for c in chats if chat_name.lower() in c["chat_name"].lower()]
+            if not matching:
+                await processing_msg.edit_text(f"No active chat found matching '{chat_name}'.")
+                return
+            results = [await refresh_rolling_summary(matching[0]["chat_id"])]
+        else:
+            # Chats are refreshed concurrently; show which ones are still being folded
+            progress_writer = TelegramStreamWriter(bot, processing_msg.chat.id, processing_msg.message_id)
+            progress = {}
+            async def report_progress(chat, status):
+                progress[chat["chat_name"]] = status
+                done = sum(1 for s in progress.values() if s != "working")
+                working = [name for name, s in progress.items() if s == "working"]
+                try:
+                    await progress_writer.update(
+                        f"Generating summary... {done} chats done\n"
+                        + (f"Working on: {', '.join(working)}" if working else "")
+                    )
+                except Exception as e:
+                    logger.debug(f"Could not update summary progress: {str(e)}")
+            results = await refresh_all_rolling_summaries(on_progress=report_progress)
+        results = [r for r in results if r and r.get("summary")]
+        if not results:
+            logger.info("No messages found to summarize today")
             await processing_msg.edit_text("No recent messages found to summarize.")
             return
-        logger.debug(f"Found {len(chat_messages)} messages to summarize")
-        summary = await generate_chat_summary(
-            chat_messages, 
-            chat_name or "All monitored chats"
-        )
-        response = (
-            f"📊 <b>Summary for {chat_name or 'All Chats'}</b>\n"
-            f"<i>Period: Last 24 hours</i>\n\n"
-            f"{summary}"
-        )
+        logger.debug(f"Rolling summaries ready for {len(results)} chats, "
+                     f"{sum(r['new_messages'] for r in results)} new messages folded")
+        # Telegram rejects messages longer than 4096 characters, so split between chat sections
+        chunks = [
+            f"📊 <b>Summary for {html.escape(chat_name or 'All Chats')}</b>\n"
+            f"<i>Period: Today (UTC)</i>"
+        ]
+        sections = []
+        if len(results) > 1:
+            budget_reason = await exhausted_budget("summaries")
+            if budget_reason:
+                chunks[0] += f"\n\n<i>No digest: the {html.escape(budget_reason)}</i>"
+            else:
+                digest = await merge_chat_summaries(results, "Today (UTC)")
+                sections.append(("Digest", digest, ""))
+        for r in results:
+            stale_note = "\n<i>Not fully up to date: token budget used up</i>" if r.get("stale") else ""
+            sections.append((r["chat_name"], r["summary"], stale_note))
+        for title, text, note in sections:
+            pages = _escaped_pages(text)
+            pages[0] = f"<b>{html.escape(title)}</b>\n{pages[0]}"
+            pages[-1] += note
+            for page in pages:
+                if len(chunks[-1]) + len(page) + 2 > SUMMARY_CHUNK_LIMIT:
+                    chunks.append(page)
+                else:
+                    chunks[-1] += "\n\n" + page
         logger.info(f"Summary generated successfully for {chat_name or 'All chats'}")
-        await processing_msg.edit_text(response, parse_mode="HTML")
+        await processing_msg.edit_text(chunks[0], parse_mode="HTML")
+        for chunk in chunks[1:]:
+            await message.answer(chunk, parse_mode="HTML")
     except Exception as e:
         logger.error(f"Error generating summary: {str(e)}", exc_info=True)
         await processing_msg.edit_text(f"Error generating summary: {str(e)}")
@@ -228,7 +306,11 @@ async def cmd_teamreport(message: types.Message):
         if not productivity_data:
             await processing_msg.edit_text("No productivity data available.")
             return
-        analysis = await analyze_productivity(productivity_data)
+        budget_reason = await exhausted_budget("reports")
+        if budget_reason:
+            analysis = f"<i>Skipped: the {budget_reason}</i>"
+        else:
+            analysis = await analyze_productivity(productivity_data)
         response = [
             "📈 <b>Team Productivity Report</b>\n",
             "<i>Period: Last 7 days</i>\n\n",
@@ -466,13 +548,18 @@ async def cmd_ask(message: types.Message):
             show_details = True
             query_text = query_text.replace("--details", "").replace("-d", "").strip()
         
+        if await reject_if_over_budget(message, "ask" if use_legacy_mode else "agent"):
+            return
+        
         if use_legacy_mode:
             # Use the old context-based approach
             processing_msg = await message.reply("Обрабатываю ваш вопрос...")
             
             try:
                 chat_id = message.chat.id
-                result = await process_question_with_context(query_text, chat_id)
+                writer = TelegramStreamWriter(bot, processing_msg.chat.id, processing_msg.message_id)
+                with llm_deadline(INTERACTIVE_DEADLINE):
+                    result = await process_question_with_context(query_text, chat_id, stream_writer=writer)
                 
                 answer = result.get("answer", "Не удалось сформировать ответ")
                 
@@ -487,7 +574,7 @@ async def cmd_ask(message: types.Message):
                     
                     answer += details_text
                 
-                await processing_msg.edit_text(answer, parse_mode="HTML")
+                await writer.finish(answer, parse_mode="HTML")
                 logger.info(f"Processed contextual question: {query_text[:50]}...")
             except Exception as e:
                 logger.error(f"Error processing contextual question: {str(e)}")
@@ -501,7 +588,7 @@ async def cmd_ask(message: types.Message):
             
             # Start the autonomous agent
             from telegram_ai_assistant.ai_module.ai_analyzer import ai_agent_query
-            asyncio.create_task(ai_agent_query(query_text))
+            asyncio.create_task(with_deadline(ai_agent_query(query_text), INTERACTIVE_DEADLINE))
             
             logger.info(f"Started autonomous AI agent for question: {query_text[:50]}...")
     
@@ -525,6 +612,8 @@ async def cmd_reason(message: types.Message):
             return
         
         question = command_parts[1].strip()
+        if await reject_if_over_budget(message, "reasoning"):
+            return
         
         # Let the user know we're starting the reasoning process
         intro_message = await message.reply(
@@ -534,7 +623,7 @@ async def cmd_reason(message: types.Message):
         
         # We don't need to await the result here since the iterative_reasoning
         # function itself will update the Telegram message as it progresses
-        asyncio.create_task(iterative_reasoning(question, max_attempts=3))
+        asyncio.create_task(with_deadline(iterative_reasoning(question, max_attempts=3), INTERACTIVE_DEADLINE))
         
         logger.info(f"Started iterative reasoning for question: {question[:50]}...")
         
@@ -623,6 +712,8 @@ async def cmd_discussion_summary(message: types.Message):
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
             )
         else:
+            if await reject_if_over_budget(message, "summaries"):
+                return
             # Start the iterative summary process directly if chat ID provided
             await message.reply(
                 f"🔍 *Starting iterative discussion summary for chat {chat_id}*\n\n"
@@ -632,7 +723,8 @@ async def cmd_discussion_summary(message: types.Message):
             )
             
             # Start the analysis process
-            asyncio.create_task(iterative_discussion_summary(chat_id, time_period))
+            with usage_scope(chat_id=chat_id):
+                asyncio.create_task(iterative_discussion_summary(chat_id, time_period))
             
             logger.info(f"Started iterative discussion summary for chat_id={chat_id}, period={time_period}")
             
@@ -640,6 +732,47 @@ async def cmd_discussion_summary(message: types.Message):
         logger.error(f"Error in discussion summary command: {str(e)}")
         await message.reply(f"Error starting discussion summary: {str(e)}")
 
+@dp.message(Command("usage"))
+async def cmd_usage(message: types.Message):
+    """Show LLM token usage and estimated cost, and today's budgets"""
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    try:
+        days = 1
+        group_by = "feature"
+        for arg in message.text.split()[1:]:
+            if arg.isdigit():
+                days = max(int(arg), 1)
+            elif arg in ("feature", "call_site", "chat", "model", "day"):
+                group_by = arg
+        since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+        rows = await get_llm_usage_report(since, group_by=group_by)
+        period = "today (UTC)" if days == 1 else f"last {days} days"
+        response = [f"💰 <b>LLM usage by {group_by}, {period}</b>\n"]
+        if not rows:
+            response.append("No LLM requests recorded.")
+        for row in rows:
+            response.append(
+                f"• <b>{row['key']}</b>: {row['total_tokens']:,} tokens in {row['requests']} requests "
+                f"({row['cached_tokens']:,} cached), ${row['cost']:.4f}"
+            )
+        if rows:
+            response.append(
+                f"\n<b>Total:</b> {sum(r['total_tokens'] for r in rows):,} tokens, ${sum(r['cost'] for r in rows):.4f}"
+            )
+        status = await get_budget_status()
+        budgets = [(feature, state) for feature, state in status["features"].items() if state["budget"]]
+        if budgets or status["chats"]:
+            response.append("\n<b>Today's budgets</b>")
+        for feature, state in budgets:
+            response.append(f"• {feature}: {state['used']:,} / {state['budget']:,} tokens ({state['used'] / state['budget']:.0%})")
+        for chat_id, state in list(status["chats"].items())[:5]:
+            if state["budget"]:
+                response.append(f"• chat {chat_id}: {state['used']:,} / {state['budget']:,} tokens")
+        await message.reply("\n".join(response), parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Error building usage report: {str(e)}", exc_info=True)
+        await message.reply(f"Error building usage report: {str(e)}")
 @dp.callback_query(lambda c: c.data.startswith(("summarize_chat:", "change_period:", "try_different_period", "retry_", "continue_", "accept_", "refine_")))
 async def summary_callback_handler(callback_query: types.CallbackQuery):
     """Handle callbacks for the iterative discussion summary feature"""
@@ -857,6 +990,34 @@ async def process_refinement_input(message: types.Message, state: FSMContext):
         # TODO: Process the refinement in the ongoing summary analysis
         logger.info(f"Received summary refinement: {user_input}")
 
+async def analyze_intent_with_history(text: str, chat_id: int) -> Dict[str, Any]:
+    """Fetch recent chat history and analyze the intent of a message"""
+    recent_messages = await get_recent_chat_messages(chat_id, limit=10)
+    return await analyze_message_intent(text, recent_messages)
+# Used when intent analysis failed: no task flow, straight to the context processor
+NO_INTENT = {
+    "task_creation_score": 0,
+    "task_candidate_score": 0,
+    "database_query_score": 0,
+    "primary_intent": "other",
+    "task_title": "",
+    "task_description": ""
+}
+def _task_result(task: asyncio.Task) -> Optional[Any]:
+    """Result of a finished speculative task, or None if it was cancelled or raised"""
+    if task.cancelled():
+        return None
+    if task.exception() is not None:
+        logger.error(f"Speculative task failed: {str(task.exception())}", exc_info=task.exception())
+        return None
+    return task.result()
+def is_task_intent(intent_analysis: Dict[str, Any]) -> bool:
+    """Whether intent analysis is confident the message asks for, or describes, a task"""
+    if intent_analysis['primary_intent'] == 'task_creation':
+        return intent_analysis['task_creation_score'] >= 7
+    if intent_analysis['primary_intent'] == 'task_candidate':
+        return intent_analysis['task_candidate_score'] >= 7
+    return False
 @dp.message()
 async def handle_message(message: types.Message):
     """Process regular messages"""
@@ -993,6 +1154,7 @@ async def handle_message(message: types.Message):
     
     # Process message using intent detection
     if message.text:
+        speculative_tasks = []
         # Get recent message history for context
         try:
             from telegram_ai_assistant.utils.db_utils import get_recent_chat_messages, execute_sql_query
@@ -1003,14 +1165,37 @@ async def handle_message(message: types.Message):
             # Generate SQL directly for common database queries
             processing_msg = await message.reply("Анализирую...")
             
+            # 0. Common analytics questions are answered by precompiled queries without the LLM
+            routed = await route_question(message.text)
+            if routed:
+                await processing_msg.edit_text(routed["answer"], parse_mode="HTML")
+                return
+            
             # Determine if this is a database query
             from telegram_ai_assistant.ai_module.ai_analyzer import generate_sql_from_question
             
-            # 1. Try to generate SQL query directly
-            sql_response = await generate_sql_from_question(message.text)
+            # 1. SQL generation, intent analysis and the chat list fetch run speculatively in parallel.
+            # Whichever of SQL generation and intent analysis decides the path first wins and the
+            # other one is cancelled, so a task request does not wait for SQL generation and vice versa.
+            sql_task = asyncio.create_task(generate_sql_from_question(message.text))
+            intent_task = asyncio.create_task(analyze_intent_with_history(message.text, message.chat.id))
+            chats_task = asyncio.create_task(get_user_chats())
+            speculative_tasks = [sql_task, intent_task, chats_task]
+            
+            done, _ = await asyncio.wait({sql_task, intent_task}, return_when=asyncio.FIRST_COMPLETED)
+            early_intent = _task_result(intent_task) if sql_task not in done else None
+            if early_intent and is_task_intent(early_intent):
+                logger.info("Intent analysis finished first with a task request, cancelling SQL generation")
+                sql_task.cancel()
+                sql_response = None
+            else:
+                await asyncio.wait({sql_task})
+                sql_response = _task_result(sql_task)
             
             # Check if we have a valid SQL query
             if sql_response and "sql_query" in sql_response and sql_response["sql_query"].strip():
+                # The SQL route won: stop paying for intent analysis while the query runs and is explained
+                intent_task.cancel()
                 sql_query = sql_response["sql_query"]
                 explanation = sql_response.get("explanation", "Выполняю SQL запрос")
                 
@@ -1028,7 +1213,11 @@ async def handle_message(message: types.Message):
                 # Execute the query
                 try:
                     logger.info("Executing SQL query...")
-                    query_result = await execute_sql_query(sql_query)
+                    if sql_response.get("cached"):
+                        # The cached template was already executed to validate it
+                        query_result = sql_response["result"]
+                    else:
+                        query_result = await execute_sql_query(sql_query, sql_response.get("sql_params"))
                     
                     # Format results for display
                     if query_result:
@@ -1045,11 +1234,12 @@ async def handle_message(message: types.Message):
                                 columns = list(query_result[0].keys())
                                 
                                 # Create a response with the query results
-                                result_text = await client.chat.completions.create(
+                                result_text = await chat_completion(
+                                    "handle_message.explain_result",
                                     model=OPENAI_MODEL,
                                     messages=[
                                         {"role": "system", "content": "Ты аналитик данных. Твоя задача объяснить результаты SQL запроса кратко и понятно. Не упоминай SQL или запросы в ответе, просто интерпретируй данные как обычный человек. Используй факты из данных, не придумывай информацию."},
-                                        {"role": "user", "content": f"Вопрос пользователя: {message.text}\n\nРезультаты запроса ({len(query_result)} строк):\n{json.dumps(query_result, indent=2, ensure_ascii=False)}\n\nДай лаконичное объяснение этих данных на русском языке, не упоминая сам SQL запрос."}
+                                        {"role": "user", "content": f"Вопрос пользователя: {message.text}\n\nРезультаты запроса ({len(query_result)} строк):\n{format_result_for_prompt(query_result)}\n\nДай лаконичное объяснение этих данных на русском языке, не упоминая сам SQL запрос."}
                                     ]
                                 )
                                 
@@ -1057,7 +1247,8 @@ async def handle_message(message: types.Message):
                                 await processing_msg.edit_text(response_text)
                             else:
                                 # Single row result
-                                result_text = await client.chat.completions.create(
+                                result_text = await chat_completion(
+                                    "handle_message.explain_result",
                                     model=OPENAI_MODEL,
                                     messages=[
                                         {"role": "system", "content": "Ты аналитик данных. Твоя задача объяснить результаты SQL запроса кратко и понятно. Не упоминай SQL или запросы в ответе, просто интерпретируй данные как обычный человек. Используй факты из данных, не придумывай информацию."},
@@ -1078,11 +1269,12 @@ async def handle_message(message: types.Message):
                     # If SQL execution fails, fallback to context processor
             
             # 2. Fallback to analyze_message_intent for task creation/candidates
-            # Get recent messages for context analysis
-            recent_messages = await get_recent_chat_messages(message.chat.id, limit=10)
-            
-            # Analyze message intent
-            intent_analysis = await analyze_message_intent(message.text, recent_messages)
+            if intent_task.cancelled():
+                # Cancelled when SQL generation won, but executing that query failed
+                intent_task = asyncio.create_task(analyze_intent_with_history(message.text, message.chat.id))
+                speculative_tasks.append(intent_task)
+            await asyncio.wait({intent_task})
+            intent_analysis = _task_result(intent_task) or NO_INTENT
             
             logger.info(f"Message intent analysis: task_creation={intent_analysis['task_creation_score']}, "
                         f"task_candidate={intent_analysis['task_candidate_score']}, "
@@ -1179,21 +1371,23 @@ async def handle_message(message: types.Message):
                 return
                 
             # 3. Final fallback - process with context processor
-            available_chats = await get_user_chats()
+            available_chats = await chats_task
             
             # Process with context processor
             await processing_msg.edit_text("Анализирую вопрос...")
             
+            writer = TelegramStreamWriter(bot, processing_msg.chat.id, processing_msg.message_id)
             result = await process_question_with_context(
                 question=message.text, 
                 chat_id=message.chat.id, 
-                available_chats=available_chats
+                available_chats=available_chats,
+                stream_writer=writer
             )
             
             # Update message with result
             logger.info("Получен ответ с контекстом, обновляем сообщение")
             if "answer" in result:
-                await processing_msg.edit_text(result["answer"])
+                await writer.finish(result["answer"], parse_mode="HTML")
             else:
                 logger.warning("Missing 'answer' key in context processor result")
                 await processing_msg.edit_text("Не удалось сформировать ответ на ваш вопрос. Пожалуйста, уточните запрос.")
@@ -1201,6 +1395,11 @@ async def handle_message(message: types.Message):
         except Exception as e:
             logger.error(f"Error processing message: {str(e)}")
             await message.reply(f"Произошла ошибка при обработке сообщения: {str(e)}")
+        finally:
+            # Cancel speculative work whose result was not needed
+            for task in speculative_tasks:
+                if not task.done():
+                    task.cancel()
 @dp.callback_query(lambda c: c.data.startswith('respond_'))
 async def callback_respond(callback_query: types.CallbackQuery):
     """Handle respond button click for unanswered questions"""
@@ -1399,6 +1598,8 @@ async def cmd_ai_agent(message: types.Message):
             return
         
         question = command_parts[1].strip()
+        if await reject_if_over_budget(message, "agent"):
+            return
         
         # Let the user know we're starting the autonomous reasoning process
         await message.reply(
@@ -1407,7 +1608,7 @@ async def cmd_ai_agent(message: types.Message):
         )
         
         # Start the autonomous agent
-        asyncio.create_task(ai_agent_query(question))
+        asyncio.create_task(with_deadline(ai_agent_query(question), INTERACTIVE_DEADLINE))
         
         logger.info(f"Started autonomous AI agent for question: {question[:50]}...")
         
@@ -1499,9 +1700,13 @@ async def start_bot():
     logger.info("Initializing database...")
     init_db()
     
+    # Render the schema prompt once so every SQL prompt starts with the same cached prefix
+    get_schema_prompt()
+    
     # Start the reminder checker as a background task
     logger.info("Starting background tasks")
     asyncio.create_task(check_reminders_periodically())
+    asyncio.create_task(refresh_summaries_periodically())
     
     # Start polling
     logger.info("Starting bot polling")
@@ -6,6 +6,7 @@ TELEGRAM_API_ID = int(os.getenv("TELEGRAM_API_ID", ""))
 TELEGRAM_API_HASH = os.getenv("TELEGRAM_API_HASH", "")
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 USERBOT_SESSION = os.getenv("USERBOT_SESSION", "user_session")
+USERBOT_SESSION_STRING = os.getenv("USERBOT_SESSION_STRING", "")
 MONITORED_CHATS = json.loads(os.getenv("MONITORED_CHATS", "[]")) 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "o3-mini")
@@ -15,5 +16,51 @@ DB_URI = os.getenv("DB_URI", "sqlite:///telegram_assistant.db")
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", ""))
 REMINDER_INTERVAL = int(os.getenv("REMINDER_INTERVAL", "3600"))
 SUMMARY_HOUR = int(os.getenv("SUMMARY_HOUR", "18"))
+SUMMARY_REFRESH_INTERVAL = int(os.getenv("SUMMARY_REFRESH_INTERVAL", "1800"))
+SUMMARY_FOLD_BATCH_SIZE = int(os.getenv("SUMMARY_FOLD_BATCH_SIZE", "200"))
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "5"))
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+SQL_CACHE_SIMILARITY = float(os.getenv("SQL_CACHE_SIMILARITY", "0.9"))
+AGENT_QUERY_CONCURRENCY = int(os.getenv("AGENT_QUERY_CONCURRENCY", "4"))
+RESULT_RAW_ROWS = int(os.getenv("RESULT_RAW_ROWS", "20"))
+RESULT_SAMPLE_ROWS = int(os.getenv("RESULT_SAMPLE_ROWS", "10"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+LLM_HEDGE_MAX_RATIO = float(os.getenv("LLM_HEDGE_MAX_RATIO", "0.05"))
+INTERACTIVE_DEADLINE = float(os.getenv("INTERACTIVE_DEADLINE", "90"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "60"))
+REPROCESS_INTERVAL = int(os.getenv("REPROCESS_INTERVAL", "60"))
+REPROCESS_RATE_PER_MINUTE = int(os.getenv("REPROCESS_RATE_PER_MINUTE", "20"))
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "200"))
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "3"))
+BACKFILL_WAIT_TIME = float(os.getenv("BACKFILL_WAIT_TIME", "1"))
+SYNC_STATE_FLUSH_INTERVAL = int(os.getenv("SYNC_STATE_FLUSH_INTERVAL", "30"))
+RECENT_MESSAGE_IDS_SIZE = int(os.getenv("RECENT_MESSAGE_IDS_SIZE", "10000"))
+ANALYSIS_BATCH_SIZE = int(os.getenv("ANALYSIS_BATCH_SIZE", "50"))
+ANALYSIS_FLUSH_INTERVAL = float(os.getenv("ANALYSIS_FLUSH_INTERVAL", "5"))
+DUPLICATE_WINDOW_HOURS = float(os.getenv("DUPLICATE_WINDOW_HOURS", "24"))
+DUPLICATE_WINDOW_SIZE = int(os.getenv("DUPLICATE_WINDOW_SIZE", "5000"))
+DUPLICATE_MAX_DISTANCE = int(os.getenv("DUPLICATE_MAX_DISTANCE", "6"))
+DUPLICATE_MIN_LENGTH = int(os.getenv("DUPLICATE_MIN_LENGTH", "40"))
+LINK_FETCH_CONCURRENCY = int(os.getenv("LINK_FETCH_CONCURRENCY", "5"))
+LINK_FETCH_TIMEOUT = float(os.getenv("LINK_FETCH_TIMEOUT", "10"))
+LINK_MAX_BYTES = int(os.getenv("LINK_MAX_BYTES", "1048576"))
+LINK_MAX_PER_MESSAGE = int(os.getenv("LINK_MAX_PER_MESSAGE", "3"))
+LINK_CACHE_SIZE = int(os.getenv("LINK_CACHE_SIZE", "500"))
+LINK_CACHE_TTL = int(os.getenv("LINK_CACHE_TTL", "3600"))
+LINK_CONTEXT_TOKENS = int(os.getenv("LINK_CONTEXT_TOKENS", "1500"))
+USAGE_CHAT_DAILY_TOKENS = int(os.getenv("USAGE_CHAT_DAILY_TOKENS", "0"))
+USAGE_FEATURE_DAILY_TOKENS = json.loads(os.getenv("USAGE_FEATURE_DAILY_TOKENS", "{}"))
+LLM_PRICES = json.loads(os.getenv("LLM_PRICES", "{}"))
+MEDIA_POLICIES = json.loads(os.getenv("MEDIA_POLICIES", "{}"))
+MEDIA_CHAT_POLICIES = json.loads(os.getenv("MEDIA_CHAT_POLICIES", "{}"))
+MEDIA_EAGER_MAX_BYTES = int(os.getenv("MEDIA_EAGER_MAX_BYTES", "10485760"))
+MEDIA_DOWNLOAD_CONCURRENCY = int(os.getenv("MEDIA_DOWNLOAD_CONCURRENCY", "3"))
+MEDIA_QUOTA_BYTES = int(os.getenv("MEDIA_QUOTA_BYTES", "2147483648"))
+MEDIA_MAX_AGE_DAYS = float(os.getenv("MEDIA_MAX_AGE_DAYS", "30"))
+MEDIA_JANITOR_INTERVAL = int(os.getenv("MEDIA_JANITOR_INTERVAL", "3600"))
+VISION_MAX_DIMENSION = int(os.getenv("VISION_MAX_DIMENSION", "1536"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
 DOWNLOADS_DIR = os.getenv("DOWNLOADS_DIR", "downloads")
 os.makedirs(DOWNLOADS_DIR, exist_ok=True) 
\ No newline at end of file
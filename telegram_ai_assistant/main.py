@@ -28,6 +28,20 @@ async def run_bot():
     logger.info("Starting Telegram bot...")
     from telegram_ai_assistant.bot.telegram_bot import start_bot
     await start_bot()
+async def run_backfill(chats=None, days=None, analyze=False):
+    """Import the message history of monitored chats"""
+    logger.info("Starting history backfill...")
+    init_db()
+    from telegram_ai_assistant.userbot.telegram_client import client
+    from telegram_ai_assistant.userbot.backfill import backfill
+    await client.connect()
+    try:
+        if not await client.is_user_authorized():
+            logger.error("User is not authorized. Please run the authentication script first.")
+            return
+        await backfill(client, chats=chats, days=days, analyze=analyze)
+    finally:
+        await client.disconnect()
 async def run_all():
     """Run both userbot and bot together"""
     logger.info("Initializing database...")
@@ -37,8 +51,11 @@ async def run_all():
     await asyncio.gather(userbot_task, bot_task)
 def main():
     parser = argparse.ArgumentParser(description='Telegram AI Assistant')
-    parser.add_argument('--mode', type=str, choices=['all', 'userbot', 'bot'], 
+    parser.add_argument('--mode', type=str, choices=['all', 'userbot', 'bot', 'backfill'], 
                         default='all', help='Which components to run')
+    parser.add_argument('--chats', type=int, nargs='*', help='Chat IDs to backfill (default: MONITORED_CHATS or all dialogs)')
+    parser.add_argument('--days', type=int, help='Backfill only the last N days')
+    parser.add_argument('--analyze', action='store_true', help='Queue backfilled messages for analysis at the reprocessing rate')
     parser.add_argument('--debug', action='store_true', help='Enable debug logging')
     args = parser.parse_args()
     if args.debug:
@@ -55,6 +72,9 @@ def main():
         elif args.mode == 'bot':
             logger.info("Running only bot")
             asyncio.run(run_bot())
+        elif args.mode == 'backfill':
+            logger.info("Running history backfill")
+            asyncio.run(run_backfill(chats=args.chats, days=args.days, analyze=args.analyze))
     except KeyboardInterrupt:
         logger.info("Received keyboard interrupt, shutting down...")
     except Exception as e:
@@ -0,0 +1,138 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+from telethon import errors
+from telegram_ai_assistant.config import MONITORED_CHATS, BACKFILL_BATCH_SIZE, BACKFILL_CONCURRENCY, BACKFILL_WAIT_TIME
+from telegram_ai_assistant.utils.db_utils import store_messages_batch, get_chat_sync_state, mark_backfill_completed
+from telegram_ai_assistant.utils.media_policy import describe_media
+from telegram_ai_assistant.utils.near_duplicates import simhash
+from telegram_ai_assistant.utils.logging_utils import setup_userbot_logger
+logger = setup_userbot_logger()
+def _display_name(entity) -> str:
+    if entity is None:
+        return ""
+    if getattr(entity, "title", None):
+        return entity.title
+    return f"{getattr(entity, 'first_name', '') or ''} {getattr(entity, 'last_name', '') or ''}".strip()
+def message_to_row(message, chat_id: int) -> Dict[str, Any]:
+    """Turn a Telethon message from the history into the row shape of store_messages_batch"""
+    text = message.raw_text or ""
+    sender = message.sender
+    attachment = describe_media(message, chat_id)
+    return {
+        "message_id": message.id,
+        "sender_id": message.sender_id or chat_id,
+        "sender_name": _display_name(sender) or f"User {message.sender_id}",
+        "text": text,
+        "attachments": [attachment] if attachment else [],
+        "timestamp": message.date,
+        "is_bot": bool(getattr(sender, "bot", False)),
+        "simhash": simhash(text),
+        "reply_to_message_id": message.reply_to_msg_id
+    }
+async def import_history(client, entity, min_id: int, max_id: int = 0, since: Optional[datetime] = None,
+                         analyze: bool = False, checkpoint: str = "backfill_message_id",
+                         label: str = "Backfill") -> Dict[str, Any]:
+    """
+    Store the messages of a chat newer than min_id, oldest first, in batches
+    Each batch is saved together with the checkpoint, so an interrupted run resumes after the last batch.
+    Args:
+        client: Connected Telethon client
+        entity: Chat entity
+        min_id: Only fetch messages newer than this ID
+        max_id: Only fetch messages older than this ID; 0 for no limit
+        since: Skip messages older than this
+        analyze: Queue imported messages for the reprocessing job, which analyzes them at its own rate
+        checkpoint: store_messages_batch argument the checkpoint is saved as
+        label: Name of the run in log messages
+    Returns:
+        Dict with chat_id, chat_name, fetched and inserted counts
+    """
+    chat_id = entity.id
+    chat_name = _display_name(entity) or str(chat_id)
+    result = {"chat_id": chat_id, "chat_name": chat_name, "fetched": 0, "inserted": 0}
+    started = time.monotonic()
+    while True:
+        batch: List[Dict[str, Any]] = []
+        last_id = min_id
+        try:
+            async for message in client.iter_messages(
+                entity, reverse=True, min_id=min_id, max_id=max_id, offset_date=since, wait_time=BACKFILL_WAIT_TIME
+            ):
+                last_id = message.id
+                result["fetched"] += 1
+                # Service messages and the account's own messages are not ingested live either
+                if not message.action and not message.out:
+                    batch.append(message_to_row(message, chat_id))
+                if len(batch) >= BACKFILL_BATCH_SIZE:
+                    result["inserted"] += await store_messages_batch(
+                        chat_id, chat_name, batch, analysis_pending=analyze, **{checkpoint: last_id}
+                    )
+                    min_id = last_id
+                    batch = []
+                    elapsed = max(time.monotonic() - started, 0.001)
+                    logger.info(
+                        f"{label} of {chat_name}: {result['fetched']} fetched, {result['inserted']} new, "
+                        f"{result['fetched'] / elapsed:.0f} messages/s, at message {min_id}"
+                    )
+            if last_id != min_id:
+                result["inserted"] += await store_messages_batch(
+                    chat_id, chat_name, batch, analysis_pending=analyze, **{checkpoint: last_id}
+                )
+            break
+        except errors.FloodWaitError as e:
+            # Longer waits than the client's flood_sleep_threshold surface here; the unsaved batch is fetched again
+            logger.warning(f"Flood wait of {e.seconds} seconds during {label.lower()} of {chat_name}, resuming after message {min_id}")
+            await asyncio.sleep(e.seconds)
+    logger.info(
+        f"{label} of {chat_name} complete: {result['fetched']} fetched, {result['inserted']} new "
+        f"in {time.monotonic() - started:.0f}s"
+    )
+    return result
+async def backfill_chat(client, chat, since: Optional[datetime] = None, analyze: bool = False) -> Dict[str, Any]:
+    """
+    Import the history of a chat, oldest first, resuming after the last stored checkpoint
+    Args:
+        client: Connected Telethon client
+        chat: Chat ID, username or entity
+        since: Skip messages older than this
+        analyze: Queue imported messages for the reprocessing job, which analyzes them at its own rate
+    Returns:
+        Dict with chat_id, chat_name, fetched and inserted counts
+    """
+    entity = await client.get_entity(chat)
+    state = await get_chat_sync_state(entity.id)
+    checkpoint = state["backfill_message_id"] if state else 0
+    logger.info(f"Backfilling {_display_name(entity) or entity.id} ({entity.id}) after message {checkpoint}")
+    result = await import_history(client, entity, checkpoint, since=since, analyze=analyze)
+    await mark_backfill_completed(entity.id)
+    return result
+async def backfill(client, chats: Optional[List[Any]] = None, days: Optional[int] = None, analyze: bool = False) -> List[Dict[str, Any]]:
+    """
+    Import the history of several chats concurrently, BACKFILL_CONCURRENCY at a time
+    Args:
+        client: Connected Telethon client
+        chats: Chats to import; defaults to MONITORED_CHATS, or every dialog when that is empty
+        days: Only import messages of the last N days
+        analyze: Queue imported messages for analysis by the reprocessing job
+    Returns:
+        Per-chat results of the chats that were imported without errors
+    """
+    if not chats:
+        chats = MONITORED_CHATS or [dialog.entity async for dialog in client.iter_dialogs()]
+    since = datetime.now(timezone.utc) - timedelta(days=days) if days else None
+    semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+    async def run(chat):
+        async with semaphore:
+            try:
+                return await backfill_chat(client, chat, since=since, analyze=analyze)
+            except Exception as e:
+                logger.error(f"Error backfilling chat {getattr(chat, 'id', chat)}: {str(e)}", exc_info=True)
+                return None
+    results = [result for result in await asyncio.gather(*(run(chat) for chat in chats)) if result]
+    logger.info(
+        f"Backfill finished for {len(results)}/{len(chats)} chats: "
+        f"{sum(result['inserted'] for result in results)} new messages"
+    )
+    return results
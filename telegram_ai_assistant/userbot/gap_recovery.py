@@ -0,0 +1,116 @@
+import asyncio
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+from telegram_ai_assistant.config import MONITORED_CHATS, BACKFILL_CONCURRENCY, SYNC_STATE_FLUSH_INTERVAL
+from telegram_ai_assistant.utils.db_utils import get_chat_sync_states, save_last_seen_message_ids
+from telegram_ai_assistant.userbot.backfill import import_history
+from telegram_ai_assistant.utils.logging_utils import setup_userbot_logger
+logger = setup_userbot_logger()
+# Newest message received live per chat in this session: chat_id -> (peer_id, message_id)
+_last_seen: Dict[int, Tuple[int, int]] = {}
+_dirty: Set[int] = set()
+_semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+_pending_ranges: Set[Tuple[int, int, int]] = set()
+_dialogs_loaded = False
+_stats: Dict[str, Any] = {"catch_up_runs": 0, "gaps_detected": 0, "messages_recovered": 0, "last_catch_up": None}
+def note_message(chat_id: int, peer_id: int, message_id: int, is_channel: bool = False) -> Optional[Tuple[int, int]]:
+    """
+    Record a message received live
+    Channels and supergroups number their messages consecutively, so a jump in IDs there means updates
+    were lost, e.g. across a reconnect. Other chats share the account-wide numbering and cannot be checked.
+    Args:
+        chat_id: Chat ID
+        peer_id: Marked peer ID of the chat
+        message_id: Telegram message ID
+        is_channel: Whether the chat is a channel or supergroup
+    Returns:
+        (min_id, max_id) of the missing range, or None
+    """
+    previous = _last_seen.get(chat_id)
+    if previous and message_id <= previous[1]:
+        return None
+    _last_seen[chat_id] = (peer_id, message_id)
+    _dirty.add(chat_id)
+    if previous and is_channel and message_id > previous[1] + 1:
+        _stats["gaps_detected"] += 1
+        return previous[1], message_id
+    return None
+async def flush_last_seen():
+    """Persist the newest message per chat seen since the last flush"""
+    if not _dirty:
+        return
+    chat_ids = list(_dirty)
+    _dirty.clear()
+    await save_last_seen_message_ids({chat_id: _last_seen[chat_id] for chat_id in chat_ids})
+async def flush_last_seen_periodically():
+    """Persist the newest message per chat every SYNC_STATE_FLUSH_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(SYNC_STATE_FLUSH_INTERVAL)
+        try:
+            await flush_last_seen()
+        except Exception as e:
+            logger.error(f"Error saving last seen message IDs: {str(e)}", exc_info=True)
+async def _resolve(client, peer_id: int):
+    """Entity of a chat; after a restart the session may only know it once the dialogs are loaded"""
+    global _dialogs_loaded
+    try:
+        return await client.get_entity(peer_id)
+    except ValueError:
+        if _dialogs_loaded:
+            raise
+        _dialogs_loaded = True
+        await client.get_dialogs()
+        return await client.get_entity(peer_id)
+async def recover_range(client, peer_id: int, min_id: int, max_id: int = 0) -> Optional[Dict[str, Any]]:
+    """
+    Fetch the messages of a chat between min_id and max_id (exclusive, 0 for up to the newest)
+    They are stored and queued for the reprocessing job, so they are analyzed at REPROCESS_RATE_PER_MINUTE
+    instead of competing with live messages.
+    Returns:
+        Result of import_history, or None if the chat could not be fetched
+    """
+    key = (peer_id, min_id, max_id)
+    if key in _pending_ranges:
+        return None
+    _pending_ranges.add(key)
+    try:
+        async with _semaphore:
+            entity = await _resolve(client, peer_id)
+            result = await import_history(
+                client, entity, min_id, max_id=max_id, analyze=True,
+                checkpoint="last_seen_message_id", label="Catch-up"
+            )
+        _stats["messages_recovered"] += result["inserted"]
+        return result
+    except Exception as e:
+        logger.error(f"Error recovering messages {min_id}-{max_id or 'newest'} of chat {peer_id}: {str(e)}", exc_info=True)
+        return None
+    finally:
+        _pending_ranges.discard(key)
+async def catch_up(client, states: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """
+    Fetch what every known chat received after its last seen message, e.g. while the userbot was down
+    Args:
+        client: Connected Telethon client
+        states: Sync states read before live handling started; read now if not given
+    Returns:
+        Per-chat results of the chats that were caught up
+    """
+    if states is None:
+        await flush_last_seen()
+        states = await get_chat_sync_states()
+    states = [state for state in states if state["peer_id"] and state["last_seen_message_id"]]
+    if MONITORED_CHATS:
+        states = [state for state in states if state["peer_id"] in MONITORED_CHATS or state["chat_id"] in MONITORED_CHATS]
+    logger.info(f"Catching up on {len(states)} chats")
+    results = await asyncio.gather(*(
+        recover_range(client, state["peer_id"], state["last_seen_message_id"]) for state in states
+    ))
+    results = [result for result in results if result]
+    _stats["catch_up_runs"] += 1
+    _stats["last_catch_up"] = datetime.utcnow().isoformat()
+    logger.info(f"Catch-up finished: {sum(result['inserted'] for result in results)} missed messages recovered")
+    return results
+def get_gap_recovery_stats() -> Dict[str, Any]:
+    """Return gap recovery counters since startup"""
+    return dict(_stats, chats_tracked=len(_last_seen))
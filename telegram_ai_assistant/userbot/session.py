@@ -0,0 +1,54 @@
+import os
+from typing import List
+from telethon.sessions import SQLiteSession, StringSession
+from telegram_ai_assistant.config import USERBOT_SESSION, USERBOT_SESSION_STRING, MONITORED_CHATS
+from telegram_ai_assistant.utils.logging_utils import setup_userbot_logger
+logger = setup_userbot_logger()
+def build_session() -> SQLiteSession:
+    """
+    Open the userbot's SQLite session file (USERBOT_SESSION.session)
+    Telethon keeps the entities and access hashes it sees in this file, so chats and senders resolve
+    from disk after a restart. A USERBOT_SESSION_STRING is imported into a new session file once;
+    an existing file always wins, since it already holds the authorization.
+    """
+    session = SQLiteSession(USERBOT_SESSION)
+    if session.auth_key is None and USERBOT_SESSION_STRING:
+        string_session = StringSession(USERBOT_SESSION_STRING)
+        session.set_dc(string_session.dc_id, string_session.server_address, string_session.port)
+        session.auth_key = string_session.auth_key
+        session.save()
+        logger.info(f"Imported USERBOT_SESSION_STRING into session file {session.filename}")
+    elif session.auth_key is None:
+        logger.warning(f"Session file {session.filename} is not authorized yet, run utils/create_session.py first")
+    return session
+async def preload_dialogs(client) -> List[int]:
+    """
+    Make sure every monitored chat can be resolved without an API call
+    Chats missing from the session's entity cache are filled in with a single dialog listing, which is
+    only needed on the first start or after joining new chats.
+    Returns:
+        Monitored chat IDs that could not be resolved
+    """
+    if not MONITORED_CHATS:
+        return []
+    missing = []
+    for chat in MONITORED_CHATS:
+        try:
+            await client.get_input_entity(chat)
+        except ValueError:
+            missing.append(chat)
+    if not missing:
+        logger.info(f"All {len(MONITORED_CHATS)} monitored chats resolved from the session cache")
+        return []
+    logger.info(f"{len(missing)} monitored chats are not in the session cache, loading dialogs")
+    dialogs = await client.get_dialogs()
+    unresolved = []
+    for chat in missing:
+        try:
+            await client.get_input_entity(chat)
+        except ValueError:
+            unresolved.append(chat)
+    logger.info(f"Loaded {len(dialogs)} dialogs into the session cache")
+    if unresolved:
+        logger.warning(f"Monitored chats not found among the dialogs of this account: {unresolved}")
+    return unresolved
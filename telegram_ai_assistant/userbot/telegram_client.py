@@ -4,23 +4,58 @@ import json
 import asyncio
 import re
 from telethon import TelegramClient, events
-from telethon.sessions import StringSession
-from datetime import datetime
+from telethon.utils import resolve_id
+from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
 from utils.logging_utils import setup_userbot_logger
 logger = setup_userbot_logger()
-from telegram_ai_assistant.config import TELEGRAM_API_ID, TELEGRAM_API_HASH, USERBOT_SESSION, MONITORED_CHATS, DOWNLOADS_DIR, ADMIN_USER_ID
-from utils.db_utils import store_message, store_unanswered_question, mark_question_as_answered
-from ai_module.ai_analyzer import analyze_message, detect_question_target, extract_task_from_message
+from telegram_ai_assistant.config import TELEGRAM_API_ID, TELEGRAM_API_HASH, USERBOT_SESSION, MONITORED_CHATS, DOWNLOADS_DIR, ADMIN_USER_ID, REPROCESS_INTERVAL, REPROCESS_RATE_PER_MINUTE, DUPLICATE_WINDOW_HOURS, DUPLICATE_WINDOW_SIZE
+from utils.db_utils import (
+    store_message,
+    store_unanswered_question,
+    mark_question_as_answered,
+    mark_message_analysis_pending,
+    clear_message_analysis_pending,
+    get_pending_analysis_messages,
+    record_message_duplicate,
+    get_recent_message_fingerprints,
+    update_message_text,
+    mark_messages_deleted,
+    get_message_analysis_state
+)
+from ai_module.ai_analyzer import analyze_message, detect_question_target, extract_task_from_message, ANALYSIS_PROMPT_VERSION
+from telegram_ai_assistant.ai_module.llm_gateway import llm_available, is_outage_error
+from telegram_ai_assistant.ai_module.link_extractor import close_link_client
+from telegram_ai_assistant.ai_module.usage_tracker import usage_scope, exhausted_budget, exhausted_chats
+from telegram_ai_assistant.utils.media_policy import describe_media, materialize_attachments, load_media_buffers, fetch_analysis_images
+from telegram_ai_assistant.utils.media_store import find_media_duplicate, remember_media_analysis
+from telegram_ai_assistant.utils.media_janitor import media_janitor_periodically
+from telegram_ai_assistant.utils.db_utils import get_chat_sync_states
+from telegram_ai_assistant.userbot.session import build_session, preload_dialogs
+from telegram_ai_assistant.userbot.gap_recovery import (
+    note_message,
+    recover_range,
+    catch_up,
+    flush_last_seen,
+    flush_last_seen_periodically
+)
+from telegram_ai_assistant.utils.analysis_writer import (
+    queue_analysis_result,
+    discard_analysis_result,
+    is_message_analyzed,
+    flush_analysis_results,
+    flush_analysis_results_periodically
+)
+from telegram_ai_assistant.utils.near_duplicates import simhash, find_duplicate, remember_analysis, load_window, forget_messages
+from telegram_ai_assistant.utils.recent_messages import seen_recently, remember_message
 from linear_integration.linear_client import LinearClient
 from utils.task_utils import handle_potential_task
 from utils.message_handler import process_new_message
-SESSION_STRING = "1ApWapzMBuy6sUBC3Q4jWi1w0zcoyXB5jR93dluQ9uVrg4M3cdz3Vsvcyh5Uz1asAyVnlnXHqpFf35MDr7-WQuMoGAzUQUmn29MxzZndcIMcTLVfviRGHnUsOFULzNozRh20aiFnxCdGPu06WLwJocCH3SwRXLY4Ha930QJV17RFTXV8LOYwkbD3yTg-H_1_wZtwjt4Q54aiu6eFU79jicj8NJunrGKMfAz66HYZwLjXRQOnRzerkJctfIyZl8sJYeJuL5KKSvYGT_9qWj_tgnyjF8TOOHmTbH8lf80jqVe6I78REYhwCNrnbh44sNdD1ePwHsDTeYEIJVcDYYMVqTjg_kEuO7Bo="
 client = TelegramClient(
-    StringSession(SESSION_STRING), 
+    build_session(), 
     TELEGRAM_API_ID, 
     TELEGRAM_API_HASH,
     device_model="Desktop",
@@ -60,103 +95,203 @@ async def send_important_notification(message_data: Dict[str, Any]):
     except Exception as e:
         logger.error(f"Error sending important message notification: {str(e)}", exc_info=True)
 
+def _chat_type(chat) -> str:
+    if getattr(chat, "megagroup", False):
+        return "group"
+    if getattr(chat, "broadcast", False) or getattr(chat, "gigagroup", False):
+        return "channel"
+    return "private"
+async def _get_replied_message(event) -> Optional[Dict[str, Any]]:
+    if not getattr(event, "reply_to", None):
+        return None
+    try:
+        reply_msg = await event.get_reply_message()
+        if reply_msg:
+            reply_sender = await reply_msg.get_sender()
+            logger.debug(f"This message is a reply to message {reply_msg.id}")
+            return {
+                "message_id": reply_msg.id,
+                "sender_id": reply_sender.id if reply_sender else None,
+                "text": reply_msg.text
+            }
+    except Exception as e:
+        logger.error(f"Error getting reply message details: {str(e)}")
+    return None
+async def _build_message_data(event, chat, sender, text: str, attachments: List[Dict[str, Any]], timestamp) -> Dict[str, Any]:
+    """Message in the shape used by the analysis pipeline"""
+    return {
+        "text": text,
+        "attachments": attachments,
+        "chat_id": chat.id,
+        "chat_name": getattr(chat, "title", str(chat.id)),
+        "chat_type": _chat_type(chat),
+        "message_id": event.id,
+        "sender_id": sender.id,
+        "sender_name": f"{getattr(sender, 'first_name', '') or ''} {getattr(sender, 'last_name', '') or ''}".strip(),
+        "is_bot": getattr(sender, "bot", False),
+        "timestamp": timestamp.isoformat(),
+        "simhash": simhash(text),
+        "original_event": event,
+        "replied_message": await _get_replied_message(event)
+    }
 async def process_new_message(event):
     """Process a new message from Telegram and perform AI analysis."""
     try:
+        if seen_recently(event.chat_id, event.id):
+            logger.debug(f"Message {event.id} of chat {event.chat_id} was already received, skipping")
+            return
         sender = await event.get_sender()
         chat = await event.get_chat()
-        if sender.id == (await client.get_me()).id:
+        # Before the own-message check, since the account's own messages also advance the IDs of a group
+        gap = note_message(chat.id, event.chat_id, event.id, is_channel=event.is_channel)
+        if gap:
+            logger.info(f"Messages {gap[0] + 1}-{gap[1] - 1} of chat {chat.id} were not received, fetching them")
+            asyncio.create_task(recover_range(client, event.chat_id, *gap))
+        # The self peer is cached by the client after login, so this costs no API call per message
+        if sender.id == (await client.get_me(input_peer=True)).user_id:
             return
         text = event.raw_text
         message_id = event.id
         logger.debug(f"New message received: chat_id={chat.id}, message_id={message_id}, text={text[:50]}...")
         
-        # Get chat type
-        chat_type = "private"
-        if hasattr(chat, "megagroup") and chat.megagroup:
-            chat_type = "group"
-        elif hasattr(chat, "broadcast") and chat.broadcast:
-            chat_type = "channel"
-        elif hasattr(chat, "gigagroup") and chat.gigagroup:
-            chat_type = "channel"
-        
-        # Check if this is a reply
-        replied_message = None
-        if hasattr(event, "reply_to") and event.reply_to:
-            try:
-                reply_msg = await event.get_reply_message()
-                if reply_msg:
-                    reply_sender = await reply_msg.get_sender()
-                    replied_message = {
-                        "message_id": reply_msg.id,
-                        "sender_id": reply_sender.id if reply_sender else None,
-                        "text": reply_msg.text
-                    }
-                    logger.debug(f"This message is a reply to message {replied_message['message_id']}")
-            except Exception as e:
-                logger.error(f"Error getting reply message details: {str(e)}")
-        
+        # Only the file reference is stored here; downloads run in the analysis task per media policy
         attachments = []
-        if event.media:
-            logger.debug(f"Message has media attachment")
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            file_path = os.path.join(DOWNLOADS_DIR, f"{timestamp}_{chat.id}_{message_id}")
-            downloaded_path = await client.download_media(event.media, file=file_path)
-            if downloaded_path:
-                logger.debug(f"Downloaded media to {downloaded_path}")
-                attachments.append(downloaded_path)
-            else:
-                logger.warning(f"Failed to download media for message {message_id}")
+        attachment = describe_media(event.message, chat.id)
+        if attachment:
+            logger.debug(f"Message has {attachment['kind']} attachment ({attachment['size']} bytes), policy {attachment['policy']}")
+            attachments.append(attachment)
         
-        chat_name = getattr(chat, "title", str(chat.id))
-        sender_name = f"{getattr(sender, 'first_name', '')} {getattr(sender, 'last_name', '')}".strip()
-        is_bot = getattr(sender, 'bot', False)
-        logger.info(f"Processing message from {sender_name} in {chat_name} (ID: {message_id}, is_bot: {is_bot})")
+        message_data = await _build_message_data(event, chat, sender, text, attachments, event.date)
+        logger.info(
+            f"Processing message from {message_data['sender_name']} in {message_data['chat_name']} "
+            f"(ID: {message_id}, is_bot: {message_data['is_bot']})"
+        )
         
-        await store_message(
+        stored_id = await store_message(
             chat_id=chat.id,
-            chat_name=chat_name,
+            chat_name=message_data["chat_name"],
             message_id=message_id,
             sender_id=sender.id,
-            sender_name=sender_name,
+            sender_name=message_data["sender_name"],
             text=text,
             attachments=attachments,
             timestamp=event.date,
-            is_bot=is_bot
+            is_bot=message_data["is_bot"],
+            simhash=message_data["simhash"],
+            reply_to_message_id=event.reply_to_msg_id
         )
         
-        logger.debug(f"Message {message_id} stored in database")
-        
-        message_data = {
-            "text": text,
-            "attachments": attachments,
-            "chat_id": chat.id,
-            "chat_name": chat_name,
-            "chat_type": chat_type,
-            "message_id": message_id,
-            "sender_id": sender.id,
-            "sender_name": sender_name,
-            "is_bot": is_bot,
-            "timestamp": event.date.isoformat(),
-            "original_event": event,
-            "replied_message": replied_message
-        }
+        remember_message(event.chat_id, message_id)
+        if stored_id is None:
+            # Stored earlier by a catch-up, backfill or an earlier delivery; analyze it only if none of them will
+            state = await get_message_analysis_state(chat.id, message_id)
+            if state is None or state["is_processed"] or state["analysis_pending"]:
+                logger.debug(f"Message {message_id} was already stored and analyzed or queued, skipping analysis")
+                return
+            logger.info(f"Message {message_id} was already stored without an analysis, analyzing it")
+        else:
+            logger.debug(f"Message {message_id} stored in database")
         
         asyncio.create_task(analyze_and_process(message_data))
         logger.debug(f"Started async task to analyze message {message_id}")
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}", exc_info=True)
+async def process_edited_message(event):
+    """Apply an edit to the stored message and analyze it again if its text changed."""
+    try:
+        chat = await event.get_chat()
+        text = event.raw_text or ""
+        edit = await update_message_text(
+            chat.id, event.id, text, simhash=simhash(text), edited_at=event.message.edit_date
+        )
+        if edit is None:
+            # The account's own messages and messages from before the stored history are not tracked
+            logger.debug(f"Edited message {event.id} of chat {chat.id} is not stored, ignoring")
+            return
+        if not edit["text_changed"]:
+            # Whitespace, case and link preview updates keep the analysis
+            logger.debug(f"Edit of message {event.id} in chat {chat.id} left the normalized text unchanged")
+            return
+        logger.info(f"Message {event.id} in chat {chat.id} edited (revision {edit['revision']}), analyzing it again")
+        discard_analysis_result(chat.id, event.id)
+        forget_messages(chat.id, [event.id])
+        sender = await event.get_sender()
+        message_data = await _build_message_data(event, chat, sender, text, edit["attachments"], edit["timestamp"])
+        asyncio.create_task(analyze_and_process(message_data))
+    except Exception as e:
+        logger.error(f"Error processing edit of message {event.id}: {str(e)}", exc_info=True)
+async def process_deleted_messages(event):
+    """Mark deleted messages and drop what was derived from them."""
+    try:
+        # Only channels and supergroups name the chat of a deletion; resolve_id turns the marked ID into the stored one
+        chat_id = resolve_id(event.chat_id)[0] if event.chat_id is not None else None
+        deleted = await mark_messages_deleted(chat_id, event.deleted_ids)
+        for deleted_chat_id, message_ids in deleted.items():
+            forget_messages(deleted_chat_id, message_ids)
+            for message_id in message_ids:
+                discard_analysis_result(deleted_chat_id, message_id)
+    except Exception as e:
+        logger.error(f"Error processing deletion of messages {event.deleted_ids}: {str(e)}", exc_info=True)
 async def analyze_and_process(message_data: Dict[str, Any]):
     """Analyze message with AI and take appropriate actions."""
+    with usage_scope(feature="triage", chat_id=message_data["chat_id"], message_id=message_data["message_id"]):
+        await _analyze_and_process(message_data)
+async def _analyze_and_process(message_data: Dict[str, Any]):
     try:
-        # Skip processing for channel messages
+        # Skip processing for channel messages, before any of their media is downloaded
         chat_type = message_data.get("chat_type", "")
         if chat_type == "channel":
             logger.info(f"Skipping analysis for channel message {message_data['message_id']}")
             return
+        
+        if message_data.get("attachments"):
+            message_data["attachments"] = await materialize_attachments(
+                client, message_data, getattr(message_data.get("original_event"), "message", None)
+            )
 
-        logger.info(f"Analyzing message {message_data['message_id']} with AI")
-        analysis = await analyze_message(message_data)
+        # Restarts, reprocessing and backfills must not analyze a message twice
+        if await is_message_analyzed(message_data["chat_id"], message_data["message_id"], ANALYSIS_PROMPT_VERSION):
+            logger.debug(f"Message {message_data['message_id']} is already analyzed, skipping")
+            if message_data.get("analysis_attempts"):
+                await clear_message_analysis_pending(message_data["chat_id"], message_data["message_id"])
+            return
+        
+        # Forwarded announcements, pasted logs and reposted images reuse the analysis of an earlier copy
+        fingerprint = message_data.get("simhash")
+        if message_data.get("attachments"):
+            duplicate = await find_media_duplicate(message_data, ANALYSIS_PROMPT_VERSION)
+        else:
+            duplicate = find_duplicate(fingerprint, message_data["chat_id"], message_data["message_id"])
+        if duplicate:
+            analysis = dict(duplicate["analysis"])
+            await record_message_duplicate(
+                message_data["chat_id"], message_data["message_id"],
+                duplicate["chat_id"], duplicate["message_id"], duplicate["distance"]
+            )
+        else:
+            # During an LLM outage the message is queued for the reprocessing job instead of being dropped
+            if not llm_available():
+                await mark_message_analysis_pending(message_data["chat_id"], message_data["message_id"])
+                return
+            # Over the daily token budget the message waits for the reprocessing job on the next day
+            budget_reason = await exhausted_budget("triage", message_data["chat_id"])
+            if budget_reason:
+                logger.info(f"Deferring analysis of message {message_data['message_id']}: {budget_reason}")
+                await mark_message_analysis_pending(message_data["chat_id"], message_data["message_id"])
+                return
+            
+            logger.info(f"Analyzing message {message_data['message_id']} with AI")
+            if message_data.get("attachments"):
+                original_message = getattr(message_data.get("original_event"), "message", None)
+                message_data["media_buffers"] = await load_media_buffers(client, message_data, original_message)
+                # Evicted and reference-only images are fetched now that analysis needs them
+                message_data["attachments"] = await fetch_analysis_images(client, message_data, original_message)
+            analysis = await analyze_message(message_data)
+            # Buffers are only needed for the vision request; the queued result must not keep them alive
+            message_data.pop("media_buffers", None)
+            if analysis.get("deferred"):
+                await mark_message_analysis_pending(message_data["chat_id"], message_data["message_id"])
+                return
         logger.debug(f"AI analysis complete for message {message_data['message_id']}: {analysis}")
         
         question_data = await detect_question_target(message_data, ADMIN_USER_ID)
@@ -172,7 +307,8 @@ async def analyze_and_process(message_data: Dict[str, Any]):
             )
             logger.debug(f"Stored unanswered question in database")
         
-        if analysis.get("has_task", False):
+        # The task and the notification were already offered for the original copy
+        if analysis.get("has_task", False) and not duplicate:
             logger.info(f"Potential task detected in message {message_data['message_id']}")
             task_data = await extract_task_from_message(message_data)
             if task_data:
@@ -182,11 +318,42 @@ async def analyze_and_process(message_data: Dict[str, Any]):
         
         await check_if_answering_question(message_data)
         
-        if analysis.get("is_important", False):
+        if analysis.get("is_important", False) and not duplicate:
             logger.info(f"Important message detected: {message_data['message_id']}")
             await send_important_notification(message_data)
+        
+        # Stored only once the whole pipeline ran, so a message deferred halfway is analyzed again
+        if not duplicate:
+            remember_analysis(fingerprint, message_data["chat_id"], message_data["message_id"], analysis)
+            await remember_media_analysis(message_data, analysis)
+        queue_analysis_result(message_data, analysis)
     except Exception as e:
+        if is_outage_error(e):
+            logger.warning(f"LLM unavailable while processing message {message_data.get('message_id')}, deferring: {str(e)}")
+            await mark_message_analysis_pending(message_data["chat_id"], message_data["message_id"])
+            return
         logger.error(f"Error in AI analysis for message {message_data.get('message_id', 'unknown')}: {str(e)}")
+async def reprocess_pending_messages_periodically():
+    """Re-analyze messages deferred during an LLM outage, at most REPROCESS_RATE_PER_MINUTE per minute"""
+    logger.info(f"Starting deferred analysis reprocessing every {REPROCESS_INTERVAL} seconds")
+    delay = 60 / max(REPROCESS_RATE_PER_MINUTE, 1)
+    while True:
+        try:
+            if llm_available() and not await exhausted_budget("triage"):
+                pending = await get_pending_analysis_messages(
+                    limit=REPROCESS_RATE_PER_MINUTE, exclude_chat_ids=await exhausted_chats()
+                )
+                if pending:
+                    logger.info(f"Reprocessing {len(pending)} messages with deferred analysis")
+                for message_data in pending:
+                    if not llm_available():
+                        logger.info("LLM unavailable again, pausing reprocessing")
+                        break
+                    await analyze_and_process(message_data)
+                    await asyncio.sleep(delay)
+        except Exception as e:
+            logger.error(f"Error reprocessing deferred messages: {str(e)}", exc_info=True)
+        await asyncio.sleep(REPROCESS_INTERVAL)
 async def check_if_answering_question(message_data: Dict[str, Any]):
     """Check if this message is answering a previously asked question."""
     try:
@@ -237,18 +404,43 @@ async def start_client():
             logger.error("User is not authorized. Please run the authentication script first.")
             await client.disconnect()
             return None
+        await preload_dialogs(client)
+        # Read before live messages start moving the last seen IDs, so the downtime range is known
+        sync_states = await get_chat_sync_states()
         if not MONITORED_CHATS:
             @client.on(events.NewMessage)
             async def handler(event):
                 await process_new_message(event)
+            @client.on(events.MessageEdited)
+            async def edit_handler(event):
+                await process_edited_message(event)
+            @client.on(events.MessageDeleted)
+            async def delete_handler(event):
+                await process_deleted_messages(event)
             logger.info("Telegram userbot client started")
             logger.info("Monitoring ALL chats")
         else:
             @client.on(events.NewMessage(chats=MONITORED_CHATS))
             async def handler(event):
                 await process_new_message(event)
+            @client.on(events.MessageEdited(chats=MONITORED_CHATS))
+            async def edit_handler(event):
+                await process_edited_message(event)
+            # Deletions in private chats and basic groups carry no chat and would never pass a chats filter;
+            # mark_messages_deleted only matches messages that are stored, i.e. from monitored chats
+            @client.on(events.MessageDeleted)
+            async def delete_handler(event):
+                await process_deleted_messages(event)
             logger.info("Telegram userbot client started")
             logger.info(f"Monitoring {len(MONITORED_CHATS)} chats: {MONITORED_CHATS}")
+        load_window(await get_recent_message_fingerprints(
+            datetime.utcnow() - timedelta(hours=DUPLICATE_WINDOW_HOURS), limit=DUPLICATE_WINDOW_SIZE
+        ))
+        asyncio.create_task(reprocess_pending_messages_periodically())
+        asyncio.create_task(flush_analysis_results_periodically())
+        asyncio.create_task(media_janitor_periodically())
+        asyncio.create_task(flush_last_seen_periodically())
+        asyncio.create_task(catch_up(client, sync_states))
         return client
     except Exception as e:
         logger.error(f"Error initializing Telegram client: {str(e)}")
@@ -256,6 +448,9 @@ async def start_client():
 async def stop_client(client):
     """Stop the Telegram userbot client."""
     logger.info("Stopping Telegram userbot client")
+    await flush_analysis_results()
+    await flush_last_seen()
+    await close_link_client()
     if client:
         await client.disconnect()
         logger.info("Telegram userbot client disconnected")
@@ -0,0 +1,71 @@
+import asyncio
+from typing import Dict, Any, Tuple
+from telegram_ai_assistant.config import ANALYSIS_BATCH_SIZE, ANALYSIS_FLUSH_INTERVAL
+from telegram_ai_assistant.utils.db_utils import save_message_analyses, get_analyzed_message_ids
+from telegram_ai_assistant.utils.logging_utils import setup_db_logger
+logger = setup_db_logger()
+# Analysis results waiting to be written, keyed by (chat_id, message_id)
+_buffer: Dict[Tuple[int, int], Dict[str, Any]] = {}
+_flush_lock = asyncio.Lock()
+def queue_analysis_result(message_data: Dict[str, Any], analysis: Dict[str, Any]) -> bool:
+    """
+    Buffer the analysis of a message for the next batched write
+    Deferred and failed analyses are not stored, so the message is analyzed again later.
+    Args:
+        message_data: Message the analysis belongs to
+        analysis: Result of analyze_message
+    Returns:
+        True if the result was queued
+    """
+    if analysis.get("deferred") or analysis.get("error"):
+        return False
+    key = (message_data["chat_id"], message_data["message_id"])
+    _buffer[key] = {
+        "chat_id": key[0],
+        "message_id": key[1],
+        "category": str(analysis.get("category") or "other")[:50],
+        "is_important": bool(analysis.get("is_important")),
+        "has_task": bool(analysis.get("has_task")),
+        "is_question": bool(analysis.get("is_question")),
+        "model": analysis.get("model"),
+        "prompt_version": analysis.get("prompt_version")
+    }
+    if len(_buffer) >= ANALYSIS_BATCH_SIZE and not _flush_lock.locked():
+        asyncio.create_task(flush_analysis_results())
+    return True
+def discard_analysis_result(chat_id: int, message_id: int) -> bool:
+    """Drop a buffered result that no longer matches its message, e.g. after the text was edited"""
+    return _buffer.pop((chat_id, message_id), None) is not None
+async def is_message_analyzed(chat_id: int, message_id: int, prompt_version: str) -> bool:
+    """Whether a message already has an analysis with this prompt version, stored or still buffered"""
+    if (chat_id, message_id) in _buffer:
+        return True
+    return message_id in await get_analyzed_message_ids(chat_id, [message_id], prompt_version)
+async def flush_analysis_results() -> int:
+    """
+    Write all buffered analysis results in one batch
+    Returns:
+        Number of results written
+    """
+    async with _flush_lock:
+        if not _buffer:
+            return 0
+        batch = dict(_buffer)
+        try:
+            await save_message_analyses(list(batch.values()))
+        except Exception as e:
+            logger.error(f"Error flushing {len(batch)} analysis results, will retry: {str(e)}")
+            return 0
+        for key, result in batch.items():
+            if _buffer.get(key) is result:
+                del _buffer[key]
+        return len(batch)
+async def flush_analysis_results_periodically():
+    """Write buffered analysis results at least every ANALYSIS_FLUSH_INTERVAL seconds"""
+    logger.info(f"Starting analysis result writer, batches of {ANALYSIS_BATCH_SIZE} or every {ANALYSIS_FLUSH_INTERVAL} seconds")
+    while True:
+        await asyncio.sleep(ANALYSIS_FLUSH_INTERVAL)
+        try:
+            await flush_analysis_results()
+        except Exception as e:
+            logger.error(f"Error in analysis result writer: {str(e)}", exc_info=True)
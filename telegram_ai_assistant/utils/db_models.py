@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, ForeignKey, JSON, create_engine
+from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, Float, ForeignKey, JSON, UniqueConstraint, create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 from datetime import datetime
@@ -10,16 +10,19 @@ Base = declarative_base()
 class Chat(Base):
     __tablename__ = 'chats'
     id = Column(Integer, primary_key=True)
-    chat_id = Column(Integer, nullable=False, unique=True)
+    chat_id = Column(Integer, nullable=False, unique=True, comment="Telegram chat ID")
     chat_name = Column(String(255))
     is_active = Column(Boolean, default=True)
     last_summary_time = Column(DateTime, default=datetime.utcnow)
+    rolling_summary = Column(Text, nullable=True)
+    rolling_summary_start = Column(DateTime, nullable=True)
+    last_summary_message_id = Column(Integer, nullable=True, comment="Internal ID of the last message folded at last_summary_time")
     linear_team_id = Column(String(50))
     messages = relationship("Message", back_populates="chat")
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, unique=True, nullable=False)
+    user_id = Column(Integer, unique=True, nullable=False, comment="Telegram user ID")
     username = Column(String(255), nullable=True)
     first_name = Column(String(255))
     last_name = Column(String(255))
@@ -30,17 +33,30 @@ class User(Base):
     unanswered_questions = relationship("UnansweredQuestion", back_populates="target_user")
 class Message(Base):
     __tablename__ = 'messages'
+    __table_args__ = (UniqueConstraint('chat_id', 'message_id', name='uq_messages_chat_message'),)
     id = Column(Integer, primary_key=True)
-    message_id = Column(Integer, nullable=False)
+    message_id = Column(Integer, nullable=False, comment="Telegram message ID, unique within a chat")
     chat_id = Column(Integer, ForeignKey('chats.chat_id'))
     sender_id = Column(Integer, ForeignKey('users.user_id'))
     text = Column(Text)
-    attachments = Column(JSON)
+    attachments = Column(JSON, comment="JSON list of attachment descriptions")
     timestamp = Column(DateTime, default=datetime.utcnow)
-    is_important = Column(Boolean, default=False)
-    is_processed = Column(Boolean, default=False)
-    category = Column(String(50))
+    is_important = Column(Boolean, default=False, comment="AI analysis: needs prompt attention")
+    is_processed = Column(Boolean, default=False, comment="AI analysis has been stored for this message")
+    category = Column(String(50), comment="AI-assigned category")
     is_bot = Column(Boolean, default=False)
+    has_task = Column(Boolean, nullable=True, comment="AI analysis: describes a task or work item")
+    is_question = Column(Boolean, nullable=True, comment="AI analysis: contains a question")
+    analysis_model = Column(String(100), nullable=True)
+    analysis_prompt_version = Column(String(20), nullable=True)
+    analyzed_at = Column(DateTime, nullable=True)
+    analysis_pending = Column(Boolean, default=False, comment="Analysis deferred because the LLM was unavailable")
+    analysis_attempts = Column(Integer, default=0)
+    simhash = Column(Integer, nullable=True, comment="64-bit SimHash of the text, for near-duplicate detection")
+    reply_to_message_id = Column(Integer, nullable=True, comment="Telegram ID of the message this one replies to")
+    revision = Column(Integer, default=0, comment="Number of edits and deletions applied since the message was stored")
+    edited_at = Column(DateTime, nullable=True)
+    deleted_at = Column(DateTime, nullable=True, comment="Set when the message was deleted in Telegram")
     chat = relationship("Chat", back_populates="messages")
     sender = relationship("User", back_populates="messages")
 class Task(Base):
@@ -53,16 +69,16 @@ class Task(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     due_date = Column(DateTime)
     assignee_id = Column(Integer, ForeignKey('users.user_id'))
-    message_id = Column(Integer)
-    chat_id = Column(Integer)
+    message_id = Column(Integer, comment="Telegram message the task was created from")
+    chat_id = Column(Integer, comment="Telegram chat the task was created from")
     assignee = relationship("User", back_populates="tasks")
 class UnansweredQuestion(Base):
     __tablename__ = 'unanswered_questions'
     id = Column(Integer, primary_key=True)
     message_id = Column(Integer, nullable=False)
     chat_id = Column(Integer, nullable=False)
-    target_user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
-    sender_id = Column(Integer, nullable=True)
+    target_user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False, comment="User who should answer")
+    sender_id = Column(Integer, nullable=True, comment="User who asked")
     question = Column(Text)
     asked_at = Column(DateTime, default=datetime.utcnow)
     is_answered = Column(Boolean, default=False)
@@ -79,6 +95,63 @@ class TeamProductivity(Base):
     tasks_created = Column(Integer, default=0)
     tasks_completed = Column(Integer, default=0)
     avg_response_time = Column(Integer)
+class MessageDuplicate(Base):
+    __tablename__ = 'message_duplicates'
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, nullable=False, comment="Chat of the duplicate message")
+    message_id = Column(Integer, nullable=False, comment="Telegram ID of the duplicate message")
+    original_chat_id = Column(Integer, nullable=False, comment="Chat of the message whose analysis was reused")
+    original_message_id = Column(Integer, nullable=False)
+    distance = Column(Integer, comment="SimHash Hamming distance, 0 for identical text")
+    detected_at = Column(DateTime, default=datetime.utcnow)
+class SqlTemplate(Base):
+    __tablename__ = 'sql_templates'
+    id = Column(Integer, primary_key=True)
+    question_template = Column(Text, nullable=False, unique=True)
+    sql_template = Column(Text, nullable=False)
+    param_slots = Column(JSON)
+    hit_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, nullable=True)
+class LlmUsage(Base):
+    __tablename__ = 'llm_usage'
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    call_site = Column(String(100), nullable=False, comment="Code path that made the request, e.g. ai_agent_query.plan")
+    feature = Column(String(50), nullable=False, comment="Feature the request is billed to: triage, summaries, agent, ...")
+    model = Column(String(100))
+    chat_id = Column(Integer, nullable=True, comment="Chat the request was made for, if any")
+    message_id = Column(Integer, nullable=True, comment="Message the request was made for, if any")
+    prompt_tokens = Column(Integer, default=0)
+    cached_tokens = Column(Integer, default=0, comment="Prompt tokens served from the provider's prompt cache")
+    completion_tokens = Column(Integer, default=0)
+    total_tokens = Column(Integer, default=0)
+    cost = Column(Float, default=0.0, comment="Estimated cost in USD")
+class MediaObject(Base):
+    __tablename__ = 'media_objects'
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(String(64), nullable=False, unique=True, comment="SHA-256 of the file content")
+    path = Column(String(500), nullable=False, comment="Canonical file in the content-addressed store")
+    size = Column(Integer)
+    mime_type = Column(String(100))
+    ref_count = Column(Integer, default=0, comment="Number of message attachments pointing at this object")
+    analysis = Column(JSON, nullable=True, comment="Cached analysis of a message consisting of just this image")
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_accessed_at = Column(DateTime, default=datetime.utcnow)
+class MediaFileKey(Base):
+    __tablename__ = 'media_file_keys'
+    id = Column(Integer, primary_key=True)
+    file_key = Column(String(100), nullable=False, unique=True, comment="Telegram file identity, e.g. photo:<id> or document:<id>:thumb")
+    content_hash = Column(String(64), nullable=False, index=True)
+class ChatSyncState(Base):
+    __tablename__ = 'chat_sync_state'
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, nullable=False, unique=True, comment="Telegram chat ID")
+    peer_id = Column(Integer, nullable=True, comment="Marked peer ID (e.g. -100... for channels) to resolve the chat with")
+    last_seen_message_id = Column(Integer, default=0, comment="Newest message received live or by catch-up")
+    backfill_message_id = Column(Integer, default=0, comment="Newest message imported by the history backfill")
+    backfill_completed_at = Column(DateTime, nullable=True, comment="When the backfill last reached the newest message")
+    updated_at = Column(DateTime, default=datetime.utcnow)
 def init_db():
     engine = create_engine(DB_URI)
     Base.metadata.create_all(engine)
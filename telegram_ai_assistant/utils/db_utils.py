@@ -1,20 +1,41 @@
 import sys
 import os
 import json
-from datetime import datetime, timedelta
+import asyncio
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine, func, and_, text
+from sqlalchemy import create_engine, event, func, and_, text, bindparam, cast, DateTime, Text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.future import select
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from telegram_ai_assistant.config import DB_URI
-from utils.db_models import Chat, User, Message, Task, UnansweredQuestion, TeamProductivity, Base
+from utils.db_models import Chat, User, Message, Task, UnansweredQuestion, TeamProductivity, SqlTemplate, MessageDuplicate, LlmUsage, MediaObject, MediaFileKey, ChatSyncState, Base
 from utils.logging_utils import setup_db_logger
+from telegram_ai_assistant.utils.near_duplicates import text_hash
 logger = setup_db_logger()
 engine = create_engine(DB_URI)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Separate pool for read-only queries executed from worker threads
+read_engine = create_engine(DB_URI, connect_args={"check_same_thread": False} if DB_URI.startswith("sqlite") else {})
+if read_engine.dialect.name == "sqlite":
+    @event.listens_for(read_engine, "connect")
+    def _set_query_only(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA query_only = ON")
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+def _insert_new_messages():
+    """INSERT into messages that skips rows whose (chat_id, message_id) is already stored"""
+    if engine.dialect.name == "postgresql":
+        return postgresql_insert(Message).on_conflict_do_nothing(index_elements=["chat_id", "message_id"])
+    return sqlite_insert(Message).on_conflict_do_nothing(index_elements=["chat_id", "message_id"])
 async def store_message(chat_id, chat_name, message_id, sender_id, sender_name, 
-                        text, attachments=None, timestamp=None, is_bot=False):
+                        text, attachments=None, timestamp=None, is_bot=False, simhash=None, reply_to_message_id=None):
+    """
+    Store a message received live and count it in today's productivity
+    Returns:
+        Internal ID of the new row, or None if the message was already stored
+    """
     session = SessionLocal()
     try:
         logger.debug(f"Storing message {message_id} from chat {chat_id}")
@@ -56,19 +77,26 @@ async def store_message(chat_id, chat_name, message_id, sender_id, sender_name,
                 
         attachments_json = json.dumps(attachments) if attachments else "[]"
         message_time = timestamp if timestamp else datetime.utcnow()
-        message = Message(
-            message_id=message_id,
-            chat_id=chat_id,
-            sender_id=sender_id,
-            text=text,
-            attachments=attachments_json,
-            timestamp=message_time,
-            is_important=False,
-            is_processed=False,
-            category="default",
-            is_bot=is_bot
-        )
-        session.add(message)
+        row = {
+            "message_id": message_id,
+            "chat_id": chat_id,
+            "sender_id": sender_id,
+            "text": text,
+            "attachments": attachments_json,
+            "timestamp": message_time,
+            "is_important": False,
+            "is_processed": False,
+            "category": "default",
+            "is_bot": is_bot,
+            "simhash": simhash,
+            "reply_to_message_id": reply_to_message_id
+        }
+        inserted = session.execute(_insert_new_messages().returning(Message.id), [row]).scalars().all()
+        if not inserted:
+            # Already stored, e.g. by a catch-up or a redelivered update; nothing must be counted twice
+            session.commit()
+            logger.debug(f"Message {message_id} of chat {chat_id} is already stored")
+            return None
         today = datetime.utcnow().date()
         productivity = session.query(TeamProductivity).filter(
             TeamProductivity.user_id == sender_id,
@@ -85,8 +113,8 @@ async def store_message(chat_id, chat_name, message_id, sender_id, sender_name,
             )
             session.add(productivity)
         session.commit()
-        logger.debug(f"Successfully stored message {message_id} with internal ID {message.id}")
-        return message.id
+        logger.debug(f"Successfully stored message {message_id} with internal ID {inserted[0]}")
+        return inserted[0]
     except Exception as e:
         session.rollback()
         logger.error(f"Error storing message {message_id}: {str(e)}", exc_info=True)
@@ -112,6 +140,7 @@ async def get_recent_chat_messages(chat_id, hours=24, limit=100):
         LEFT JOIN users u ON m.sender_id = u.user_id
         WHERE m.chat_id = :chat_id
         AND m.timestamp >= :timestamp
+        AND m.deleted_at IS NULL
         ORDER BY m.timestamp DESC
         LIMIT :limit
         """)
@@ -168,6 +197,129 @@ async def get_recent_chat_messages(chat_id, hours=24, limit=100):
     except Exception as e:
         logger.error(f"Error retrieving recent chat messages: {str(e)}")
         return []
+async def get_chat_messages_since(chat_id, since, limit=1000, after_id=None):
+    """
+    Retrieve messages from a chat that are newer than the given time
+    Args:
+        chat_id: Chat ID
+        since: Only messages with a timestamp strictly after this are returned
+        limit: Maximum number of messages to return
+        after_id: Also return messages with a timestamp equal to since whose internal ID is greater,
+            so (since, after_id) works as a cursor that never skips messages sharing a timestamp
+    Returns:
+        List of message dicts in (timestamp, id) order (oldest first)
+    """
+    session = SessionLocal()
+    try:
+        if after_id is None:
+            cursor_filter = "m.timestamp > :since"
+        else:
+            cursor_filter = "(m.timestamp > :since OR (m.timestamp = :since AND m.id > :after_id))"
+        # Typed parameters are rendered in the stored DateTime format, which plain string comparison relies on
+        sql_query = text(f"""
+        SELECT m.id, m.message_id, m.chat_id, m.sender_id,
+               m.text, m.timestamp, u.first_name, u.last_name, u.username, u.is_bot
+        FROM messages m
+        LEFT JOIN users u ON m.sender_id = u.user_id
+        WHERE m.chat_id = :chat_id
+        AND {cursor_filter}
+        AND m.deleted_at IS NULL
+        ORDER BY m.timestamp ASC, m.id ASC
+        LIMIT :limit
+        """).bindparams(bindparam("since", type_=DateTime)).columns(timestamp=DateTime)
+        params = {"chat_id": chat_id, "since": since, "limit": limit}
+        if after_id is not None:
+            params["after_id"] = after_id
+        result = session.execute(sql_query, params)
+        messages = []
+        for row in result:
+            sender_name = f"{row.first_name or ''} {row.last_name or ''}".strip()
+            if not sender_name and row.username:
+                sender_name = row.username
+            if not sender_name:
+                sender_name = f"User {row.sender_id}"
+            if row.is_bot:
+                sender_name += " (bot)"
+            messages.append({
+                "id": row.id,
+                "message_id": row.message_id,
+                "chat_id": row.chat_id,
+                "sender_id": row.sender_id,
+                "sender_name": sender_name,
+                "text": row.text,
+                "timestamp": row.timestamp
+            })
+        logger.debug(f"Retrieved {len(messages)} messages from chat {chat_id} since {since}")
+        return messages
+    except Exception as e:
+        logger.error(f"Error retrieving messages since {since} for chat {chat_id}: {str(e)}")
+        return []
+    finally:
+        session.close()
+async def get_active_chats():
+    """Return chat_id and chat_name of every active chat"""
+    session = SessionLocal()
+    try:
+        chats = session.query(Chat).filter(Chat.is_active == True).order_by(Chat.chat_name).all()
+        return [{"chat_id": chat.chat_id, "chat_name": chat.chat_name or f"Chat {chat.chat_id}"} for chat in chats]
+    except Exception as e:
+        logger.error(f"Error retrieving active chats: {str(e)}", exc_info=True)
+        return []
+    finally:
+        session.close()
+async def get_chat_summary_state(chat_id):
+    """
+    Get the stored rolling summary of a chat
+    Args:
+        chat_id: Chat ID
+    Returns:
+        Dict with chat_name, rolling_summary, rolling_summary_start, last_summary_time and
+        last_summary_message_id, or None if the chat is unknown
+    """
+    session = SessionLocal()
+    try:
+        chat = session.query(Chat).filter(Chat.chat_id == chat_id).first()
+        if not chat:
+            return None
+        return {
+            "chat_id": chat.chat_id,
+            "chat_name": chat.chat_name or f"Chat {chat.chat_id}",
+            "rolling_summary": chat.rolling_summary,
+            "rolling_summary_start": chat.rolling_summary_start,
+            "last_summary_time": chat.last_summary_time,
+            "last_summary_message_id": chat.last_summary_message_id
+        }
+    finally:
+        session.close()
+async def save_chat_summary(chat_id, summary, summary_start, summary_time, summary_message_id=None):
+    """
+    Persist the rolling summary of a chat
+    Args:
+        chat_id: Chat ID
+        summary: Summary text covering all messages since summary_start
+        summary_start: Start of the period covered by the summary
+        summary_time: Timestamp of the newest message folded into the summary
+        summary_message_id: Internal ID of that message, the tie-breaker for messages sharing its timestamp
+    """
+    session = SessionLocal()
+    try:
+        chat = session.query(Chat).filter(Chat.chat_id == chat_id).first()
+        if not chat:
+            logger.warning(f"Cannot save summary for unknown chat {chat_id}")
+            return False
+        chat.rolling_summary = summary
+        chat.rolling_summary_start = summary_start
+        chat.last_summary_time = summary_time
+        chat.last_summary_message_id = summary_message_id
+        session.commit()
+        logger.debug(f"Saved rolling summary for chat {chat_id} up to {summary_time}")
+        return True
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error saving rolling summary for chat {chat_id}: {str(e)}", exc_info=True)
+        raise e
+    finally:
+        session.close()
 async def mark_question_as_answered(message_id, chat_id):
     session = SessionLocal()
     try:
@@ -195,6 +347,13 @@ async def store_unanswered_question(message_id, chat_id, target_user_id, questio
         if is_bot:
             logger.info(f"Skipping question from bot (message {message_id})")
             return None
+        existing = session.query(UnansweredQuestion).filter(
+            UnansweredQuestion.message_id == message_id,
+            UnansweredQuestion.chat_id == chat_id
+        ).first()
+        if existing:
+            logger.debug(f"Question from message {message_id} in chat {chat_id} is already stored")
+            return existing.id
         question = UnansweredQuestion(
             message_id=message_id,
             chat_id=chat_id,
@@ -496,28 +655,44 @@ async def get_user_chats(user_id=None):
         return []  # Return empty list instead of raising exception
     finally:
         session.close()
-async def execute_sql_query(sql_query: str):
+async def execute_sql_query(sql_query: str, params: dict = None):
     """
     Execute an arbitrary SQL query and return the results
     
     Args:
         sql_query: SQL query string to execute
+        params: Optional bind parameters for the query
         
     Returns:
         List of dictionaries with the query results
     """
+    return _run_sql_query(SessionLocal, sql_query, params)
+async def execute_read_query(sql_query: str, params: dict = None):
+    """
+    Execute a read-only SQL query on a separate read connection in a worker thread,
+    so several queries can run concurrently without blocking the event loop
+    
+    Args:
+        sql_query: SQL query string to execute
+        params: Optional bind parameters for the query
+        
+    Returns:
+        List of dictionaries with the query results, or [{"error": ...}] on failure
+    """
+    return await asyncio.to_thread(_run_sql_query, ReadSessionLocal, sql_query, params)
+def _run_sql_query(session_factory, sql_query: str, params: dict = None):
     logger.info(f"Executing raw SQL query:")
     logger.info(sql_query)
     
     try:
         # Create a new session
-        session = SessionLocal()
+        session = session_factory()
         
         # Wrap the query string in SQLAlchemy text() function
         sql_text = text(sql_query)
         
         # Execute the query directly
-        result = session.execute(sql_text)
+        result = session.execute(sql_text, params or {})
         
         # Convert result to a list of dictionaries
         columns = result.keys()
@@ -552,4 +727,862 @@ async def execute_sql_query(sql_query: str):
         error_msg = str(e)
         logger.error(f"Error executing SQL query: {error_msg}")
         logger.error(f"Query was: {sql_query}")
-        return [{"error": error_msg}] 
\ No newline at end of file
+        return [{"error": error_msg}] 
+async def get_sql_templates():
+    """Return all cached question -> SQL templates"""
+    session = SessionLocal()
+    try:
+        return [
+            {
+                "id": template.id,
+                "question_template": template.question_template,
+                "sql_template": template.sql_template,
+                "param_slots": template.param_slots or {},
+                "hit_count": template.hit_count or 0
+            }
+            for template in session.query(SqlTemplate).all()
+        ]
+    except Exception as e:
+        logger.error(f"Error retrieving SQL templates: {str(e)}", exc_info=True)
+        return []
+    finally:
+        session.close()
+async def save_sql_template(question_template, sql_template, param_slots):
+    """
+    Store a validated question -> SQL template, replacing the SQL of an existing template
+    Args:
+        question_template: Normalized question with parameter placeholders
+        sql_template: SQL with named bind parameters
+        param_slots: Dict of parameter name -> format string for its value
+    Returns:
+        ID of the stored template, or None on error
+    """
+    session = SessionLocal()
+    try:
+        template = session.query(SqlTemplate).filter(SqlTemplate.question_template == question_template).first()
+        if template:
+            template.sql_template = sql_template
+            template.param_slots = param_slots
+        else:
+            template = SqlTemplate(question_template=question_template, sql_template=sql_template, param_slots=param_slots)
+            session.add(template)
+        session.commit()
+        return template.id
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error saving SQL template: {str(e)}", exc_info=True)
+        return None
+    finally:
+        session.close()
+async def record_sql_template_hit(template_id):
+    """Increase the hit counter of a SQL template"""
+    session = SessionLocal()
+    try:
+        template = session.query(SqlTemplate).filter(SqlTemplate.id == template_id).first()
+        if template:
+            template.hit_count = (template.hit_count or 0) + 1
+            template.last_used_at = datetime.utcnow()
+            session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error updating SQL template {template_id}: {str(e)}", exc_info=True)
+    finally:
+        session.close()
+async def delete_sql_template(template_id):
+    """Remove a SQL template that no longer executes"""
+    session = SessionLocal()
+    try:
+        session.query(SqlTemplate).filter(SqlTemplate.id == template_id).delete()
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error deleting SQL template {template_id}: {str(e)}", exc_info=True)
+    finally:
+        session.close()
+async def mark_message_analysis_pending(chat_id, message_id):
+    """Flag a message whose analysis has to be retried once the LLM is available again"""
+    session = SessionLocal()
+    try:
+        message = session.query(Message).filter(Message.chat_id == chat_id, Message.message_id == message_id).first()
+        if not message:
+            logger.warning(f"Cannot defer analysis of unknown message {message_id} in chat {chat_id}")
+            return False
+        message.analysis_pending = True
+        message.analysis_attempts = (message.analysis_attempts or 0) + 1
+        session.commit()
+        logger.info(f"Analysis of message {message_id} in chat {chat_id} deferred (attempt {message.analysis_attempts})")
+        return True
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error deferring analysis of message {message_id}: {str(e)}", exc_info=True)
+        return False
+    finally:
+        session.close()
+async def clear_message_analysis_pending(chat_id, message_id):
+    """Remove the deferred-analysis flag after a message was analyzed"""
+    session = SessionLocal()
+    try:
+        session.query(Message).filter(
+            Message.chat_id == chat_id,
+            Message.message_id == message_id,
+            Message.analysis_pending == True
+        ).update({Message.analysis_pending: False}, synchronize_session=False)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error clearing deferred analysis of message {message_id}: {str(e)}", exc_info=True)
+    finally:
+        session.close()
+def _decode_attachments(attachments):
+    """store_message keeps attachments as a JSON-encoded string inside the JSON column"""
+    if isinstance(attachments, str):
+        try:
+            attachments = json.loads(attachments)
+        except ValueError:
+            return []
+    return attachments or []
+async def get_message_attachments(chat_id, message_id):
+    """Get the decoded attachment list of a stored message, or None if the message is unknown"""
+    session = SessionLocal()
+    try:
+        message = session.query(Message).filter(Message.chat_id == chat_id, Message.message_id == message_id).first()
+        return _decode_attachments(message.attachments) if message else None
+    except Exception as e:
+        logger.error(f"Error loading attachments of message {message_id}: {str(e)}", exc_info=True)
+        return None
+    finally:
+        session.close()
+async def update_message_attachments(chat_id, message_id, attachments):
+    """Replace the attachment list of a stored message, encoded the same way as in store_message"""
+    session = SessionLocal()
+    try:
+        updated = session.query(Message).filter(
+            Message.chat_id == chat_id, Message.message_id == message_id
+        ).update({Message.attachments: json.dumps(attachments) if attachments else "[]"}, synchronize_session=False)
+        session.commit()
+        return updated > 0
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error updating attachments of message {message_id}: {str(e)}", exc_info=True)
+        return False
+    finally:
+        session.close()
+async def get_pending_analysis_messages(limit=20, exclude_chat_ids=None):
+    """
+    Get messages whose analysis was deferred, oldest first
+    Args:
+        limit: Maximum number of messages
+        exclude_chat_ids: Chats to skip, e.g. those over their daily token budget
+    Returns:
+        List of message_data dicts in the shape used by the analysis pipeline
+    """
+    session = SessionLocal()
+    try:
+        query = (
+            session.query(Message, Chat.chat_name, User.first_name, User.last_name, User.username)
+            .outerjoin(Chat, Message.chat_id == Chat.chat_id)
+            .outerjoin(User, Message.sender_id == User.user_id)
+            .filter(Message.analysis_pending == True)
+        )
+        if exclude_chat_ids:
+            query = query.filter(Message.chat_id.notin_(list(exclude_chat_ids)))
+        rows = query.order_by(Message.timestamp).limit(limit).all()
+        return [
+            {
+                "text": message.text or "",
+                "attachments": _decode_attachments(message.attachments),
+                "chat_id": message.chat_id,
+                "chat_name": chat_name or str(message.chat_id),
+                "message_id": message.message_id,
+                "sender_id": message.sender_id,
+                "sender_name": f"{first_name or ''} {last_name or ''}".strip() or username or f"User {message.sender_id}",
+                "is_bot": bool(message.is_bot),
+                "timestamp": message.timestamp.isoformat() if message.timestamp else None,
+                "simhash": message.simhash,
+                "analysis_attempts": message.analysis_attempts or 0
+            }
+            for message, chat_name, first_name, last_name, username in rows
+        ]
+    except Exception as e:
+        logger.error(f"Error getting messages with deferred analysis: {str(e)}", exc_info=True)
+        return []
+    finally:
+        session.close()
+async def save_message_analyses(results):
+    """
+    Write AI analysis results back to their messages in a single executemany statement
+    Args:
+        results: List of dicts with chat_id, message_id, category, is_important, has_task,
+                 is_question, model and prompt_version
+    Returns:
+        Number of messages updated
+    """
+    if not results:
+        return 0
+    session = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        statement = (
+            Message.__table__.update()
+            .where(Message.chat_id == bindparam("b_chat_id"), Message.message_id == bindparam("b_message_id"))
+            .values(
+                category=bindparam("b_category"),
+                is_important=bindparam("b_is_important"),
+                has_task=bindparam("b_has_task"),
+                is_question=bindparam("b_is_question"),
+                analysis_model=bindparam("b_model"),
+                analysis_prompt_version=bindparam("b_prompt_version"),
+                analyzed_at=bindparam("b_analyzed_at"),
+                is_processed=True,
+                analysis_pending=False
+            )
+        )
+        rows = [
+            {
+                "b_chat_id": result["chat_id"],
+                "b_message_id": result["message_id"],
+                "b_category": result.get("category"),
+                "b_is_important": bool(result.get("is_important")),
+                "b_has_task": bool(result.get("has_task")),
+                "b_is_question": bool(result.get("is_question")),
+                "b_model": result.get("model"),
+                "b_prompt_version": result.get("prompt_version"),
+                "b_analyzed_at": now
+            }
+            for result in results
+        ]
+        updated = session.execute(statement, rows).rowcount
+        session.commit()
+        logger.info(f"Saved analysis results for {updated} of {len(results)} messages")
+        return updated
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error saving analysis results: {str(e)}", exc_info=True)
+        raise e
+    finally:
+        session.close()
+async def get_message_analysis_state(chat_id, message_id):
+    """
+    Return the analysis flags of a stored message
+    Returns:
+        Dict with is_processed and analysis_pending, or None if the message is not stored
+    """
+    session = SessionLocal()
+    try:
+        message = session.query(Message.is_processed, Message.analysis_pending).filter(
+            Message.chat_id == chat_id, Message.message_id == message_id
+        ).first()
+        if message is None:
+            return None
+        return {"is_processed": bool(message.is_processed), "analysis_pending": bool(message.analysis_pending)}
+    except Exception as e:
+        logger.error(f"Error reading analysis state of message {message_id}: {str(e)}", exc_info=True)
+        return None
+    finally:
+        session.close()
+async def get_analyzed_message_ids(chat_id, message_ids, prompt_version=None):
+    """
+    Find which of the given messages already have a stored analysis
+    Args:
+        chat_id: Chat ID
+        message_ids: Telegram message IDs to check
+        prompt_version: Only count analyses made with this prompt version
+    Returns:
+        Set of message IDs that are already analyzed
+    """
+    if not message_ids:
+        return set()
+    session = SessionLocal()
+    try:
+        query = session.query(Message.message_id).filter(
+            Message.chat_id == chat_id,
+            Message.message_id.in_(list(message_ids)),
+            Message.is_processed == True
+        )
+        if prompt_version is not None:
+            query = query.filter(Message.analysis_prompt_version == prompt_version)
+        return {row.message_id for row in query.all()}
+    except Exception as e:
+        logger.error(f"Error checking analyzed messages in chat {chat_id}: {str(e)}", exc_info=True)
+        return set()
+    finally:
+        session.close()
+async def record_message_duplicate(chat_id, message_id, original_chat_id, original_message_id, distance):
+    """Record that a message reused the analysis of a near-identical earlier message"""
+    session = SessionLocal()
+    try:
+        session.add(MessageDuplicate(
+            chat_id=chat_id,
+            message_id=message_id,
+            original_chat_id=original_chat_id,
+            original_message_id=original_message_id,
+            distance=distance
+        ))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error recording duplicate of message {original_message_id}: {str(e)}", exc_info=True)
+    finally:
+        session.close()
+async def get_recent_message_fingerprints(since, limit=5000):
+    """
+    Get fingerprints and stored analyses of analyzed messages, oldest first
+    Args:
+        since: Only messages newer than this datetime
+        limit: Maximum number of messages (the newest are kept)
+    Returns:
+        List of dicts with fingerprint, chat_id, message_id, analysis and seen_at (epoch seconds)
+    """
+    session = SessionLocal()
+    try:
+        messages = (
+            session.query(Message)
+            .filter(Message.simhash.isnot(None), Message.is_processed == True, Message.deleted_at.is_(None), Message.timestamp >= since)
+            .order_by(Message.timestamp.desc())
+            .limit(limit)
+            .all()
+        )
+        return [
+            {
+                "fingerprint": message.simhash,
+                "chat_id": message.chat_id,
+                "message_id": message.message_id,
+                "analysis": {
+                    "category": message.category,
+                    "is_important": bool(message.is_important),
+                    "has_task": bool(message.has_task),
+                    "is_question": bool(message.is_question),
+                    "model": message.analysis_model,
+                    "prompt_version": message.analysis_prompt_version
+                },
+                "seen_at": message.timestamp.replace(tzinfo=timezone.utc).timestamp()
+            }
+            for message in reversed(messages)
+        ]
+    except Exception as e:
+        logger.error(f"Error loading message fingerprints: {str(e)}", exc_info=True)
+        return []
+    finally:
+        session.close()
+async def record_llm_usage(usage):
+    """
+    Store the token usage of one LLM request
+    Args:
+        usage: Dict with call_site, feature, model, chat_id, message_id, prompt_tokens,
+               cached_tokens, completion_tokens, total_tokens and cost
+    """
+    session = SessionLocal()
+    try:
+        session.add(LlmUsage(**usage))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error recording LLM usage of {usage.get('call_site')}: {str(e)}", exc_info=True)
+    finally:
+        session.close()
+async def get_llm_usage_totals(since):
+    """
+    Get total tokens per feature and per chat since a point in time, for budget checks
+    Args:
+        since: Start datetime (UTC)
+    Returns:
+        Dict with "features" and "chats", each mapping to total tokens
+    """
+    session = SessionLocal()
+    try:
+        features = (
+            session.query(LlmUsage.feature, func.sum(LlmUsage.total_tokens))
+            .filter(LlmUsage.created_at >= since)
+            .group_by(LlmUsage.feature)
+            .all()
+        )
+        chats = (
+            session.query(LlmUsage.chat_id, func.sum(LlmUsage.total_tokens))
+            .filter(LlmUsage.created_at >= since, LlmUsage.chat_id.isnot(None))
+            .group_by(LlmUsage.chat_id)
+            .all()
+        )
+        return {
+            "features": {feature: int(tokens or 0) for feature, tokens in features},
+            "chats": {chat_id: int(tokens or 0) for chat_id, tokens in chats}
+        }
+    except Exception as e:
+        logger.error(f"Error loading LLM usage totals: {str(e)}", exc_info=True)
+        return {"features": {}, "chats": {}}
+    finally:
+        session.close()
+async def get_llm_usage_report(since, group_by="feature", limit=20):
+    """
+    Aggregate LLM usage since a point in time
+    Args:
+        since: Start datetime (UTC)
+        group_by: "feature", "call_site", "chat", "model" or "day"
+        limit: Maximum number of groups, largest first
+    Returns:
+        List of dicts with key, requests, prompt_tokens, cached_tokens, completion_tokens, total_tokens and cost
+    """
+    columns = {
+        "feature": LlmUsage.feature,
+        "call_site": LlmUsage.call_site,
+        "chat": LlmUsage.chat_id,
+        "model": LlmUsage.model,
+        "day": func.date(LlmUsage.created_at)
+    }
+    if group_by not in columns:
+        raise ValueError(f"Unknown usage grouping: {group_by}")
+    key = columns[group_by]
+    session = SessionLocal()
+    try:
+        total_tokens = func.sum(LlmUsage.total_tokens)
+        query = (
+            session.query(
+                key.label("key"),
+                func.count(LlmUsage.id),
+                func.sum(LlmUsage.prompt_tokens),
+                func.sum(LlmUsage.cached_tokens),
+                func.sum(LlmUsage.completion_tokens),
+                total_tokens,
+                func.sum(LlmUsage.cost)
+            )
+            .filter(LlmUsage.created_at >= since)
+            .group_by(key)
+            .order_by(key if group_by == "day" else total_tokens.desc())
+            .limit(limit)
+        )
+        return [
+            {
+                "key": row[0],
+                "requests": row[1],
+                "prompt_tokens": int(row[2] or 0),
+                "cached_tokens": int(row[3] or 0),
+                "completion_tokens": int(row[4] or 0),
+                "total_tokens": int(row[5] or 0),
+                "cost": float(row[6] or 0.0)
+            }
+            for row in query.all()
+        ]
+    except Exception as e:
+        logger.error(f"Error building LLM usage report: {str(e)}", exc_info=True)
+        return []
+    finally:
+        session.close()
+def _media_object_to_dict(media_object):
+    return {
+        "content_hash": media_object.content_hash,
+        "path": media_object.path,
+        "size": media_object.size,
+        "mime_type": media_object.mime_type,
+        "ref_count": media_object.ref_count or 0,
+        "analysis": media_object.analysis,
+        "last_accessed_at": media_object.last_accessed_at
+    }
+async def get_media_object(content_hash=None, file_key=None):
+    """
+    Look up a stored media object by content hash or by Telegram file key
+    Returns:
+        Dict with content_hash, path, size, mime_type, ref_count, analysis and last_accessed_at, or None
+    """
+    session = SessionLocal()
+    try:
+        if content_hash is None and file_key is not None:
+            key = session.query(MediaFileKey).filter(MediaFileKey.file_key == file_key).first()
+            content_hash = key.content_hash if key else None
+        if content_hash is None:
+            return None
+        media_object = session.query(MediaObject).filter(MediaObject.content_hash == content_hash).first()
+        return _media_object_to_dict(media_object) if media_object else None
+    except Exception as e:
+        logger.error(f"Error looking up media object {content_hash or file_key}: {str(e)}", exc_info=True)
+        return None
+    finally:
+        session.close()
+async def add_media_reference(content_hash, path=None, size=None, mime_type=None, file_key=None):
+    """
+    Count one more attachment pointing at a media object, creating the object if it is new
+    Args:
+        content_hash: SHA-256 of the file content
+        path: Canonical file path, required when the object is new
+        size: File size in bytes
+        mime_type: MIME type
+        file_key: Telegram file key to map to this object for later downloads of the same file
+    Returns:
+        The media object dict, or None on error
+    """
+    session = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        media_object = session.query(MediaObject).filter(MediaObject.content_hash == content_hash).first()
+        if media_object is None:
+            media_object = MediaObject(
+                content_hash=content_hash, path=path, size=size, mime_type=mime_type, ref_count=0, created_at=now
+            )
+            session.add(media_object)
+        elif path:
+            media_object.path = path
+        media_object.ref_count = (media_object.ref_count or 0) + 1
+        media_object.last_accessed_at = now
+        if file_key and not session.query(MediaFileKey).filter(MediaFileKey.file_key == file_key).first():
+            session.add(MediaFileKey(file_key=file_key, content_hash=content_hash))
+        session.commit()
+        return _media_object_to_dict(media_object)
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error referencing media object {content_hash}: {str(e)}", exc_info=True)
+        return None
+    finally:
+        session.close()
+async def release_media_reference(content_hash):
+    """Count one attachment less pointing at a media object"""
+    session = SessionLocal()
+    try:
+        media_object = session.query(MediaObject).filter(MediaObject.content_hash == content_hash).first()
+        if media_object and media_object.ref_count:
+            media_object.ref_count -= 1
+            session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error releasing media object {content_hash}: {str(e)}", exc_info=True)
+    finally:
+        session.close()
+async def save_media_analysis(content_hash, analysis):
+    """Cache the analysis of a message that consists of just this media object"""
+    session = SessionLocal()
+    try:
+        session.query(MediaObject).filter(MediaObject.content_hash == content_hash).update(
+            {MediaObject.analysis: analysis}, synchronize_session=False
+        )
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error caching analysis of media object {content_hash}: {str(e)}", exc_info=True)
+    finally:
+        session.close()
+async def touch_media_object(content_hash):
+    """Mark a media object as recently used so the janitor evicts it last"""
+    session = SessionLocal()
+    try:
+        session.query(MediaObject).filter(MediaObject.content_hash == content_hash).update(
+            {MediaObject.last_accessed_at: datetime.utcnow()}, synchronize_session=False
+        )
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error touching media object {content_hash}: {str(e)}", exc_info=True)
+    finally:
+        session.close()
+async def get_media_objects_by_last_access():
+    """Get all stored media objects, least recently used first"""
+    session = SessionLocal()
+    try:
+        return [
+            _media_object_to_dict(media_object)
+            for media_object in session.query(MediaObject).order_by(MediaObject.last_accessed_at).all()
+        ]
+    except Exception as e:
+        logger.error(f"Error listing media objects: {str(e)}", exc_info=True)
+        return []
+    finally:
+        session.close()
+async def delete_media_object(content_hash):
+    """Remove a media object and its Telegram file keys after its file was evicted"""
+    session = SessionLocal()
+    try:
+        session.query(MediaFileKey).filter(MediaFileKey.content_hash == content_hash).delete(synchronize_session=False)
+        session.query(MediaObject).filter(MediaObject.content_hash == content_hash).delete(synchronize_session=False)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error deleting media object {content_hash}: {str(e)}", exc_info=True)
+    finally:
+        session.close()
+async def get_messages_with_attachment(needle):
+    """
+    Find messages whose attachments mention a content hash or file path
+    Args:
+        needle: Content hash or path to look for in the attachments JSON
+    Returns:
+        List of dicts with chat_id, message_id and decoded attachments
+    """
+    session = SessionLocal()
+    try:
+        # LIKE may over-match on "_" in paths, so callers compare the decoded attachments exactly
+        messages = session.query(Message).filter(cast(Message.attachments, Text).like(f"%{needle}%")).all()
+        return [
+            {"chat_id": message.chat_id, "message_id": message.message_id, "attachments": _decode_attachments(message.attachments)}
+            for message in messages
+        ]
+    except Exception as e:
+        logger.error(f"Error finding messages with attachment {needle}: {str(e)}", exc_info=True)
+        return []
+    finally:
+        session.close()
+async def store_messages_batch(chat_id, chat_name, messages, backfill_message_id=None, analysis_pending=False,
+                               last_seen_message_id=None):
+    """
+    Store a batch of messages of one chat in a single transaction, skipping messages already stored
+    Unlike store_message, productivity counters are not touched since the messages are historical.
+    Args:
+        chat_id: Chat ID
+        chat_name: Chat title, used if the chat is not known yet
+        messages: Dicts with message_id, sender_id, sender_name, text, attachments, timestamp, is_bot, simhash
+            and reply_to_message_id
+        backfill_message_id: Backfill checkpoint to save together with the batch, if any
+        analysis_pending: Queue the new messages for the reprocessing job
+        last_seen_message_id: Gap recovery checkpoint to save together with the batch, if any
+    Returns:
+        Number of messages inserted
+    """
+    session = SessionLocal()
+    try:
+        if not session.query(Chat).filter(Chat.chat_id == chat_id).first():
+            logger.info(f"Creating new chat record for chat_id {chat_id} ({chat_name})")
+            session.add(Chat(chat_id=chat_id, chat_name=chat_name))
+        senders = {message["sender_id"]: message for message in messages}
+        known_users = {
+            user_id for (user_id,) in session.query(User.user_id).filter(User.user_id.in_(list(senders))).all()
+        }
+        for sender_id, message in senders.items():
+            if sender_id in known_users:
+                continue
+            name_parts = (message.get("sender_name") or "").split(maxsplit=1)
+            session.add(User(
+                user_id=sender_id,
+                first_name=name_parts[0] if name_parts else "",
+                last_name=name_parts[1] if len(name_parts) > 1 else "",
+                is_bot=message.get("is_bot", False)
+            ))
+        new_messages = [
+            {
+                "message_id": message["message_id"],
+                "chat_id": chat_id,
+                "sender_id": message["sender_id"],
+                "text": message.get("text"),
+                "attachments": json.dumps(message["attachments"]) if message.get("attachments") else "[]",
+                "timestamp": message.get("timestamp") or datetime.utcnow(),
+                "is_important": False,
+                "is_processed": False,
+                "category": "default",
+                "is_bot": message.get("is_bot", False),
+                "simhash": message.get("simhash"),
+                "reply_to_message_id": message.get("reply_to_message_id"),
+                "analysis_pending": analysis_pending,
+                "analysis_attempts": 0
+            }
+            for message in messages
+        ]
+        inserted = []
+        if new_messages:
+            inserted = session.execute(_insert_new_messages().returning(Message.id), new_messages).scalars().all()
+        if backfill_message_id is not None or last_seen_message_id is not None:
+            state = session.query(ChatSyncState).filter(ChatSyncState.chat_id == chat_id).first()
+            if not state:
+                state = ChatSyncState(chat_id=chat_id)
+                session.add(state)
+            if backfill_message_id is not None:
+                state.backfill_message_id = max(state.backfill_message_id or 0, backfill_message_id)
+            if last_seen_message_id is not None:
+                state.last_seen_message_id = max(state.last_seen_message_id or 0, last_seen_message_id)
+            state.updated_at = datetime.utcnow()
+        session.commit()
+        return len(inserted)
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error storing {len(messages)} messages of chat {chat_id}: {str(e)}", exc_info=True)
+        raise e
+    finally:
+        session.close()
+def _sync_state_to_dict(state):
+    return {
+        "chat_id": state.chat_id,
+        "peer_id": state.peer_id,
+        "last_seen_message_id": state.last_seen_message_id or 0,
+        "backfill_message_id": state.backfill_message_id or 0,
+        "backfill_completed_at": state.backfill_completed_at,
+        "updated_at": state.updated_at
+    }
+async def get_chat_sync_state(chat_id):
+    """Get the backfill and gap recovery checkpoints of a chat, or None if it has none"""
+    session = SessionLocal()
+    try:
+        state = session.query(ChatSyncState).filter(ChatSyncState.chat_id == chat_id).first()
+        return _sync_state_to_dict(state) if state else None
+    except Exception as e:
+        logger.error(f"Error getting sync state of chat {chat_id}: {str(e)}", exc_info=True)
+        return None
+    finally:
+        session.close()
+async def get_chat_sync_states():
+    """Get the sync state of every chat that has one"""
+    session = SessionLocal()
+    try:
+        return [_sync_state_to_dict(state) for state in session.query(ChatSyncState).all()]
+    except Exception as e:
+        logger.error(f"Error listing chat sync states: {str(e)}", exc_info=True)
+        return []
+    finally:
+        session.close()
+async def save_last_seen_message_ids(last_seen):
+    """
+    Persist the newest message seen per chat; stored IDs only ever move forward
+    Args:
+        last_seen: Dict of chat_id to (peer_id, message_id)
+    """
+    session = SessionLocal()
+    try:
+        states = {
+            state.chat_id: state
+            for state in session.query(ChatSyncState).filter(ChatSyncState.chat_id.in_(list(last_seen))).all()
+        }
+        for chat_id, (peer_id, message_id) in last_seen.items():
+            state = states.get(chat_id)
+            if not state:
+                state = ChatSyncState(chat_id=chat_id, backfill_message_id=0, last_seen_message_id=0)
+                session.add(state)
+            state.peer_id = peer_id
+            state.last_seen_message_id = max(state.last_seen_message_id or 0, message_id)
+            state.updated_at = datetime.utcnow()
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error saving last seen message IDs of {len(last_seen)} chats: {str(e)}", exc_info=True)
+    finally:
+        session.close()
+async def mark_backfill_completed(chat_id):
+    """Record that the backfill of a chat reached its newest message"""
+    session = SessionLocal()
+    try:
+        state = session.query(ChatSyncState).filter(ChatSyncState.chat_id == chat_id).first()
+        if not state:
+            state = ChatSyncState(chat_id=chat_id, backfill_message_id=0)
+            session.add(state)
+        state.backfill_completed_at = datetime.utcnow()
+        state.updated_at = datetime.utcnow()
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error completing backfill of chat {chat_id}: {str(e)}", exc_info=True)
+    finally:
+        session.close()
+# Marked peer IDs of channels and supergroups are below this; see telethon.utils.get_peer_id
+CHANNEL_PEER_ID_OFFSET = -1000000000000
+def _invalidate_rolling_summary(session, chat_id, timestamps):
+    """Drop the rolling summary of a chat if it already folded in a message with one of these timestamps"""
+    chat = session.query(Chat).filter(Chat.chat_id == chat_id).first()
+    if not chat or not chat.rolling_summary or not chat.rolling_summary_start or not chat.last_summary_time:
+        return False
+    if not any(timestamp and chat.rolling_summary_start <= timestamp <= chat.last_summary_time for timestamp in timestamps):
+        return False
+    # refresh_rolling_summary rebuilds today's summary from the stored messages on its next run
+    chat.rolling_summary = None
+    chat.rolling_summary_start = None
+    chat.last_summary_message_id = None
+    logger.info(f"Rolling summary of chat {chat_id} invalidated by an edited or deleted message")
+    return True
+async def update_message_text(chat_id, message_id, text, simhash=None, edited_at=None):
+    """
+    Apply an edit to a stored message in place
+    The revision is bumped on every edit that changes the text. Only when the normalized text changed are the analysis fields
+    reset, open questions asked by the message dropped and a rolling summary covering it invalidated.
+    Args:
+        chat_id: Chat ID
+        message_id: Telegram message ID
+        text: New message text
+        simhash: SimHash of the new text
+        edited_at: Time of the edit (defaults to utcnow)
+    Returns:
+        Dict with revision, text_changed, attachments, timestamp and reply_to_message_id,
+        or None if the message is not stored
+    """
+    session = SessionLocal()
+    try:
+        message = session.query(Message).filter(Message.chat_id == chat_id, Message.message_id == message_id).first()
+        if not message:
+            return None
+        text_changed = text_hash(message.text) != text_hash(text)
+        # Telegram also reports loaded link previews and reactions as edits; those are not revisions
+        if message.text != text:
+            message.text = text
+            message.revision = (message.revision or 0) + 1
+            message.edited_at = edited_at or datetime.utcnow()
+        if text_changed:
+            message.simhash = simhash
+            message.is_processed = False
+            message.is_important = False
+            message.category = "default"
+            message.has_task = None
+            message.is_question = None
+            message.analysis_model = None
+            message.analysis_prompt_version = None
+            message.analyzed_at = None
+            message.analysis_pending = False
+            message.analysis_attempts = 0
+            # The analysis of the new text stores the question again if it still is one
+            session.query(UnansweredQuestion).filter(
+                UnansweredQuestion.chat_id == chat_id,
+                UnansweredQuestion.message_id == message_id,
+                UnansweredQuestion.is_answered == False
+            ).delete(synchronize_session=False)
+            _invalidate_rolling_summary(session, chat_id, [message.timestamp])
+        result = {
+            "revision": message.revision,
+            "text_changed": text_changed,
+            "attachments": _decode_attachments(message.attachments),
+            "timestamp": message.timestamp,
+            "reply_to_message_id": message.reply_to_message_id
+        }
+        session.commit()
+        logger.debug(f"Message {message_id} of chat {chat_id} edited, revision {result['revision']}, text changed: {text_changed}")
+        return result
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error applying edit of message {message_id} in chat {chat_id}: {str(e)}", exc_info=True)
+        raise e
+    finally:
+        session.close()
+async def mark_messages_deleted(chat_id, message_ids, deleted_at=None):
+    """
+    Mark messages deleted in Telegram, keeping their rows
+    Deleted messages are left out of summaries and recent message queries, their pending analysis and
+    open questions are dropped, and rolling summaries that covered them are invalidated.
+    Args:
+        chat_id: Chat ID, or None for deletions Telegram reports without a chat (private chats and basic groups)
+        message_ids: Telegram message IDs
+        deleted_at: Time of the deletion (defaults to utcnow)
+    Returns:
+        Dict of chat_id -> list of message IDs that were marked deleted
+    """
+    session = SessionLocal()
+    try:
+        query = session.query(Message).filter(Message.message_id.in_(list(message_ids)), Message.deleted_at.is_(None))
+        if chat_id is not None:
+            query = query.filter(Message.chat_id == chat_id)
+        else:
+            # Message IDs are unique per account outside channels, while every channel numbers its own
+            channel_chats = select(ChatSyncState.chat_id).where(ChatSyncState.peer_id < CHANNEL_PEER_ID_OFFSET)
+            query = query.filter(Message.chat_id.notin_(channel_chats))
+        deleted_at = deleted_at or datetime.utcnow()
+        deleted = {}
+        timestamps = {}
+        for message in query.all():
+            message.deleted_at = deleted_at
+            message.revision = (message.revision or 0) + 1
+            message.analysis_pending = False
+            deleted.setdefault(message.chat_id, []).append(message.message_id)
+            timestamps.setdefault(message.chat_id, []).append(message.timestamp)
+        for deleted_chat_id, deleted_ids in deleted.items():
+            session.query(UnansweredQuestion).filter(
+                UnansweredQuestion.chat_id == deleted_chat_id,
+                UnansweredQuestion.message_id.in_(deleted_ids),
+                UnansweredQuestion.is_answered == False
+            ).delete(synchronize_session=False)
+            _invalidate_rolling_summary(session, deleted_chat_id, timestamps[deleted_chat_id])
+        session.commit()
+        if deleted:
+            logger.info(f"Marked {sum(len(ids) for ids in deleted.values())} messages deleted in {len(deleted)} chats")
+        return deleted
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error marking {len(message_ids)} messages deleted: {str(e)}", exc_info=True)
+        raise e
+    finally:
+        session.close()
@@ -0,0 +1,271 @@
+import asyncio
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from telegram_ai_assistant.utils.db_models import init_db
+from telegram_ai_assistant.utils.db_utils import store_messages_batch
+from telegram_ai_assistant.utils.media_policy import REFERENCE, IMAGE_EXTENSIONS
+from telegram_ai_assistant.utils.near_duplicates import simhash
+from telegram_ai_assistant.utils.logging_utils import setup_main_logger
+logger = setup_main_logger()
+READ_CHUNK_SIZE = 1 << 20
+PROGRESS_INTERVAL = 5
+# Telegram Desktop media_type values mapped to the media kinds of media_policy
+EXPORT_MEDIA_KINDS = {
+    "sticker": "sticker",
+    "video_message": "video_note",
+    "voice_message": "voice",
+    "audio_file": "audio",
+    "video_file": "video",
+    "animation": "gif"
+}
+class ExportReader:
+    """
+    Incremental reader for Telegram Desktop's result.json
+    Only the containers that lead to message lists are walked; every message and every other value is
+    decoded on its own, so memory use is bounded by the largest single value rather than the file size.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.buffer = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+        self.eof = False
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.file.read(READ_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of export file")
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {self.pos} of the read buffer, found '{self.buffer[self.pos]}'")
+        self.pos += 1
+    def value(self) -> Any:
+        """Decode the next complete JSON value, reading more of the file until it is buffered"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number that ends exactly at the buffer end may continue in the next chunk
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+    def members(self) -> Iterator[str]:
+        """Iterate the keys of an object; the caller must consume each member's value"""
+        self.expect("{")
+        first = True
+        while self.peek() != "}":
+            if not first:
+                self.expect(",")
+            first = False
+            key = self.value()
+            self.expect(":")
+            yield key
+        self.pos += 1
+    def items(self) -> Iterator[None]:
+        """Iterate the elements of an array; the caller must consume each element"""
+        self.expect("[")
+        first = True
+        while self.peek() != "]":
+            if not first:
+                self.expect(",")
+            first = False
+            yield
+        self.pos += 1
+def _iter_chat(reader: ExportReader, chat: Dict[str, Any]) -> Iterator[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """Walk a chat object, collecting its scalar fields (written before "messages" by Telegram Desktop)"""
+    for key in reader.members():
+        if key == "messages":
+            for _ in reader.items():
+                yield chat, reader.value()
+        else:
+            chat[key] = reader.value()
+def iter_export(file) -> Iterator[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """
+    Stream the messages of a Telegram Desktop export
+    Handles both a single chat export and a full account export with "chats" and "left_chats" lists.
+    Args:
+        file: Text file object of result.json
+    Yields:
+        Tuples of (chat fields such as id, name and type, message object)
+    """
+    reader = ExportReader(file)
+    root: Dict[str, Any] = {}
+    for key in reader.members():
+        if key == "messages":
+            # Single chat export: the root object is the chat
+            for _ in reader.items():
+                yield root, reader.value()
+        elif key in ("chats", "left_chats"):
+            for section_key in reader.members():
+                if section_key == "list":
+                    for _ in reader.items():
+                        yield from _iter_chat(reader, {})
+                else:
+                    reader.value()
+        else:
+            value = reader.value()
+            # Account exports also carry contacts, sessions and other sections that are not needed here
+            if not isinstance(value, (dict, list)):
+                root[key] = value
+def _peer_id(value: Any) -> Optional[int]:
+    """Telegram ID from an export peer reference like "user123" or "channel123" """
+    if value is None:
+        return None
+    digits = str(value).lstrip("abcdefghijklmnopqrstuvwxyz")
+    return int(digits) if digits.isdigit() else None
+def _text(value: Any) -> str:
+    """Plain text of a message, whose text is either a string or a list of strings and entity objects"""
+    if isinstance(value, list):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in value)
+    return value or ""
+def _attachment(message: Dict[str, Any], chat_id: int, export_dir: str) -> Optional[Dict[str, Any]]:
+    """Attachment reference in the shape of media_policy.describe_media, pointing at the exported file if included"""
+    relative_path = message.get("photo") or message.get("file")
+    if not relative_path:
+        return None
+    mime_type = message.get("mime_type")
+    if message.get("photo"):
+        kind = "photo"
+        mime_type = mime_type or "image/jpeg"
+    elif message.get("media_type") in EXPORT_MEDIA_KINDS:
+        kind = EXPORT_MEDIA_KINDS[message["media_type"]]
+    elif (mime_type or "").startswith("image/") or relative_path.lower().endswith(IMAGE_EXTENSIONS):
+        kind = "image"
+    else:
+        kind = "document"
+    # Files left out of the export are recorded as "(File not included. ...)"
+    path = os.path.abspath(os.path.join(export_dir, relative_path))
+    included = os.path.isfile(path)
+    thumbnail_path = os.path.abspath(os.path.join(export_dir, message["thumbnail"])) if message.get("thumbnail") else None
+    return {
+        "kind": kind,
+        "file_key": None,
+        "mime_type": mime_type,
+        "file_name": message.get("file_name") or (os.path.basename(relative_path) if included else None),
+        "size": message.get("file_size"),
+        "chat_id": chat_id,
+        "message_id": message["id"],
+        "has_thumbnail": bool(message.get("thumbnail")) or kind == "photo",
+        "policy": REFERENCE,
+        "object": None,
+        "path": path if included else None,
+        "thumbnail_object": None,
+        "thumbnail_path": thumbnail_path if thumbnail_path and os.path.isfile(thumbnail_path) else None
+    }
+def _timestamp(message: Dict[str, Any]) -> Optional[datetime]:
+    if message.get("date_unixtime"):
+        return datetime.utcfromtimestamp(int(message["date_unixtime"]))
+    # Older exports only have the local time of the exporting machine
+    return datetime.fromisoformat(message["date"]) if message.get("date") else None
+def message_to_row(message: Dict[str, Any], chat_id: int, export_dir: str) -> Dict[str, Any]:
+    """Turn an exported message into the row shape of store_messages_batch"""
+    text = _text(message.get("text"))
+    sender_id = _peer_id(message.get("from_id")) or chat_id
+    attachment = _attachment(message, chat_id, export_dir)
+    return {
+        "message_id": message["id"],
+        "sender_id": sender_id,
+        "sender_name": message.get("from") or f"User {sender_id}",
+        "text": text,
+        "attachments": [attachment] if attachment else [],
+        "timestamp": _timestamp(message),
+        "is_bot": False,
+        "simhash": simhash(text),
+        "reply_to_message_id": message.get("reply_to_message_id")
+    }
+async def import_export(path: str, chat_ids: Optional[List[int]] = None, batch_size: int = 5000, analyze: bool = False) -> Dict[str, Any]:
+    """
+    Import a Telegram Desktop export into the messages table
+    Messages are inserted in transactions of batch_size per chat. Already stored messages are skipped,
+    so an interrupted import can simply be run again. The backfill checkpoint of each chat moves past the
+    imported messages, so an API backfill afterwards only fetches what is newer than the export.
+    Args:
+        path: Path of result.json
+        chat_ids: Only import these chats
+        batch_size: Messages per transaction
+        analyze: Queue imported messages for the reprocessing job
+    Returns:
+        Dict with chats, read, inserted and seconds
+    """
+    export_dir = os.path.dirname(os.path.abspath(path))
+    total_bytes = os.path.getsize(path)
+    stats = {"chats": 0, "read": 0, "inserted": 0, "seconds": 0.0}
+    started = time.monotonic()
+    last_report = started
+    batch: List[Dict[str, Any]] = []
+    batch_chat: Optional[Dict[str, Any]] = None
+    async def flush():
+        nonlocal batch
+        if batch:
+            stats["inserted"] += await store_messages_batch(
+                batch_chat["id"], batch_chat.get("name") or str(batch_chat["id"]), batch,
+                backfill_message_id=max(row["message_id"] for row in batch), analysis_pending=analyze
+            )
+            batch = []
+    with open(path, encoding="utf-8") as file:
+        for chat, message in iter_export(file):
+            if chat is not batch_chat:
+                await flush()
+                batch_chat = chat
+                stats["chats"] += 1
+                logger.info(f"Importing chat {chat.get('name')} ({chat.get('id')}, {chat.get('type')})")
+            stats["read"] += 1
+            if chat_ids and chat.get("id") not in chat_ids:
+                continue
+            if chat.get("id") is None or message.get("type") != "message":
+                continue
+            batch.append(message_to_row(message, chat["id"], export_dir))
+            if len(batch) >= batch_size:
+                await flush()
+            now = time.monotonic()
+            if now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                logger.info(
+                    f"Import progress: {file.buffer.tell() / max(total_bytes, 1):.0%} of {total_bytes / 1048576:.0f} MB, "
+                    f"{stats['read']} messages read, {stats['inserted']} new, {stats['read'] / (now - started):.0f} messages/s"
+                )
+        await flush()
+    stats["seconds"] = time.monotonic() - started
+    logger.info(
+        f"Import finished: {stats['chats']} chats, {stats['read']} messages read, {stats['inserted']} new "
+        f"in {stats['seconds']:.0f}s ({stats['read'] / max(stats['seconds'], 0.001):.0f} messages/s)"
+    )
+    return stats
+async def main():
+    """Import messages from a Telegram Desktop JSON export (result.json)."""
+    parser = argparse.ArgumentParser(description="Import a Telegram Desktop JSON export")
+    parser.add_argument("path", help="Path of result.json")
+    parser.add_argument("--chats", type=int, nargs="*", help="Only import these chat IDs")
+    parser.add_argument("--batch-size", type=int, default=5000, help="Messages per transaction (default: 5000)")
+    parser.add_argument("--analyze", action="store_true", help="Queue imported messages for analysis at the reprocessing rate")
+    args = parser.parse_args()
+    init_db()
+    stats = await import_export(args.path, chat_ids=args.chats, batch_size=args.batch_size, analyze=args.analyze)
+    print(
+        f"Imported {stats['inserted']} new of {stats['read']} messages from {stats['chats']} chats "
+        f"in {stats['seconds']:.0f}s ({stats['read'] / max(stats['seconds'], 0.001):.0f} messages/s)"
+    )
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,123 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+from telegram_ai_assistant.config import DOWNLOADS_DIR, MEDIA_QUOTA_BYTES, MEDIA_MAX_AGE_DAYS, MEDIA_JANITOR_INTERVAL
+from telegram_ai_assistant.utils.db_utils import (
+    get_media_objects_by_last_access,
+    delete_media_object,
+    get_messages_with_attachment,
+    update_message_attachments
+)
+from telegram_ai_assistant.utils.media_policy import normalize_attachment
+from telegram_ai_assistant.utils.media_store import OBJECTS_DIR, INCOMING_DIR
+from telegram_ai_assistant.utils.logging_utils import setup_userbot_logger
+logger = setup_userbot_logger()
+# Unfinished downloads older than this are left over from a crash
+INCOMING_MAX_AGE = timedelta(hours=1)
+_stats: Dict[str, Any] = {"runs": 0, "evicted_files": 0, "evicted_bytes": 0, "last_run": None, "last_usage_bytes": 0}
+def _untracked_files() -> List[Dict[str, Any]]:
+    """Files outside the object store: downloads of earlier versions and abandoned incoming files"""
+    files = []
+    objects_dir = os.path.abspath(OBJECTS_DIR)
+    incoming_dir = os.path.abspath(INCOMING_DIR)
+    stale_incoming = datetime.utcnow() - INCOMING_MAX_AGE
+    for root, dirs, names in os.walk(DOWNLOADS_DIR):
+        if os.path.abspath(root) == objects_dir:
+            dirs[:] = []
+            continue
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            last_used = datetime.utcfromtimestamp(stat.st_mtime)
+            if os.path.abspath(root) == incoming_dir and last_used > stale_incoming:
+                continue
+            files.append({"needle": path, "path": path, "size": stat.st_size, "last_used": last_used, "content_hash": None})
+    return files
+def _tracked_objects(media_objects: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {
+            "needle": media_object["content_hash"],
+            "path": media_object["path"],
+            "size": os.path.getsize(media_object["path"]) if os.path.exists(media_object["path"]) else 0,
+            "last_used": media_object["last_accessed_at"] or datetime.min,
+            "content_hash": media_object["content_hash"]
+        }
+        for media_object in media_objects
+    ]
+def _mark_evicted(attachment: Dict[str, Any], candidate: Dict[str, Any], evicted_at: str) -> bool:
+    """
+    Drop the local copy from an attachment while keeping its Telegram reference, which
+    media_policy.fetch_analysis_images uses to download it again when analysis needs it
+    """
+    changed = False
+    for prefix in ("", "thumbnail_"):
+        if candidate["content_hash"]:
+            matches = attachment.get(f"{prefix}object") == candidate["content_hash"]
+        else:
+            matches = attachment.get(f"{prefix}path") == candidate["path"]
+        if matches:
+            attachment[f"{prefix}object"] = None
+            attachment[f"{prefix}path"] = None
+            attachment["evicted_at"] = evicted_at
+            changed = True
+    return changed
+async def _evict(candidate: Dict[str, Any], evicted_at: str):
+    try:
+        os.remove(candidate["path"])
+    except FileNotFoundError:
+        pass
+    for message in await get_messages_with_attachment(candidate["needle"]):
+        attachments = [normalize_attachment(attachment) for attachment in message["attachments"]]
+        changed = [_mark_evicted(attachment, candidate, evicted_at) for attachment in attachments]
+        if any(changed):
+            await update_message_attachments(message["chat_id"], message["message_id"], attachments)
+    if candidate["content_hash"]:
+        await delete_media_object(candidate["content_hash"])
+    _stats["evicted_files"] += 1
+    _stats["evicted_bytes"] += candidate["size"]
+async def collect_media_garbage() -> Dict[str, Any]:
+    """
+    Evict media files unused for MEDIA_MAX_AGE_DAYS, then the least recently used ones until
+    DOWNLOADS_DIR fits in MEDIA_QUOTA_BYTES. Referencing attachments are marked evicted.
+    Returns:
+        Dict with evicted file count, freed bytes and the remaining usage in bytes
+    """
+    candidates = _tracked_objects(await get_media_objects_by_last_access()) + await asyncio.to_thread(_untracked_files)
+    candidates.sort(key=lambda candidate: candidate["last_used"])
+    usage = sum(candidate["size"] for candidate in candidates)
+    cutoff = datetime.utcnow() - timedelta(days=MEDIA_MAX_AGE_DAYS)
+    evicted_at = datetime.utcnow().isoformat()
+    evicted = 0
+    freed = 0
+    for candidate in candidates:
+        if candidate["last_used"] >= cutoff and usage <= MEDIA_QUOTA_BYTES:
+            break
+        await _evict(candidate, evicted_at)
+        usage -= candidate["size"]
+        freed += candidate["size"]
+        evicted += 1
+    _stats["runs"] += 1
+    _stats["last_run"] = evicted_at
+    _stats["last_usage_bytes"] = usage
+    if evicted:
+        logger.info(f"Media janitor evicted {evicted} files ({freed / 1048576:.1f} MB), {usage / 1048576:.1f} MB in use")
+    return {"evicted": evicted, "freed_bytes": freed, "usage_bytes": usage}
+def get_media_usage_stats() -> Dict[str, Any]:
+    """Return media storage usage as of the last janitor run, the limits and eviction counters"""
+    return dict(_stats, quota_bytes=MEDIA_QUOTA_BYTES, max_age_days=MEDIA_MAX_AGE_DAYS)
+async def media_janitor_periodically():
+    """Keep DOWNLOADS_DIR within its quota and age limit"""
+    logger.info(
+        f"Starting media janitor every {MEDIA_JANITOR_INTERVAL} seconds, "
+        f"quota {MEDIA_QUOTA_BYTES / 1048576:.0f} MB, max age {MEDIA_MAX_AGE_DAYS} days"
+    )
+    while True:
+        try:
+            await collect_media_garbage()
+        except Exception as e:
+            logger.error(f"Error in media janitor: {str(e)}", exc_info=True)
+        await asyncio.sleep(MEDIA_JANITOR_INTERVAL)
@@ -0,0 +1,355 @@
+import asyncio
+import os
+from typing import Any, Dict, List, Optional
+from telegram_ai_assistant.config import (
+    MEDIA_POLICIES,
+    MEDIA_CHAT_POLICIES,
+    MEDIA_EAGER_MAX_BYTES,
+    MEDIA_DOWNLOAD_CONCURRENCY
+)
+from telegram_ai_assistant.utils.db_utils import get_message_attachments, update_message_attachments, touch_media_object
+from telegram_ai_assistant.utils.media_store import reuse_object, store_file, incoming_path
+from telegram_ai_assistant.utils.logging_utils import setup_userbot_logger
+logger = setup_userbot_logger()
+EAGER = "eager"
+THUMBNAIL = "thumbnail"
+REFERENCE = "reference"
+MEMORY = "memory"
+POLICIES = (EAGER, THUMBNAIL, REFERENCE, MEMORY)
+# Only what analysis can use is downloaded by default; MEDIA_POLICIES overrides per kind
+DEFAULT_POLICIES = {
+    "photo": EAGER,
+    "image": EAGER,
+    "video": THUMBNAIL,
+    "gif": THUMBNAIL,
+    "video_note": THUMBNAIL,
+    "sticker": REFERENCE,
+    "voice": REFERENCE,
+    "audio": REFERENCE,
+    "document": REFERENCE
+}
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+IMAGE_KINDS = ("photo", "image")
+_download_semaphore = asyncio.Semaphore(MEDIA_DOWNLOAD_CONCURRENCY)
+def media_kind(message) -> str:
+    """Classify the media of a Telethon message"""
+    if getattr(message, "photo", None):
+        return "photo"
+    for kind in ("sticker", "video_note", "gif", "voice", "audio", "video"):
+        if getattr(message, kind, None):
+            return kind
+    file = getattr(message, "file", None)
+    if file is not None and (getattr(file, "mime_type", None) or "").startswith("image/"):
+        return "image"
+    return "document"
+def choose_policy(kind: str, size: Optional[int], chat_id: int, has_thumbnail: bool) -> str:
+    """
+    Decide how much of an attachment to download at ingest
+    Args:
+        kind: Media kind from media_kind
+        size: File size in bytes, if known
+        chat_id: Chat the message belongs to
+        has_thumbnail: Whether Telegram provides a preview of the file
+    Returns:
+        "eager", "thumbnail", "reference" or "memory"
+    """
+    chat_policy = MEDIA_CHAT_POLICIES.get(str(chat_id))
+    if isinstance(chat_policy, dict):
+        chat_policy = chat_policy.get(kind)
+    policy = chat_policy or MEDIA_POLICIES.get(kind) or DEFAULT_POLICIES.get(kind, REFERENCE)
+    if policy not in POLICIES:
+        logger.warning(f"Unknown media policy '{policy}' for {kind}, keeping a reference only")
+        policy = REFERENCE
+    if policy == EAGER and size and size > MEDIA_EAGER_MAX_BYTES:
+        policy = THUMBNAIL
+    if policy == THUMBNAIL and not has_thumbnail:
+        policy = REFERENCE
+    if policy == MEMORY and kind not in IMAGE_KINDS and not has_thumbnail:
+        policy = REFERENCE
+    return policy
+def describe_media(message, chat_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Build the attachment reference of a Telethon message without downloading anything
+    Args:
+        message: Telethon message with media
+        chat_id: Chat ID, used with the message ID to fetch the file later
+    Returns:
+        Attachment dict with kind, file metadata, policy and empty local paths, or None without media
+    """
+    if not getattr(message, "media", None):
+        return None
+    file = getattr(message, "file", None)
+    kind = media_kind(message)
+    size = getattr(file, "size", None) if file else None
+    if kind == "photo":
+        has_thumbnail = True
+        file_key = f"photo:{message.photo.id}"
+    else:
+        document = getattr(message, "document", None)
+        has_thumbnail = bool(getattr(document, "thumbs", None))
+        file_key = f"document:{document.id}" if getattr(document, "id", None) else None
+    return {
+        "kind": kind,
+        "file_key": file_key,
+        "mime_type": getattr(file, "mime_type", None) if file else None,
+        "file_name": getattr(file, "name", None) if file else None,
+        "size": size,
+        "chat_id": chat_id,
+        "message_id": message.id,
+        "has_thumbnail": has_thumbnail,
+        "policy": choose_policy(kind, size, chat_id, has_thumbnail),
+        "object": None,
+        "path": None,
+        "thumbnail_object": None,
+        "thumbnail_path": None
+    }
+def normalize_attachment(attachment: Any) -> Dict[str, Any]:
+    """Turn an attachment stored as a plain file path (before media policies) into an attachment dict"""
+    if isinstance(attachment, dict):
+        return attachment
+    path = str(attachment)
+    return {
+        "kind": "image" if path.lower().endswith(IMAGE_EXTENSIONS) else "document",
+        "file_name": os.path.basename(path),
+        "policy": EAGER,
+        "path": path,
+        "thumbnail_path": None
+    }
+def local_image_path(attachment: Dict[str, Any]) -> Optional[str]:
+    """Path of a downloaded image, or of the downloaded preview of another file, usable for vision analysis"""
+    path = attachment.get("path")
+    if path and path.lower().endswith(IMAGE_EXTENSIONS) and os.path.exists(path):
+        return path
+    thumbnail_path = attachment.get("thumbnail_path")
+    if thumbnail_path and os.path.exists(thumbnail_path):
+        return thumbnail_path
+    return None
+def _needs_download(attachment: Dict[str, Any]) -> Optional[str]:
+    """What the policy of an attachment still requires locally: "eager", "thumbnail" or None"""
+    if attachment.get("evicted_at"):
+        # Evicted by the janitor; fetch_analysis_images brings it back through ensure_attachment when needed
+        return None
+    if attachment.get("policy") == EAGER and not (attachment.get("path") and os.path.exists(attachment["path"])):
+        return EAGER
+    if attachment.get("policy") == THUMBNAIL and not (
+        attachment.get("thumbnail_path") and os.path.exists(attachment["thumbnail_path"])
+    ):
+        return THUMBNAIL
+    return None
+async def _get_message(client, attachment: Dict[str, Any], message=None):
+    if message is not None and getattr(message, "media", None):
+        return message
+    # File references expire, so the message is fetched again to get a fresh one
+    return await client.get_messages(attachment["chat_id"], ids=attachment["message_id"])
+def _file_key(attachment: Dict[str, Any], thumbnail: bool) -> Optional[str]:
+    file_key = attachment.get("file_key")
+    return f"{file_key}:thumb" if file_key and thumbnail else file_key
+def _set_object(attachment: Dict[str, Any], media_object: Dict[str, Any], thumbnail: bool):
+    """Point an attachment at its canonical object in the media store"""
+    prefix = "thumbnail_" if thumbnail else ""
+    attachment[f"{prefix}object"] = media_object["content_hash"]
+    attachment[f"{prefix}path"] = media_object["path"]
+async def fetch_attachment(client, attachment: Dict[str, Any], thumbnail: bool = False, message=None) -> Optional[Dict[str, Any]]:
+    """
+    Get an attachment, or its preview, into the media store
+    A file already stored under the same Telegram file key is referenced without downloading it;
+    otherwise it is downloaded and deduplicated by content hash.
+    Args:
+        client: Telethon client
+        attachment: Attachment dict with chat_id, message_id and file_key
+        thumbnail: Download only the largest preview instead of the file
+        message: Telethon message, if already at hand
+    Returns:
+        Media object with content_hash and path, or None if the file could not be downloaded
+    """
+    file_key = _file_key(attachment, thumbnail)
+    media_object = await reuse_object(file_key)
+    if media_object:
+        return media_object
+    if attachment.get("chat_id") is None or attachment.get("message_id") is None:
+        return None
+    async with _download_semaphore:
+        try:
+            message = await _get_message(client, attachment, message)
+            if not message or not message.media:
+                logger.warning(f"Message {attachment['message_id']} in chat {attachment['chat_id']} has no media anymore")
+                return None
+            if thumbnail:
+                downloaded_path = await client.download_media(message, file=incoming_path(), thumb=-1)
+            else:
+                downloaded_path = await client.download_media(message, file=incoming_path())
+        except Exception as e:
+            logger.error(f"Error downloading media of message {attachment.get('message_id')}: {str(e)}", exc_info=True)
+            return None
+    if not downloaded_path:
+        return None
+    return await store_file(downloaded_path, file_key=file_key, mime_type=None if thumbnail else attachment.get("mime_type"))
+async def fetch_attachment_bytes(client, attachment: Dict[str, Any], thumbnail: bool = False, message=None) -> Optional[bytes]:
+    """
+    Download an attachment, or its preview, into memory without touching the disk
+    Args:
+        client: Telethon client
+        attachment: Attachment dict with chat_id and message_id
+        thumbnail: Download only the largest preview instead of the file
+        message: Telethon message, if already at hand
+    Returns:
+        File content, or None if the file could not be downloaded
+    """
+    if attachment.get("chat_id") is None or attachment.get("message_id") is None:
+        return None
+    async with _download_semaphore:
+        try:
+            message = await _get_message(client, attachment, message)
+            if not message or not message.media:
+                logger.warning(f"Message {attachment['message_id']} in chat {attachment['chat_id']} has no media anymore")
+                return None
+            if thumbnail:
+                return await client.download_media(message, file=bytes, thumb=-1)
+            return await client.download_media(message, file=bytes)
+        except Exception as e:
+            logger.error(f"Error downloading media of message {attachment.get('message_id')} into memory: {str(e)}", exc_info=True)
+            return None
+async def load_media_buffers(client, message_data: Dict[str, Any], message=None) -> Dict[int, memoryview]:
+    """
+    Download the attachments with the "memory" policy into buffers for vision analysis
+    Images are loaded whole unless larger than MEDIA_EAGER_MAX_BYTES; other files contribute their preview.
+    Nothing is written to disk and the attachments keep only their Telegram reference.
+    Args:
+        client: Telethon client
+        message_data: Message with chat_id, message_id and attachments
+        message: Telethon message, if already at hand
+    Returns:
+        Dict of attachment index to buffer, for the attachments that could be downloaded
+    """
+    pending = []
+    for index, attachment in enumerate(map(normalize_attachment, message_data.get("attachments") or [])):
+        if attachment.get("policy") != MEMORY or local_image_path(attachment):
+            continue
+        size = attachment.get("size")
+        thumbnail = attachment.get("kind") not in IMAGE_KINDS or bool(size and size > MEDIA_EAGER_MAX_BYTES)
+        if thumbnail and not attachment.get("has_thumbnail"):
+            continue
+        pending.append((index, attachment, thumbnail))
+    if not pending:
+        return {}
+    contents = await asyncio.gather(*(
+        fetch_attachment_bytes(client, attachment, thumbnail=thumbnail, message=message)
+        for _, attachment, thumbnail in pending
+    ))
+    buffers = {index: memoryview(content) for (index, _, _), content in zip(pending, contents) if content}
+    logger.debug(f"Loaded {len(buffers)} attachments of message {message_data.get('message_id')} into memory")
+    return buffers
+async def materialize_attachments(client, message_data: Dict[str, Any], message=None) -> List[Dict[str, Any]]:
+    """
+    Get what the media policy of each attachment requires into the media store
+    Runs after the message is stored, so ingestion does not wait for downloads. Attachments
+    whose files went missing are fetched again through their Telegram reference.
+    Args:
+        client: Telethon client
+        message_data: Message with chat_id, message_id and attachments
+        message: Telethon message, if already at hand
+    Returns:
+        Updated attachment dicts
+    """
+    attachments = [normalize_attachment(attachment) for attachment in message_data.get("attachments") or []]
+    pending = [(attachment, _needs_download(attachment)) for attachment in attachments]
+    pending = [(attachment, need) for attachment, need in pending if need]
+    if not pending:
+        return attachments
+    media_objects = await asyncio.gather(*(
+        fetch_attachment(client, attachment, thumbnail=need == THUMBNAIL, message=message)
+        for attachment, need in pending
+    ))
+    for (attachment, need), media_object in zip(pending, media_objects):
+        if media_object:
+            _set_object(attachment, media_object, thumbnail=need == THUMBNAIL)
+            logger.debug(f"Stored {need} of {attachment['kind']} of message {message_data['message_id']} as {media_object['path']}")
+    await update_message_attachments(message_data["chat_id"], message_data["message_id"], attachments)
+    return attachments
+async def ensure_attachment(client, chat_id: int, message_id: int, index: int = 0, thumbnail: bool = False,
+                            message=None) -> Optional[str]:
+    """
+    Return a local copy of a stored attachment, downloading it on demand if only its reference is kept
+    Args:
+        client: Telethon client
+        chat_id: Chat ID
+        message_id: Telegram message ID
+        index: Position of the attachment in the message
+        thumbnail: Whether the preview is enough
+        message: Telethon message, if already at hand
+    Returns:
+        Local path, or None if the message, attachment or file is not available
+    """
+    attachments = await get_message_attachments(chat_id, message_id)
+    if not attachments or index >= len(attachments):
+        return None
+    attachments = [normalize_attachment(attachment) for attachment in attachments]
+    attachment = attachments[index]
+    prefix = "thumbnail_" if thumbnail else ""
+    path = attachment.get(f"{prefix}path")
+    if path and os.path.exists(path):
+        if attachment.get(f"{prefix}object"):
+            await touch_media_object(attachment[f"{prefix}object"])
+        return path
+    attachment.setdefault("chat_id", chat_id)
+    attachment.setdefault("message_id", message_id)
+    media_object = await fetch_attachment(client, attachment, thumbnail=thumbnail, message=message)
+    if not media_object:
+        return None
+    _set_object(attachment, media_object, thumbnail)
+    attachment.pop("evicted_at", None)
+    await update_message_attachments(chat_id, message_id, attachments)
+    return media_object["path"]
+def _on_demand_preview(attachment: Dict[str, Any]) -> Optional[bool]:
+    """
+    Whether analysis should fetch an attachment that has no local copy, and which part of it:
+    False for the file, True for its preview, None when nothing is fetched. Evicted files are
+    brought back as they were stored, images kept as a reference only are fetched like eager ones.
+    """
+    if local_image_path(attachment) or attachment.get("policy") == MEMORY:
+        return None
+    if attachment.get("evicted_at"):
+        thumbnail = attachment.get("policy") == THUMBNAIL or attachment.get("kind") not in IMAGE_KINDS
+    elif attachment.get("policy") == REFERENCE and attachment.get("kind") in IMAGE_KINDS:
+        size = attachment.get("size")
+        thumbnail = bool(size and size > MEDIA_EAGER_MAX_BYTES)
+    else:
+        return None
+    if thumbnail and not attachment.get("has_thumbnail"):
+        return None
+    return thumbnail
+async def fetch_analysis_images(client, message_data: Dict[str, Any], message=None) -> List[Dict[str, Any]]:
+    """
+    Fetch on demand, with ensure_attachment, the images analysis needs but the store does not hold:
+    files evicted by the janitor and images with the "reference" policy
+    Args:
+        client: Telethon client
+        message_data: Stored message with chat_id, message_id, attachments and optional media_buffers
+        message: Telethon message, if already at hand
+    Returns:
+        Attachment dicts, updated with the fetched files
+    """
+    attachments = [normalize_attachment(attachment) for attachment in message_data.get("attachments") or []]
+    buffers = message_data.get("media_buffers") or {}
+    pending = [(index, _on_demand_preview(attachment)) for index, attachment in enumerate(attachments) if index not in buffers]
+    pending = [(index, thumbnail) for index, thumbnail in pending if thumbnail is not None]
+    if not pending:
+        return attachments
+    # One at a time: each ensure_attachment rewrites the attachment list of the message
+    paths = []
+    for index, thumbnail in pending:
+        paths.append(await ensure_attachment(
+            client, message_data["chat_id"], message_data["message_id"], index, thumbnail, message=message
+        ))
+    logger.debug(f"Fetched {sum(1 for path in paths if path)}/{len(paths)} attachments of message {message_data['message_id']} on demand")
+    # ensure_attachment stored the new objects with the message; read them back with their content hashes
+    stored = await get_message_attachments(message_data["chat_id"], message_data["message_id"])
+    return [normalize_attachment(attachment) for attachment in stored] if stored else attachments
+def describe_attachment(attachment: Dict[str, Any]) -> str:
+    """Short text description of an attachment for prompts"""
+    details = [attachment.get("kind") or "file"]
+    if attachment.get("file_name"):
+        details.append(attachment["file_name"])
+    if attachment.get("size"):
+        details.append(f"{attachment['size'] / 1024:.0f} KB")
+    return ", ".join(details)
@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from typing import Any, Dict, Optional
+from telegram_ai_assistant.config import DOWNLOADS_DIR
+from telegram_ai_assistant.utils.db_utils import get_media_object, add_media_reference, save_media_analysis
+from telegram_ai_assistant.utils.logging_utils import setup_userbot_logger
+logger = setup_userbot_logger()
+OBJECTS_DIR = os.path.join(DOWNLOADS_DIR, "objects")
+INCOMING_DIR = os.path.join(DOWNLOADS_DIR, "incoming")
+HASH_CHUNK_SIZE = 1 << 20
+# Attachment kinds whose cached analysis can stand in for the analysis of a message with just that file
+ANALYZABLE_KINDS = ("photo", "image")
+ANALYSIS_KEYS = ("category", "is_important", "has_task", "is_question", "context_summary", "model", "prompt_version")
+_stats = {"stored": 0, "reused_by_file_key": 0, "reused_by_hash": 0, "bytes_saved": 0, "analysis_hits": 0}
+def hash_file(path: str) -> str:
+    """SHA-256 of a file, read in chunks so large files never sit in memory"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+def object_path(content_hash: str, extension: str = "") -> str:
+    """Canonical location of an object, fanned out over subdirectories by hash prefix"""
+    return os.path.join(OBJECTS_DIR, content_hash[:2], content_hash[2:4], f"{content_hash}{extension}")
+def incoming_path() -> str:
+    """Temporary download location; files are moved into the store once their hash is known"""
+    os.makedirs(INCOMING_DIR, exist_ok=True)
+    return os.path.join(INCOMING_DIR, uuid.uuid4().hex)
+async def reuse_object(file_key: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Reference an already stored object for a Telegram file, so it is not downloaded again
+    Args:
+        file_key: Telegram file key of the attachment
+    Returns:
+        The media object, or None if the file is not in the store
+    """
+    if not file_key:
+        return None
+    media_object = await get_media_object(file_key=file_key)
+    if not media_object or not os.path.exists(media_object["path"]):
+        return None
+    _stats["reused_by_file_key"] += 1
+    _stats["bytes_saved"] += media_object["size"] or 0
+    return await add_media_reference(media_object["content_hash"])
+async def store_file(downloaded_path: str, file_key: Optional[str] = None, mime_type: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Move a downloaded file into the content-addressed store
+    A file whose content is already stored is discarded and the existing object is referenced instead.
+    Args:
+        downloaded_path: File returned by the download
+        file_key: Telegram file key to associate with the object
+        mime_type: MIME type of the file
+    Returns:
+        The media object, or None on error
+    """
+    content_hash = await asyncio.to_thread(hash_file, downloaded_path)
+    existing = await get_media_object(content_hash=content_hash)
+    if existing and os.path.exists(existing["path"]):
+        _stats["reused_by_hash"] += 1
+        _stats["bytes_saved"] += os.path.getsize(downloaded_path)
+        os.remove(downloaded_path)
+        path = existing["path"]
+        logger.debug(f"Downloaded file is identical to stored object {content_hash[:12]}, keeping one copy")
+    else:
+        path = object_path(content_hash, os.path.splitext(downloaded_path)[1].lower())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(downloaded_path, path)
+        _stats["stored"] += 1
+    return await add_media_reference(
+        content_hash, path=path, size=os.path.getsize(path), mime_type=mime_type, file_key=file_key
+    )
+def _single_media_hash(message_data: Dict[str, Any]) -> Optional[str]:
+    """Object hash of a message that consists of a single image and no text"""
+    attachments = message_data.get("attachments") or []
+    if (message_data.get("text") or "").strip() or len(attachments) != 1:
+        return None
+    attachment = attachments[0]
+    if not isinstance(attachment, dict) or attachment.get("kind") not in ANALYZABLE_KINDS:
+        return None
+    return attachment.get("object")
+async def find_media_duplicate(message_data: Dict[str, Any], prompt_version: str) -> Optional[Dict[str, Any]]:
+    """
+    Find the cached analysis of an image-only message whose image was analyzed before
+    Args:
+        message_data: Message with materialized attachments
+        prompt_version: Only analyses made with this prompt version are reused
+    Returns:
+        Dict with chat_id, message_id, analysis and distance (0) of the original message, or None
+    """
+    content_hash = _single_media_hash(message_data)
+    if not content_hash:
+        return None
+    media_object = await get_media_object(content_hash=content_hash)
+    cached = (media_object or {}).get("analysis") or {}
+    if cached.get("prompt_version") != prompt_version:
+        return None
+    if (cached.get("chat_id"), cached.get("message_id")) == (message_data["chat_id"], message_data["message_id"]):
+        return None
+    _stats["analysis_hits"] += 1
+    logger.info(f"Message {message_data['message_id']} reuses the analysis of image {content_hash[:12]}")
+    return {
+        "chat_id": cached["chat_id"],
+        "message_id": cached["message_id"],
+        "analysis": {key: cached.get(key) for key in ANALYSIS_KEYS},
+        "distance": 0
+    }
+async def remember_media_analysis(message_data: Dict[str, Any], analysis: Dict[str, Any]):
+    """Cache the analysis of an image-only message on its media object"""
+    content_hash = _single_media_hash(message_data)
+    if not content_hash or analysis.get("deferred") or analysis.get("error"):
+        return
+    cached = {key: analysis.get(key) for key in ANALYSIS_KEYS}
+    cached.update(chat_id=message_data["chat_id"], message_id=message_data["message_id"])
+    await save_media_analysis(content_hash, cached)
+def get_media_store_stats() -> Dict[str, int]:
+    """Return media store counters since startup"""
+    return dict(_stats)
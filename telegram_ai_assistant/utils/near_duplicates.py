@@ -0,0 +1,136 @@
+import re
+import time
+import unicodedata
+from collections import deque
+from hashlib import blake2b
+from typing import Dict, Any, Deque, List, Optional
+import numpy as np
+from telegram_ai_assistant.config import (
+    DUPLICATE_WINDOW_HOURS,
+    DUPLICATE_WINDOW_SIZE,
+    DUPLICATE_MAX_DISTANCE,
+    DUPLICATE_MIN_LENGTH
+)
+from telegram_ai_assistant.utils.logging_utils import setup_ai_logger
+logger = setup_ai_logger()
+FINGERPRINT_BITS = 64
+_BIT_POSITIONS = np.arange(FINGERPRINT_BITS, dtype=np.uint64)
+_URL = re.compile(r"https?://\S+")
+_DIGITS = re.compile(r"\d+")
+# Analyzed messages of the last DUPLICATE_WINDOW_HOURS, oldest first
+_window: Deque[Dict[str, Any]] = deque(maxlen=DUPLICATE_WINDOW_SIZE)
+_stats = {"lookups": 0, "duplicates": 0}
+def _tokens(text: str) -> List[str]:
+    """Lowercased word bigrams with URLs and numbers masked, so notifications that differ only in a
+    time, counter or link get the same fingerprint"""
+    words = re.sub(r"[^\w\s]", " ", _DIGITS.sub("0", _URL.sub(" url ", text.lower()))).split()
+    if len(words) < 2:
+        return words
+    return [f"{a} {b}" for a, b in zip(words, words[1:])]
+def simhash(text: Optional[str]) -> Optional[int]:
+    """
+    64-bit SimHash fingerprint of a message text
+    Args:
+        text: Message text
+    Returns:
+        Signed 64-bit fingerprint (fits an SQLite INTEGER), or None for texts too short to compare
+    """
+    if not text or len(text.strip()) < DUPLICATE_MIN_LENGTH:
+        return None
+    tokens = _tokens(text)
+    if not tokens:
+        return None
+    hashes = np.array(
+        [int.from_bytes(blake2b(token.encode("utf-8"), digest_size=8).digest(), "little") for token in tokens],
+        dtype=np.uint64
+    )
+    bits = ((hashes[:, None] >> _BIT_POSITIONS) & np.uint64(1)).astype(np.int32)
+    votes = (bits * 2 - 1).sum(axis=0)
+    fingerprint = sum(1 << i for i in np.flatnonzero(votes > 0).tolist())
+    return fingerprint - (1 << FINGERPRINT_BITS) if fingerprint >= 1 << (FINGERPRINT_BITS - 1) else fingerprint
+def text_hash(text: Optional[str]) -> str:
+    """
+    Hash of a message text after Unicode, case and whitespace normalization
+    Edits that only touch formatting or spacing keep the same hash and do not need a new analysis.
+    """
+    normalized = " ".join(unicodedata.normalize("NFKC", text or "").casefold().split())
+    return blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+def hamming_distance(a: int, b: int) -> int:
+    return ((a ^ b) & ((1 << FINGERPRINT_BITS) - 1)).bit_count()
+def _evict_expired(now: float):
+    cutoff = now - DUPLICATE_WINDOW_HOURS * 3600
+    while _window and _window[0]["seen_at"] < cutoff:
+        _window.popleft()
+def find_duplicate(fingerprint: Optional[int], chat_id: int, message_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Find an already analyzed message whose fingerprint is within DUPLICATE_MAX_DISTANCE bits
+    Args:
+        fingerprint: SimHash of the new message
+        chat_id: Chat of the new message, so a message is never its own duplicate
+        message_id: Telegram ID of the new message
+    Returns:
+        Window entry with chat_id, message_id, analysis and distance of the closest match, or None
+    """
+    if fingerprint is None:
+        return None
+    _stats["lookups"] += 1
+    _evict_expired(time.time())
+    best = None
+    for entry in reversed(_window):
+        if entry["chat_id"] == chat_id and entry["message_id"] == message_id:
+            continue
+        distance = hamming_distance(fingerprint, entry["fingerprint"])
+        if distance <= DUPLICATE_MAX_DISTANCE and (best is None or distance < best["distance"]):
+            best = dict(entry, distance=distance)
+            if distance == 0:
+                break
+    if best:
+        _stats["duplicates"] += 1
+        logger.info(
+            f"Message {message_id} in chat {chat_id} is a near duplicate of message {best['message_id']} "
+            f"in chat {best['chat_id']} (distance {best['distance']}), "
+            f"{_stats['duplicates']}/{_stats['lookups']} duplicates so far"
+        )
+    return best
+def remember_analysis(fingerprint: Optional[int], chat_id: int, message_id: int, analysis: Dict[str, Any],
+                      seen_at: Optional[float] = None):
+    """Add an analyzed message to the sliding window so later copies can reuse its analysis"""
+    if fingerprint is None or analysis.get("deferred") or analysis.get("error"):
+        return
+    _window.append({
+        "fingerprint": fingerprint,
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "analysis": {
+            key: analysis.get(key)
+            for key in ("category", "is_important", "has_task", "is_question", "context_summary", "model", "prompt_version")
+        },
+        "seen_at": seen_at if seen_at is not None else time.time()
+    })
+def forget_messages(chat_id: int, message_ids: List[int]) -> int:
+    """
+    Drop edited or deleted messages from the window so no later copy reuses their outdated analysis
+    Returns:
+        Number of entries removed
+    """
+    message_ids = set(message_ids)
+    kept = [entry for entry in _window if entry["chat_id"] != chat_id or entry["message_id"] not in message_ids]
+    removed = len(_window) - len(kept)
+    if removed:
+        _window.clear()
+        _window.extend(kept)
+    return removed
+def load_window(entries: List[Dict[str, Any]]):
+    """
+    Rebuild the window after a restart from stored fingerprints and analyses
+    Args:
+        entries: Dicts with fingerprint, chat_id, message_id, analysis and seen_at (epoch seconds), oldest first
+    """
+    _window.clear()
+    for entry in entries:
+        remember_analysis(entry["fingerprint"], entry["chat_id"], entry["message_id"], entry["analysis"], entry["seen_at"])
+    _evict_expired(time.time())
+    logger.info(f"Loaded {len(_window)} analyzed messages into the near-duplicate window")
+def get_duplicate_stats() -> Dict[str, int]:
+    """Return near-duplicate lookup counters since startup"""
+    return dict(_stats, window=len(_window))
@@ -0,0 +1,40 @@
+from collections import OrderedDict
+from typing import Dict, Tuple
+from telegram_ai_assistant.config import RECENT_MESSAGE_IDS_SIZE
+# (chat_id, message_id) of the most recently received messages, least recent first
+_recent: "OrderedDict[Tuple[int, int], None]" = OrderedDict()
+_stats = {"checked": 0, "dropped": 0}
+def seen_recently(chat_id: int, message_id: int) -> bool:
+    """
+    Check a received message against the last RECENT_MESSAGE_IDS_SIZE stored ones
+    Redelivered updates are dropped here before any API, database or LLM work; older repeats are
+    still caught by the unique (chat_id, message_id) constraint of the messages table. Messages are
+    only added by remember_message, so one that failed to store is processed again when redelivered.
+    Args:
+        chat_id: Chat ID
+        message_id: Telegram message ID
+    Returns:
+        True if the message was received before
+    """
+    _stats["checked"] += 1
+    key = (chat_id, message_id)
+    if key in _recent:
+        _recent.move_to_end(key)
+        _stats["dropped"] += 1
+        return True
+    return False
+def remember_message(chat_id: int, message_id: int):
+    """
+    Add a message to the recently received ones, once it is stored
+    Args:
+        chat_id: Chat ID
+        message_id: Telegram message ID
+    """
+    key = (chat_id, message_id)
+    _recent[key] = None
+    _recent.move_to_end(key)
+    if len(_recent) > RECENT_MESSAGE_IDS_SIZE:
+        _recent.popitem(last=False)
+def get_recent_message_stats() -> Dict[str, int]:
+    """Return how many received messages were checked and dropped as repeats since startup"""
+    return dict(_stats, size=len(_recent))
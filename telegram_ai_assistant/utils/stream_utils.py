@@ -0,0 +1,162 @@
+import asyncio
+import time
+from typing import List, Optional
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from telegram_ai_assistant.config import STREAM_EDIT_INTERVAL
+from telegram_ai_assistant.ai_module.usage_tracker import check_budget, record_usage
+from telegram_ai_assistant.ai_module.llm_gateway import circuit_breaker
+from telegram_ai_assistant.utils.logging_utils import setup_bot_logger
+logger = setup_bot_logger()
+TELEGRAM_MESSAGE_LIMIT = 4096
+def split_message_text(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """
+    Split text into Telegram-sized pages, preferring to break at a newline
+    Args:
+        text: Text to split
+        limit: Maximum page length
+    Returns:
+        List of pages (at least one, possibly empty)
+    """
+    pages = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        pages.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    pages.append(text)
+    return pages
+class TelegramStreamWriter:
+    """
+    Renders a growing text into one or more Telegram messages.
+    Edits are throttled to STREAM_EDIT_INTERVAL seconds so streaming stays under
+    Telegram's edit rate limits, and text beyond 4096 characters continues in
+    follow-up messages. Intermediate edits are sent as plain text because partial
+    Markdown/HTML is usually unparseable; finish() applies the real parse mode.
+    """
+    def __init__(self, bot: Bot, chat_id: int, message_id: Optional[int] = None,
+                 header: str = "", min_interval: float = STREAM_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_ids: List[int] = [message_id] if message_id else []
+        self.header = header
+        self.buffer = ""
+        self.min_interval = min_interval
+        self._sent_pages: List[str] = []
+        self._last_edit = 0.0
+        self._lock = asyncio.Lock()
+    async def start(self, placeholder: str = "…"):
+        """Send the first message right away if the writer does not own one yet"""
+        if not self.message_ids:
+            message = await self.bot.send_message(self.chat_id, f"{self.header}{placeholder}", parse_mode=None)
+            self.message_ids.append(message.message_id)
+            self._sent_pages = [f"{self.header}{placeholder}"]
+    def reset(self, header: Optional[str] = None):
+        """Start rendering a new text into the same messages"""
+        if header is not None:
+            self.header = header
+        self.buffer = ""
+    async def append(self, delta: str):
+        """Add streamed text and edit the messages if the throttle interval has passed"""
+        if not delta:
+            return
+        self.buffer += delta
+        if time.monotonic() - self._last_edit >= self.min_interval:
+            await self._render(self.header + self.buffer, parse_mode=None)
+    async def update(self, text: str):
+        """Replace the streamed text, subject to the same throttle as append()"""
+        self.buffer = text
+        if time.monotonic() - self._last_edit >= self.min_interval:
+            await self._render(self.header + self.buffer, parse_mode=None)
+    async def finish(self, final_text: Optional[str] = None, parse_mode: Optional[str] = None) -> str:
+        """
+        Render the final text with the requested parse mode, falling back to plain text
+        Args:
+            final_text: Text to show instead of header + streamed buffer
+            parse_mode: "Markdown", "HTML" or None
+        Returns:
+            The rendered text
+        """
+        text = final_text if final_text is not None else self.header + self.buffer
+        try:
+            await self._render(text, parse_mode=parse_mode, force=True)
+        except TelegramBadRequest as e:
+            logger.warning(f"Could not render streamed message with {parse_mode}: {str(e)}, sending plain text")
+            await self._render(text, parse_mode=None, force=True)
+        await self._drop_extra_pages(len(split_message_text(text)))
+        return text
+    async def _render(self, text: str, parse_mode: Optional[str], force: bool = False):
+        async with self._lock:
+            if not force and time.monotonic() - self._last_edit < self.min_interval:
+                return
+            pages = split_message_text(text)
+            for index, page in enumerate(pages):
+                if not page:
+                    continue
+                if index < len(self.message_ids):
+                    if not force and index < len(self._sent_pages) and self._sent_pages[index] == page:
+                        continue
+                    await self._edit(self.message_ids[index], page, parse_mode)
+                else:
+                    message = await self._send(page, parse_mode)
+                    self.message_ids.append(message.message_id)
+                if index < len(self._sent_pages):
+                    self._sent_pages[index] = page
+                else:
+                    self._sent_pages.append(page)
+            self._last_edit = time.monotonic()
+    async def _edit(self, message_id: int, page: str, parse_mode: Optional[str]):
+        try:
+            await self.bot.edit_message_text(text=page, chat_id=self.chat_id, message_id=message_id, parse_mode=parse_mode)
+        except TelegramRetryAfter as e:
+            logger.debug(f"Edit throttled by Telegram, retrying after {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+            await self.bot.edit_message_text(text=page, chat_id=self.chat_id, message_id=message_id, parse_mode=parse_mode)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+    async def _send(self, page: str, parse_mode: Optional[str]):
+        try:
+            return await self.bot.send_message(self.chat_id, page, parse_mode=parse_mode)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            return await self.bot.send_message(self.chat_id, page, parse_mode=parse_mode)
+    async def _drop_extra_pages(self, page_count: int):
+        """Delete overflow messages left over from a longer earlier render"""
+        while len(self.message_ids) > max(page_count, 1):
+            message_id = self.message_ids.pop()
+            if len(self._sent_pages) > len(self.message_ids):
+                self._sent_pages.pop()
+            try:
+                await self.bot.delete_message(self.chat_id, message_id)
+            except Exception as e:
+                logger.debug(f"Could not delete overflow message {message_id}: {str(e)}")
+async def stream_chat_completion(client, writer: TelegramStreamWriter, call_site: str = "stream", **kwargs) -> str:
+    """
+    Run a streaming chat completion and pipe the tokens into a Telegram message
+    The request goes through the LLM circuit breaker like chat_completion; callers bound it by
+    the current deadline with llm_gateway.bounded.
+    Args:
+        client: AsyncOpenAI client
+        writer: Stream writer that renders the partial answer
+        call_site: Name of the code path making the request, used for token accounting
+        **kwargs: Arguments for client.chat.completions.create
+    Returns:
+        The full completion text
+    """
+    await check_budget(call_site)
+    parts = []
+    with circuit_breaker(call_site):
+        await writer.start()
+        stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                await record_usage(call_site, kwargs.get("model"), chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                await writer.append(delta)
+    return "".join(parts)
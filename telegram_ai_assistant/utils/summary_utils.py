@@ -0,0 +1,127 @@
+import asyncio
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+from telegram_ai_assistant.config import SUMMARY_REFRESH_INTERVAL, SUMMARY_FOLD_BATCH_SIZE, SUMMARY_CONCURRENCY
+from telegram_ai_assistant.utils.db_utils import (
+    get_active_chats,
+    get_chat_messages_since,
+    get_chat_summary_state,
+    save_chat_summary
+)
+from telegram_ai_assistant.ai_module.ai_analyzer import fold_into_rolling_summary
+from telegram_ai_assistant.ai_module.usage_tracker import BudgetExceeded, usage_scope
+from telegram_ai_assistant.utils.logging_utils import setup_ai_logger
+logger = setup_ai_logger()
+# One lock per chat so a scheduled refresh and an on-demand /summary never fold the same messages twice
+_summary_locks: Dict[int, asyncio.Lock] = {}
+def _get_summary_lock(chat_id: int) -> asyncio.Lock:
+    lock = _summary_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _summary_locks[chat_id] = lock
+    return lock
+def _start_of_day(now: datetime) -> datetime:
+    return now.replace(hour=0, minute=0, second=0, microsecond=0)
+async def refresh_rolling_summary(chat_id: int, now: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+    """
+    Bring the stored summary of a chat up to date.
+    Only messages after the (last_summary_time, last_summary_message_id) cursor are read and folded into the stored
+    summary. The summary covers the current UTC day and starts over after midnight.
+    Args:
+        chat_id: Chat ID
+        now: Current UTC time (defaults to utcnow)
+    Returns:
+        Dict with chat_name, summary, summary_start, last_summary_time, new_messages and stale
+        (True if the token budget ran out before all messages were folded), or None if the chat is unknown
+    """
+    now = now or datetime.utcnow()
+    async with _get_summary_lock(chat_id):
+        state = await get_chat_summary_state(chat_id)
+        if state is None:
+            logger.warning(f"Rolling summary requested for unknown chat {chat_id}")
+            return None
+        day_start = _start_of_day(now)
+        summary = state["rolling_summary"]
+        summary_start = state["rolling_summary_start"]
+        since = state["last_summary_time"]
+        after_id = state["last_summary_message_id"]
+        if summary_start is None or summary_start < day_start or since is None:
+            # Nothing stored for today yet: start a fresh summary at midnight
+            summary = None
+            summary_start = day_start
+            since = day_start
+            after_id = 0
+        new_messages_count = 0
+        stale = False
+        while True:
+            fetched = await get_chat_messages_since(chat_id, since, limit=SUMMARY_FOLD_BATCH_SIZE, after_id=after_id)
+            if not fetched:
+                break
+            # Media-only messages are skipped, but the cursor still moves past them
+            messages = [m for m in fetched if m.get("text")]
+            if messages:
+                logger.info(f"Folding {len(messages)} new messages into rolling summary of chat {chat_id}")
+                try:
+                    with usage_scope(chat_id=chat_id):
+                        summary = await fold_into_rolling_summary(summary, messages, state["chat_name"])
+                except BudgetExceeded as e:
+                    # Keep serving what was folded so far; the rest is folded once the budget resets
+                    logger.info(f"Rolling summary of chat {chat_id} left stale: {str(e)}")
+                    stale = True
+                    break
+            since = fetched[-1]["timestamp"]
+            after_id = fetched[-1]["id"]
+            new_messages_count += len(messages)
+            await save_chat_summary(chat_id, summary, summary_start, since, after_id)
+            if len(fetched) < SUMMARY_FOLD_BATCH_SIZE:
+                break
+        return {
+            "chat_id": chat_id,
+            "chat_name": state["chat_name"],
+            "summary": summary,
+            "summary_start": summary_start,
+            "last_summary_time": since,
+            "new_messages": new_messages_count,
+            "stale": stale
+        }
+async def refresh_all_rolling_summaries(
+    on_progress: Optional[Callable[[Dict[str, Any], str], Awaitable[None]]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Refresh the rolling summary of every active chat and return the results.
+    Chats are refreshed concurrently, at most SUMMARY_CONCURRENCY at a time.
+    Args:
+        on_progress: Optional coroutine called with (chat, status) whenever a chat
+            starts ("working") or ends ("done", "error")
+    Returns:
+        Results of refresh_rolling_summary in active chat order
+    """
+    semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+    async def refresh_chat(chat: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        async with semaphore:
+            status = "error"
+            if on_progress:
+                await on_progress(chat, "working")
+            try:
+                result = await refresh_rolling_summary(chat["chat_id"])
+                status = "done"
+                return result
+            except Exception as e:
+                logger.error(f"Error refreshing rolling summary for chat {chat['chat_id']}: {str(e)}", exc_info=True)
+                return None
+            finally:
+                if on_progress:
+                    await on_progress(chat, status)
+    results = await asyncio.gather(*(refresh_chat(chat) for chat in await get_active_chats()))
+    return [result for result in results if result]
+async def refresh_summaries_periodically():
+    """Keep rolling summaries warm so /summary only has to fold the last few messages"""
+    logger.info(f"Starting periodic rolling summary refresh every {SUMMARY_REFRESH_INTERVAL} seconds")
+    while True:
+        try:
+            results = await refresh_all_rolling_summaries()
+            folded = sum(r["new_messages"] for r in results)
+            logger.info(f"Rolling summaries refreshed for {len(results)} chats, {folded} new messages folded")
+        except Exception as e:
+            logger.error(f"Error in rolling summary refresh: {str(e)}", exc_info=True)
+        await asyncio.sleep(SUMMARY_REFRESH_INTERVAL)
@@ -0,0 +1,40 @@
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+from telegram_ai_assistant.utils.db_models import init_db
+from telegram_ai_assistant.utils.db_utils import get_llm_usage_report
+from telegram_ai_assistant.ai_module.usage_tracker import get_budget_status
+GROUPINGS = ["feature", "call_site", "chat", "model", "day"]
+async def main():
+    """Print LLM token usage and estimated cost from the llm_usage table."""
+    parser = argparse.ArgumentParser(description="LLM token usage report")
+    parser.add_argument("--days", type=int, default=7, help="Number of days to report (default: 7)")
+    parser.add_argument("--by", choices=GROUPINGS, default="feature", help="How to group usage (default: feature)")
+    parser.add_argument("--limit", type=int, default=30, help="Maximum number of rows")
+    args = parser.parse_args()
+    init_db()
+    since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=args.days - 1)
+    rows = await get_llm_usage_report(since, group_by=args.by, limit=args.limit)
+    print(f"LLM usage by {args.by} since {since:%Y-%m-%d} (UTC)")
+    print("-" * 96)
+    print(f"{args.by:<40} {'requests':>9} {'prompt':>12} {'cached':>10} {'completion':>11} {'cost $':>10}")
+    print("-" * 96)
+    for row in rows:
+        print(
+            f"{str(row['key']):<40.40} {row['requests']:>9} {row['prompt_tokens']:>12,} {row['cached_tokens']:>10,} "
+            f"{row['completion_tokens']:>11,} {row['cost']:>10.4f}"
+        )
+    print("-" * 96)
+    print(
+        f"{'total':<40} {sum(row['requests'] for row in rows):>9} {sum(row['prompt_tokens'] for row in rows):>12,} "
+        f"{sum(row['cached_tokens'] for row in rows):>10,} {sum(row['completion_tokens'] for row in rows):>11,} "
+        f"{sum(row['cost'] for row in rows):>10.4f}"
+    )
+    status = await get_budget_status()
+    budgets = [(feature, state) for feature, state in status["features"].items() if state["budget"]]
+    if budgets:
+        print(f"\nDaily budgets for {status['day']}:")
+        for feature, state in budgets:
+            print(f"  {feature:<20} {state['used']:>12,} / {state['budget']:,} tokens ({state['used'] / state['budget']:.0%})")
+if __name__ == "__main__":
+    asyncio.run(main())
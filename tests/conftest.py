@@ -0,0 +1,21 @@
+import os
+import tempfile
+import pytest
+# config.py reads these at import time; tests run against a throwaway SQLite database
+_TEST_DIR = tempfile.mkdtemp(prefix="telegram_ai_assistant_tests_")
+os.environ.setdefault("TELEGRAM_API_ID", "1")
+os.environ.setdefault("TELEGRAM_API_HASH", "test")
+os.environ.setdefault("ADMIN_USER_ID", "1")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ["DB_URI"] = f"sqlite:///{os.path.join(_TEST_DIR, 'test.db')}"
+os.environ["DOWNLOADS_DIR"] = os.path.join(_TEST_DIR, "downloads")
+@pytest.fixture
+def db():
+    """Empty database tables for one test"""
+    from telegram_ai_assistant.utils.db_models import init_db
+    from telegram_ai_assistant.utils.db_utils import engine, Base
+    init_db().close()
+    yield engine
+    with engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
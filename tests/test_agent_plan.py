@@ -0,0 +1,11 @@
+import pytest
+from telegram_ai_assistant.ai_module.ai_analyzer import validate_plan_steps
+def test_steps_are_numbered_by_field_or_position():
+    assert validate_plan_steps([{"step": 1}, {"step": 2}, {"step": 5}]) == [1, 2, 5]
+    assert validate_plan_steps([{"sql": "SELECT 1"}, {"step": "two"}]) == [1, 2]
+def test_duplicate_step_numbers_are_rejected():
+    with pytest.raises(ValueError, match=r"\[2\]"):
+        validate_plan_steps([{"step": 1}, {"step": 2}, {"step": 2}])
+    # A positional number can collide with an explicit one
+    with pytest.raises(ValueError):
+        validate_plan_steps([{"step": 2}, {"sql": "SELECT 1"}])
@@ -0,0 +1,47 @@
+import io
+import json
+import pytest
+from telegram_ai_assistant.utils import export_importer
+from telegram_ai_assistant.utils.export_importer import iter_export, message_to_row
+SINGLE_CHAT = {
+    "name": "Dev",
+    "type": "private_supergroup",
+    "id": 1234567890,
+    "messages": [
+        {"id": 1, "type": "message", "date": "2026-10-19T09:00:00", "from": "Ivan", "from_id": "user10", "text": "Привет, команда"},
+        {"id": 2, "type": "message", "date": "2026-10-19T09:01:00", "from": "Olga", "from_id": "user11",
+         "text": ["See ", {"type": "link", "text": "https://example.com"}, " please"], "reply_to_message_id": 1},
+        {"id": 123456789, "type": "service", "date": "2026-10-19T09:02:00", "actor_id": "user10", "action": "pin_message"}
+    ]
+}
+ACCOUNT = {
+    "about": "Telegram Desktop export",
+    "contacts": {"list": [{"first_name": "Ivan"}]},
+    "chats": {"about": "chats", "list": [
+        {"name": "Dev", "type": "private_supergroup", "id": 1, "messages": [{"id": 1, "text": "a"}, {"id": 2, "text": "b"}]},
+        {"name": "Empty", "type": "personal_chat", "id": 2, "messages": []}
+    ]},
+    "left_chats": {"list": [{"name": "Old", "type": "public_channel", "id": 3, "messages": [{"id": 7, "text": "c"}]}]}
+}
+@pytest.fixture(params=[1, 7, 64, export_importer.READ_CHUNK_SIZE])
+def chunk_size(request, monkeypatch):
+    """Small read chunks split keys, strings and numbers across buffer refills"""
+    monkeypatch.setattr(export_importer, "READ_CHUNK_SIZE", request.param)
+    return request.param
+def _read(data):
+    return [(dict(chat), message) for chat, message in iter_export(io.StringIO(json.dumps(data, ensure_ascii=False, indent=1)))]
+def test_single_chat_export(chunk_size):
+    items = _read(SINGLE_CHAT)
+    assert [message for _, message in items] == SINGLE_CHAT["messages"]
+    assert all(chat == {"name": "Dev", "type": "private_supergroup", "id": 1234567890} for chat, _ in items)
+def test_account_export_walks_chats_and_left_chats(chunk_size):
+    items = _read(ACCOUNT)
+    assert [(chat["name"], message["id"]) for chat, message in items] == [("Dev", 1), ("Dev", 2), ("Old", 7)]
+def test_truncated_export_raises():
+    with pytest.raises(ValueError):
+        list(iter_export(io.StringIO(json.dumps(SINGLE_CHAT)[:-40])))
+def test_message_to_row_flattens_text_and_peer_ids(tmp_path):
+    row = message_to_row(SINGLE_CHAT["messages"][1], 1234567890, str(tmp_path))
+    assert row["text"] == "See https://example.com please"
+    assert row["sender_id"] == 11
+    assert row["reply_to_message_id"] == 1
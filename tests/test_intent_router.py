@@ -0,0 +1,54 @@
+import asyncio
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import text
+from telegram_ai_assistant.ai_module.intent_router import (
+    detect_intent,
+    detect_period,
+    period_range,
+    unexplained_words,
+    route_question
+)
+@pytest.fixture
+def chats(db):
+    now = datetime.utcnow()
+    with db.begin() as connection:
+        connection.execute(text("INSERT INTO chats (chat_id, chat_name, is_active) VALUES (1, 'Dev', 1), (2, 'Marketing', 1)"))
+        connection.execute(text("INSERT INTO users (user_id, first_name) VALUES (10, 'Ivan'), (11, 'Olga')"))
+        for message_id, chat_id, sender_id, deleted_at in [(1, 1, 10, None), (2, 1, 10, None), (3, 1, 11, now), (4, 2, 11, None)]:
+            connection.execute(
+                text("INSERT INTO messages (message_id, chat_id, sender_id, text, timestamp, is_bot, deleted_at) "
+                     "VALUES (:message_id, :chat_id, :sender_id, 'hi', :timestamp, 0, :deleted_at)"),
+                {"message_id": message_id, "chat_id": chat_id, "sender_id": sender_id,
+                 "timestamp": now - timedelta(minutes=message_id), "deleted_at": deleted_at}
+            )
+        connection.execute(
+            text("INSERT INTO tasks (title, status, due_date, assignee_id, chat_id) "
+                 "VALUES ('Fix login', 'Todo', :due, 10, 1), ('Plan campaign', 'Todo', :due, 11, 2)"),
+            {"due": now + timedelta(hours=1)}
+        )
+    return db
+def test_detect_intent_and_period():
+    assert detect_intent("Кто больше всех писал на этой неделе?") == "top_senders"
+    assert detect_intent("Покажи неотвеченные вопросы") == "unanswered_questions"
+    assert detect_intent("Расскажи анекдот") is None
+    assert detect_period("Кто больше всех писал на этой неделе?") == "this_week"
+def test_this_week_starts_on_monday():
+    start, end = period_range("this_week", now=datetime(2026, 10, 18, 15, 0))
+    assert start == datetime(2026, 10, 12)
+    assert end == datetime(2026, 10, 19)
+def test_qualified_question_is_left_to_the_llm():
+    assert unexplained_words("Кто больше всех писал про релиз?", "top_senders") == ["про", "релиз"]
+    assert asyncio.run(route_question("Who sent the most messages about the release?")) is None
+def test_top_senders_filter_by_chat_and_skip_deleted(chats):
+    answer = asyncio.run(route_question("Кто больше всех писал в чате Dev за неделю?"))["answer"]
+    assert "Ivan — 2" in answer
+    assert "Olga" not in answer
+def test_tasks_due_filter_by_chat(chats):
+    answer = asyncio.run(route_question("Какие задачи со сроком на неделю в чате Dev?"))["answer"]
+    assert "Fix login" in answer
+    assert "Plan campaign" not in answer
+    answer = asyncio.run(route_question("Какие задачи со сроком на неделю?"))["answer"]
+    assert "Fix login" in answer and "Plan campaign" in answer
+def test_unknown_chat_is_left_to_the_llm(chats):
+    assert asyncio.run(route_question('Сколько сообщений в чате "Nope" сегодня?')) is None
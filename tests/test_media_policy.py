@@ -0,0 +1,63 @@
+import asyncio
+import os
+import pytest
+from telegram_ai_assistant.utils import media_policy
+from telegram_ai_assistant.utils.media_policy import choose_policy, fetch_analysis_images, local_image_path
+from telegram_ai_assistant.utils.db_utils import store_message
+MB = 1024 * 1024
+@pytest.fixture
+def policies(monkeypatch):
+    monkeypatch.setattr(media_policy, "MEDIA_POLICIES", {})
+    monkeypatch.setattr(media_policy, "MEDIA_CHAT_POLICIES", {})
+    monkeypatch.setattr(media_policy, "MEDIA_EAGER_MAX_BYTES", 10 * MB)
+    return monkeypatch
+def test_default_policies(policies):
+    assert choose_policy("photo", MB, 1, True) == "eager"
+    assert choose_policy("video", 50 * MB, 1, True) == "thumbnail"
+    assert choose_policy("voice", MB, 1, False) == "reference"
+    assert choose_policy("unknown", MB, 1, False) == "reference"
+def test_large_or_previewless_files_are_downgraded(policies):
+    assert choose_policy("photo", 20 * MB, 1, True) == "thumbnail"
+    assert choose_policy("image", 20 * MB, 1, False) == "reference"
+    assert choose_policy("video", MB, 1, False) == "reference"
+def test_kind_and_chat_overrides(policies):
+    policies.setattr(media_policy, "MEDIA_POLICIES", {"document": "thumbnail", "sticker": "bogus"})
+    policies.setattr(media_policy, "MEDIA_CHAT_POLICIES", {"5": "reference", "6": {"photo": "memory"}})
+    assert choose_policy("document", MB, 1, True) == "thumbnail"
+    assert choose_policy("sticker", MB, 1, True) == "reference"
+    assert choose_policy("photo", MB, 5, True) == "reference"
+    assert choose_policy("photo", MB, 6, True) == "memory"
+    assert choose_policy("video", MB, 6, True) == "thumbnail"
+class FakeMessage:
+    media = True
+class FakeClient:
+    """Telethon client that serves a distinct small file per download"""
+    def __init__(self):
+        self.downloads = 0
+    async def get_messages(self, chat_id, ids):
+        return FakeMessage()
+    async def download_media(self, message, file=None, thumb=None):
+        self.downloads += 1
+        path = f"{file}.jpg"
+        with open(path, "wb") as handle:
+            handle.write(f"image {self.downloads}".encode())
+        return path
+def _attachment(**fields):
+    attachment = {"kind": "photo", "file_key": None, "policy": "eager", "path": None, "object": None,
+                  "thumbnail_path": None, "thumbnail_object": None, "has_thumbnail": True, "size": MB,
+                  "chat_id": 1, "message_id": 5}
+    attachment.update(fields)
+    return attachment
+def test_evicted_and_reference_images_are_fetched_for_analysis(db, policies):
+    attachments = [
+        _attachment(file_key="photo:1", evicted_at="2026-10-01T00:00:00"),
+        _attachment(kind="image", file_key="document:2", policy="reference", has_thumbnail=False),
+        _attachment(kind="voice", file_key="document:3", policy="reference", has_thumbnail=False)
+    ]
+    asyncio.run(store_message(1, "Dev", 5, 10, "Ivan", "", attachments=attachments))
+    client = FakeClient()
+    fetched = asyncio.run(fetch_analysis_images(client, {"chat_id": 1, "message_id": 5, "attachments": attachments}))
+    assert client.downloads == 2
+    assert [bool(local_image_path(attachment)) for attachment in fetched] == [True, True, False]
+    assert "evicted_at" not in fetched[0]
+    assert all(os.path.exists(attachment["path"]) for attachment in fetched[:2])
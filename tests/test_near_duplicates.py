@@ -0,0 +1,44 @@
+import time
+import pytest
+from telegram_ai_assistant.utils import near_duplicates
+from telegram_ai_assistant.utils.near_duplicates import simhash, hamming_distance, find_duplicate, remember_analysis, forget_messages
+ANNOUNCEMENT = (
+    "Team, the release of version 2.4 is scheduled for Thursday evening. Please merge all pending pull requests "
+    "by Wednesday noon, update the changelog and make sure the staging environment is green before the freeze starts."
+)
+ALERT = "Deploy of backend service finished at 12:41, build 5812, see https://ci.example.com/builds/5812 for the logs"
+@pytest.fixture(autouse=True)
+def empty_window():
+    near_duplicates._window.clear()
+    yield
+    near_duplicates._window.clear()
+def test_short_texts_have_no_fingerprint():
+    assert simhash("ok") is None
+    assert simhash(None) is None
+def test_fingerprint_is_a_signed_64_bit_integer():
+    fingerprint = simhash(ALERT)
+    assert -(1 << 63) <= fingerprint < 1 << 63
+    assert simhash(ALERT) == fingerprint
+def test_numbers_and_links_do_not_change_the_fingerprint():
+    other = ALERT.replace("12:41", "13:05").replace("5812", "5813")
+    assert simhash(other) == simhash(ALERT)
+def test_different_texts_are_far_apart():
+    other = "Could someone review the pull request with the new billing page before the weekly planning meeting?"
+    assert hamming_distance(simhash(ALERT), simhash(other)) > near_duplicates.DUPLICATE_MAX_DISTANCE
+def test_find_duplicate_returns_the_analysis_of_a_near_copy():
+    remember_analysis(simhash(ANNOUNCEMENT), 1, 100, {"category": "notification", "is_important": False})
+    duplicate = find_duplicate(simhash("Hi team, " + ANNOUNCEMENT[6:] + " Thanks!"), 2, 200)
+    assert (duplicate["chat_id"], duplicate["message_id"]) == (1, 100)
+    assert duplicate["analysis"]["category"] == "notification"
+    assert duplicate["distance"] <= near_duplicates.DUPLICATE_MAX_DISTANCE
+def test_message_is_not_its_own_duplicate():
+    remember_analysis(simhash(ALERT), 1, 100, {"category": "notification"})
+    assert find_duplicate(simhash(ALERT), 1, 100) is None
+def test_expired_forgotten_and_failed_analyses_are_not_reused():
+    remember_analysis(simhash(ALERT), 1, 100, {"category": "notification"}, seen_at=time.time() - 48 * 3600)
+    assert find_duplicate(simhash(ALERT), 2, 200) is None
+    remember_analysis(simhash(ALERT), 1, 101, {"error": "timeout"})
+    assert find_duplicate(simhash(ALERT), 2, 200) is None
+    remember_analysis(simhash(ALERT), 1, 102, {"category": "notification"})
+    assert forget_messages(1, [102]) == 1
+    assert find_duplicate(simhash(ALERT), 2, 200) is None
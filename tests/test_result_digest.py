@@ -0,0 +1,32 @@
+import json
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from telegram_ai_assistant.ai_module.result_digest import summarize_column, format_result_for_prompt
+def test_small_result_is_passed_as_json():
+    rows = [{"name": "Ivan", "count": 3}]
+    assert json.loads(format_result_for_prompt(rows, max_raw_rows=5)) == rows
+def test_large_result_is_digested_over_all_rows():
+    start = datetime(2026, 10, 1)
+    rows = [{"sender_id": i % 3, "amount": i, "sent_at": start + timedelta(hours=i), "text": f"m{i % 2}"} for i in range(100)]
+    text = format_result_for_prompt(rows, max_raw_rows=20)
+    assert text.startswith("Result has 100 rows.")
+    assert '- amount: {"count": 100, "nulls": 0, "distinct": 100, "type": "number", "sum": 4950' in text
+    assert '"min": "2026-10-01T00:00:00", "max": "2026-10-05T03:00:00"' in text
+    assert text.count("\n{") == 10
+def test_decimal_values_are_numbers():
+    digest = summarize_column("amount", [Decimal("1.5"), Decimal("2.5"), None])
+    assert digest["type"] == "number"
+    assert (digest["min"], digest["max"], digest["sum"], digest["nulls"]) == (1.5, 2.5, 4.0, 1)
+    json.dumps(digest)
+def test_datetime_and_date_values_are_times():
+    aware = datetime(2026, 10, 19, 3, 0, tzinfo=timezone(timedelta(hours=3)))
+    digest = summarize_column("sent_at", [aware, datetime(2026, 10, 20), "2026-10-21 12:00:00"])
+    assert digest["type"] == "datetime"
+    assert (digest["min"], digest["max"]) == ("2026-10-19T00:00:00", "2026-10-21T12:00:00")
+    assert summarize_column("due", [datetime(2026, 1, 1).date(), datetime(2026, 2, 1).date()])["type"] == "datetime"
+def test_text_and_boolean_columns():
+    assert summarize_column("flag", [True, False, True])["true"] == 2
+    digest = summarize_column("category", ["bug", "bug", "task", ""])
+    assert digest["type"] == "text"
+    assert digest["nulls"] == 1
+    assert digest["top"][0] == {"value": "bug", "count": 2}
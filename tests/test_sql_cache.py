@@ -0,0 +1,61 @@
+import asyncio
+import pytest
+from telegram_ai_assistant.ai_module import sql_cache
+from telegram_ai_assistant.ai_module.sql_cache import (
+    normalize_question,
+    parameterize_sql,
+    match_sql_template,
+    remember_sql_template
+)
+@pytest.fixture
+def cache(db):
+    sql_cache._templates = None
+    yield
+    sql_cache._templates = None
+def test_normalize_question_extracts_literals():
+    template, values = normalize_question('Сколько сообщений за 7 дней в чате "Dev"?')
+    assert template == "сколько сообщений за <n0> дней в чате <s0>"
+    assert values == {"s0": "Dev", "n0": 7}
+def test_parameterize_sql_replaces_question_literals():
+    sql, slots = parameterize_sql(
+        "SELECT COUNT(*) FROM messages m JOIN chats c ON c.chat_id = m.chat_id WHERE c.chat_name LIKE '%Dev%' LIMIT 7",
+        {"s0": "Dev", "n0": 7}
+    )
+    assert sql.endswith("WHERE c.chat_name LIKE :s0 LIMIT :n0")
+    assert slots == {"s0": "%{}%", "n0": "{}"}
+def test_exact_match_fills_parameters(cache):
+    asyncio.run(remember_sql_template(
+        'Сколько сообщений в чате "Dev"?',
+        "SELECT COUNT(*) FROM messages m JOIN chats c ON c.chat_id = m.chat_id WHERE c.chat_name = 'Dev'"
+    ))
+    match = asyncio.run(match_sql_template('Сколько сообщений в чате "Ops"?'))
+    assert match["match"] == "exact"
+    assert match["params"] == {"s0": "Ops"}
+def test_sql_with_computed_date_is_not_cached(cache):
+    asyncio.run(remember_sql_template(
+        "Сколько сообщений сегодня?",
+        "SELECT COUNT(*) FROM messages WHERE DATE(timestamp) = '2026-10-19'"
+    ))
+    assert asyncio.run(match_sql_template("Сколько сообщений сегодня?")) is None
+def test_relative_date_literal_from_question_is_cached(cache):
+    asyncio.run(remember_sql_template(
+        "Сколько сообщений за 7 дней?",
+        "SELECT COUNT(*) FROM messages WHERE timestamp >= DATE('now', '-7 days')"
+    ))
+    assert asyncio.run(match_sql_template("Сколько сообщений за 7 дней?"))["match"] == "exact"
+    assert asyncio.run(match_sql_template("Сколько сообщений за 30 дней?")) is None
+def test_similar_match_requires_same_baked_literals(cache):
+    asyncio.run(remember_sql_template(
+        "How many messages in the backend chat mention the release?",
+        "SELECT COUNT(*) FROM messages WHERE text LIKE '%release%'"
+    ))
+    assert asyncio.run(match_sql_template("How many messages in the backend chat mention a release?"))["match"] == "similar"
+    # Close enough by embedding, but the SQL searches for a word the question does not contain
+    assert asyncio.run(match_sql_template("How many messages in the backend chat mention the relise?")) is None
+def test_similar_match_requires_same_qualifiers(cache):
+    asyncio.run(remember_sql_template(
+        "Who sent the most messages in the backend chat?",
+        "SELECT sender_id, COUNT(*) AS n FROM messages GROUP BY sender_id ORDER BY n DESC LIMIT 1"
+    ))
+    assert asyncio.run(match_sql_template("Who sent the most messages in backend chat?"))["match"] == "similar"
+    assert asyncio.run(match_sql_template("Who sent the least messages in the backend chat?")) is None